@@ -0,0 +1,122 @@
+"""Measure how throughput scales with the number of workers a `Coordinator` shards a batch across.
+
+Each record runs an agent whose one callable either sleeps (standing in for a model or service
+call) or spins the CPU, for a time drawn uniformly from zero to twice `--seconds`, so callable
+latency is uneven. Throughput is reported for each number of workers, along with its speedup over
+one worker:
+
+    python benchmarks/distributed_benchmark.py --records 400 --workers 1 2 4 8 --work sleep
+"""
+
+import argparse
+import random
+import time
+from typing import ClassVar
+
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+from planning_agent_demo.serving.distributed import Coordinator
+
+
+class WorkInputs(BaseCallableInputs):
+    seconds: float
+    work: str
+
+
+class WorkOutputs(BaseCallableOutputs):
+    seconds: float
+
+
+class WorkTool(SimpleCallable[WorkInputs, WorkOutputs]):
+    name: ClassVar[str] = "work"
+    description: ClassVar[str] = "Sleep or spin for some time"
+    inputs: ClassVar[type[BaseCallableInputs]] = WorkInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = WorkOutputs
+
+    def execute(self, arguments: WorkInputs) -> WorkOutputs:
+        if arguments.work == "sleep":
+            time.sleep(arguments.seconds)
+        else:
+            end = time.perf_counter() + arguments.seconds
+            while time.perf_counter() < end:
+                pass
+        return WorkOutputs(seconds=arguments.seconds)
+
+
+def work_agent() -> SelfProgrammer:
+    return SelfProgrammer(
+        name="worker",
+        instructions="Do some work",
+        callables=[WorkTool()],
+        inputs=dict(
+            seconds=PlaceholderDefinition(dtype=float, description="How long"),
+            work=PlaceholderDefinition(dtype=str, description="sleep or cpu"),
+        ),
+        expected_outputs=dict(seconds=PlaceholderDefinition(dtype=float, description="How long")),
+        program=Program(
+            statements=[
+                AssignmentStatement(
+                    assignments=dict(seconds="seconds"),
+                    rhs_expression=CallableInvocation(
+                        name="work",
+                        arguments=dict(
+                            seconds=VariableExpr(name="seconds"), work=VariableExpr(name="work")
+                        ),
+                    ),
+                )
+            ],
+            return_statement=ReturnStatement(
+                return_values=dict(seconds=VariableExpr(name="seconds"))
+            ),
+        ),
+    )
+
+
+def measure(agent: SelfProgrammer, records: list[dict], workers: int) -> float:
+    with Coordinator(agent) as coordinator:
+        coordinator.spawn_workers(workers, callables=[WorkTool()])
+        start = time.perf_counter()
+        results = list(coordinator.map(records))
+        seconds = time.perf_counter() - start
+    assert [result["seconds"] for result in results] == [record["seconds"] for record in records]
+    return len(records) / seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--records", type=int, default=400)
+    parser.add_argument("--seconds", type=float, default=0.01, help="Mean time per record")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--work", choices=["sleep", "cpu"], default="sleep")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    records = [
+        dict(seconds=rng.uniform(0, 2 * args.seconds), work=args.work) for _ in range(args.records)
+    ]
+    agent = work_agent()
+    print(f"Running {args.records} records of ~{args.seconds * 1000:.0f} ms of {args.work}")
+    baseline = None
+    for workers in args.workers:
+        throughput = measure(agent, records, workers)
+        baseline = baseline or throughput
+        print(
+            f"- {workers:3} workers: {throughput:8.1f} records/s, "
+            f"{throughput / baseline:5.2f}x one worker"
+        )
+
+
+if __name__ == "__main__":
+    main()
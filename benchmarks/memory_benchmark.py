@@ -0,0 +1,118 @@
+"""Measure the memory a nested agent tree allocates to pass one large value down to its leaf.
+
+Each agent in a chain of `--depth` agents hands a list of `--items` numbers to the next, and the
+innermost one counts them. The peak traced allocation of running the tree is reported with the
+list's inputs declared normally (so each agent boundary validates, and copies, the list) and with
+`by_reference=True` (so each boundary only checks the value's type and passes it on as-is):
+
+    python benchmarks/memory_benchmark.py --depth 8 --items 1000000
+"""
+
+import argparse
+import time
+import tracemalloc
+from typing import ClassVar
+
+from pydantic import InstanceOf, validate_call
+
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class CountInputs(BaseCallableInputs):
+    items: InstanceOf[list]
+
+
+class CountOutputs(BaseCallableOutputs):
+    count: int
+
+
+class CountTool(SimpleCallable[CountInputs, CountOutputs]):
+    name: ClassVar[str] = "count"
+    description: ClassVar[str] = "Count the items in a list"
+    inputs: ClassVar[type[BaseCallableInputs]] = CountInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = CountOutputs
+
+    @validate_call
+    def execute(self, arguments: CountInputs) -> CountOutputs:
+        return CountOutputs(count=len(arguments.items))
+
+
+def agent_chain(depth: int, *, by_reference: bool, trusted: bool) -> SelfProgrammer:
+    """`depth` agents, each passing `items` on to the next; the innermost one calls `count`."""
+    callable_instance = CountTool()
+    for level in range(depth):
+        callable_instance = SelfProgrammer(
+            name="count" if level == 0 else f"level_{level}",
+            instructions="Count the items",
+            callables=[callable_instance],
+            inputs=dict(
+                items=PlaceholderDefinition(
+                    dtype=list, description="The items", by_reference=by_reference
+                )
+            ),
+            expected_outputs=dict(count=PlaceholderDefinition(dtype=int, description="How many")),
+            trusted=trusted,
+            program=Program(
+                statements=[
+                    AssignmentStatement(
+                        assignments=dict(count="count"),
+                        rhs_expression=CallableInvocation(
+                            name=callable_instance.definition.name,
+                            arguments=dict(items=VariableExpr(name="items")),
+                        ),
+                    )
+                ],
+                return_statement=ReturnStatement(
+                    return_values=dict(count=VariableExpr(name="count"))
+                ),
+            ),
+        )
+    return callable_instance
+
+
+def measure(agent: SelfProgrammer, items: list) -> tuple[int, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = agent.execute(dict(items=items))
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result.count == len(items)
+    return peak, seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--items", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    items = list(range(args.items))
+    print(f"Passing {args.items} items through {args.depth} nested agents")
+    for trusted in (False, True):
+        for by_reference in (False, True):
+            agent = agent_chain(args.depth, by_reference=by_reference, trusted=trusted)
+            # The first run builds and caches each agent's input and output models
+            measure(agent, items)
+            peak, seconds = measure(agent, items)
+            print(
+                f"- trusted={trusted!s:5} by_reference={by_reference!s:5}: "
+                f"peak {peak / 2**20:8.2f} MiB, {seconds * 1000:8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
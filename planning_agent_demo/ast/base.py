@@ -10,6 +10,12 @@ class BaseExpression(BaseModel):
     def evaluate(self, run_state) -> Any:
         raise NotImplementedError("Subclasses must implement evaluate")
 
+    def verify(self, defined_variables, callables) -> list[str]:
+        raise NotImplementedError("Subclasses must implement verify")
+
+    def reads(self) -> set[str]:
+        raise NotImplementedError("Subclasses must implement reads")
+
 
 class BaseStatement(BaseModel):
     def __str__(self):
@@ -17,3 +23,9 @@ class BaseStatement(BaseModel):
 
     def execute(self, run_state):
         raise NotImplementedError("Subclasses must implement execute")
+
+    def verify(self, defined_variables, callables) -> list[str]:
+        raise NotImplementedError("Subclasses must implement verify")
+
+    def reads(self) -> set[str]:
+        raise NotImplementedError("Subclasses must implement reads")
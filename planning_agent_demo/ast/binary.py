@@ -0,0 +1,559 @@
+"""Compact, versioned binary encoding for `Program`s and `SelfProgrammer` agents.
+
+Each blob starts with a small header (magic, format version, payload kind), followed by a table of
+interned strings and the payload itself. Variable names, callable names, descriptions, etc. are
+stored once in the string table and referenced by index everywhere else.
+
+Decoding builds the AST with `model_construct`, skipping pydantic validation entirely, so only
+load blobs that were produced by `dumps`.
+
+Many blobs can be bundled into a single archive file with `write_archive` and loaded back lazily
+through a memory map with `ProgramArchive`.
+"""
+
+import decimal
+import functools
+import importlib
+import json
+import mmap
+import struct
+import uuid
+from collections.abc import Iterable, Mapping
+from typing import Annotated, Any
+
+from pydantic import TypeAdapter
+
+from planning_agent_demo.ast.dtype import BaseDtype
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    LiteralExpr,
+    MapExpr,
+    Program,
+    RecordExpr,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+
+MAGIC = b"PADB"
+ARCHIVE_MAGIC = b"PADA"
+FORMAT_VERSION = 1
+
+KIND_PROGRAM = 1
+KIND_AGENT = 2
+KIND_VALUES = 3
+
+_EXPR_VARIABLE = 0
+_EXPR_LITERAL = 1
+_EXPR_CALL = 2
+_EXPR_RECORD = 3
+_EXPR_MAP = 4
+
+_PARALLELISM = ["serial", "threads", "processes"]
+
+_STMT_ASSIGNMENT = 0
+
+_VALUE_NONE = 0
+_VALUE_FALSE = 1
+_VALUE_TRUE = 2
+_VALUE_INT = 3
+_VALUE_FLOAT = 4
+_VALUE_DECIMAL = 5
+_VALUE_STR = 6
+_VALUE_LIST = 7
+_VALUE_DICT = 8
+_VALUE_BYTES = 9
+
+_CALLABLE_BY_NAME = 0
+_CALLABLE_AGENT = 1
+
+# Agent fields with their own encoding; every other field is stored in the agent's settings
+_AGENT_FIELDS = frozenset(
+    [
+        "instance_id",
+        "name",
+        "instructions",
+        "trusted",
+        "inline_agents",
+        "inputs",
+        "expected_outputs",
+        "callables",
+        "program",
+    ]
+)
+
+_HEADER = struct.Struct("<4sBB")
+_ARCHIVE_HEADER = struct.Struct("<4sBI")
+_ARCHIVE_ENTRY = struct.Struct("<QI")
+_FLOAT = struct.Struct("<d")
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+def _construct(cls, **fields):
+    # Like `model_construct`, minus the per-field default handling, which dominates decode time
+    # for the small AST nodes; callers pass every field, including the `*_type` discriminators
+    instance = cls.__new__(cls)
+    object.__setattr__(instance, "__dict__", fields)
+    object.__setattr__(instance, "__pydantic_fields_set__", set(fields))
+    object.__setattr__(instance, "__pydantic_extra__", None)
+    object.__setattr__(instance, "__pydantic_private__", None)
+    return instance
+
+
+class _Writer:
+    def __init__(self):
+        self.strings: dict[str, int] = {}
+        self.payload = bytearray()
+
+    def byte(self, value: int):
+        self.payload.append(value)
+
+    def varint(self, value: int):
+        while value >= 0x80:
+            self.payload.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.payload.append(value)
+
+    def string(self, value: str):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        self.varint(index)
+
+    def raw(self, value: bytes):
+        self.varint(len(value))
+        self.payload += value
+
+    def getvalue(self, kind: int) -> bytes:
+        table = _Writer()
+        table.varint(len(self.strings))
+        for value in self.strings:
+            table.raw(value.encode())
+        return _HEADER.pack(MAGIC, FORMAT_VERSION, kind) + table.payload + self.payload
+
+
+class _Reader:
+    def __init__(self, data: bytes | memoryview):
+        self.data = memoryview(data)
+        magic, self.version, self.kind = _HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise BinaryFormatError("Not a planning agent binary blob")
+        if self.version != FORMAT_VERSION:
+            raise BinaryFormatError(f"Unsupported binary format version {self.version}")
+        self.offset = _HEADER.size
+        self.strings = [str(self.raw(), "utf-8") for _ in range(self.varint())]
+
+    def byte(self) -> int:
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self) -> int:
+        result = shift = 0
+        while True:
+            value = self.data[self.offset]
+            self.offset += 1
+            result |= (value & 0x7F) << shift
+            if value < 0x80:
+                return result
+            shift += 7
+
+    def string(self) -> str:
+        return self.strings[self.varint()]
+
+    def raw(self) -> memoryview:
+        length = self.varint()
+        value = self.data[self.offset : self.offset + length]
+        self.offset += length
+        return value
+
+
+def _write_value(writer: _Writer, value: Any):
+    match value:
+        case None:
+            writer.byte(_VALUE_NONE)
+        case bool():
+            writer.byte(_VALUE_TRUE if value else _VALUE_FALSE)
+        case int():
+            writer.byte(_VALUE_INT)
+            # Zigzag so small negative numbers stay small
+            writer.varint(value << 1 if value >= 0 else (-value << 1) - 1)
+        case float():
+            writer.byte(_VALUE_FLOAT)
+            writer.payload += _FLOAT.pack(value)
+        case decimal.Decimal():
+            writer.byte(_VALUE_DECIMAL)
+            writer.string(str(value))
+        case str():
+            writer.byte(_VALUE_STR)
+            writer.string(value)
+        case bytes():
+            writer.byte(_VALUE_BYTES)
+            writer.raw(value)
+        case list() | tuple():
+            writer.byte(_VALUE_LIST)
+            writer.varint(len(value))
+            for item in value:
+                _write_value(writer, item)
+        case dict():
+            writer.byte(_VALUE_DICT)
+            writer.varint(len(value))
+            for k, v in value.items():
+                _write_value(writer, k)
+                _write_value(writer, v)
+        case _:
+            raise BinaryFormatError(f"Cannot encode literal of type {type(value).__name__}")
+
+
+def _read_value(reader: _Reader) -> Any:
+    tag = reader.byte()
+    if tag == _VALUE_NONE:
+        return None
+    elif tag == _VALUE_FALSE:
+        return False
+    elif tag == _VALUE_TRUE:
+        return True
+    elif tag == _VALUE_INT:
+        value = reader.varint()
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+    elif tag == _VALUE_FLOAT:
+        (value,) = _FLOAT.unpack_from(reader.data, reader.offset)
+        reader.offset += _FLOAT.size
+        return value
+    elif tag == _VALUE_DECIMAL:
+        return decimal.Decimal(reader.string())
+    elif tag == _VALUE_STR:
+        return reader.string()
+    elif tag == _VALUE_LIST:
+        return [_read_value(reader) for _ in range(reader.varint())]
+    elif tag == _VALUE_DICT:
+        return {_read_value(reader): _read_value(reader) for _ in range(reader.varint())}
+    elif tag == _VALUE_BYTES:
+        return bytes(reader.raw())
+    raise BinaryFormatError(f"Unknown value tag {tag}")
+
+
+def _write_expression(writer: _Writer, expression):
+    match expression:
+        case VariableExpr(name=name):
+            writer.byte(_EXPR_VARIABLE)
+            writer.string(name)
+        case LiteralExpr(value=value):
+            writer.byte(_EXPR_LITERAL)
+            _write_value(writer, value)
+        case CallableInvocation(name=name, arguments=arguments):
+            writer.byte(_EXPR_CALL)
+            writer.string(name)
+            _write_expression_dict(writer, arguments)
+        case RecordExpr(values=values):
+            writer.byte(_EXPR_RECORD)
+            _write_expression_dict(writer, values)
+        case MapExpr():
+            writer.byte(_EXPR_MAP)
+            writer.string(expression.name)
+            writer.string(expression.item_parameter)
+            _write_expression(writer, expression.collection)
+            _write_expression_dict(writer, expression.arguments)
+            writer.byte(_PARALLELISM.index(expression.parallelism))
+            # Zero stands for the default number of workers
+            writer.varint(expression.max_workers or 0)
+        case _:
+            raise BinaryFormatError(f"Cannot encode expression {type(expression).__name__}")
+
+
+def _write_expression_dict(writer: _Writer, expressions: Mapping[str, Any]):
+    writer.varint(len(expressions))
+    for k, v in expressions.items():
+        writer.string(k)
+        _write_expression(writer, v)
+
+
+def _read_expression(reader: _Reader):
+    tag = reader.byte()
+    if tag == _EXPR_VARIABLE:
+        return _construct(VariableExpr, expr_type="variable", name=reader.string())
+    elif tag == _EXPR_LITERAL:
+        return _construct(LiteralExpr, expr_type="literal", value=_read_value(reader))
+    elif tag == _EXPR_CALL:
+        name = reader.string()
+        return _construct(
+            CallableInvocation,
+            expr_type="func_call",
+            name=name,
+            arguments=_read_expression_dict(reader),
+        )
+    elif tag == _EXPR_RECORD:
+        return _construct(RecordExpr, expr_type="record", values=_read_expression_dict(reader))
+    elif tag == _EXPR_MAP:
+        return _construct(
+            MapExpr,
+            expr_type="map",
+            name=reader.string(),
+            item_parameter=reader.string(),
+            collection=_read_expression(reader),
+            arguments=_read_expression_dict(reader),
+            parallelism=_PARALLELISM[reader.byte()],
+            max_workers=reader.varint() or None,
+        )
+    raise BinaryFormatError(f"Unknown expression tag {tag}")
+
+
+def _read_expression_dict(reader: _Reader) -> dict[str, Any]:
+    return {reader.string(): _read_expression(reader) for _ in range(reader.varint())}
+
+
+def _write_program(writer: _Writer, program: Program):
+    writer.varint(len(program.statements))
+    for statement in program.statements:
+        writer.byte(_STMT_ASSIGNMENT)
+        writer.varint(len(statement.assignments))
+        for k, v in statement.assignments.items():
+            writer.string(k)
+            writer.string(v)
+        _write_expression(writer, statement.rhs_expression)
+    _write_expression_dict(writer, program.return_statement.return_values)
+
+
+def _read_program(reader: _Reader) -> Program:
+    statements = []
+    for _ in range(reader.varint()):
+        if (tag := reader.byte()) != _STMT_ASSIGNMENT:
+            raise BinaryFormatError(f"Unknown statement tag {tag}")
+        assignments = {reader.string(): reader.string() for _ in range(reader.varint())}
+        statements.append(
+            _construct(
+                AssignmentStatement,
+                stmt_type="invocation",
+                assignments=assignments,
+                rhs_expression=_read_expression(reader),
+            )
+        )
+    return_statement = _construct(
+        ReturnStatement, stmt_type="return", return_values=_read_expression_dict(reader)
+    )
+    return _construct(Program, statements=statements, return_statement=return_statement)
+
+
+def _dtype_name(dtype: BaseDtype) -> str:
+    tp = dtype.to_python_type()
+    return f"{tp.__module__}.{tp.__qualname__}"
+
+
+def _dtype_from_name(name: str) -> BaseDtype:
+    module, _, qualname = name.rpartition(".")
+    tp = importlib.import_module(module)
+    for part in qualname.split("."):
+        tp = getattr(tp, part)
+    return BaseDtype.model_construct(root=tp)
+
+
+def _write_placeholders(writer: _Writer, placeholders: Mapping[str, PlaceholderDefinition]):
+    writer.varint(len(placeholders))
+    for name, placeholder in placeholders.items():
+        writer.string(name)
+        writer.string(_dtype_name(placeholder.dtype))
+        writer.string(placeholder.description)
+        writer.byte(placeholder.by_reference)
+
+
+def _read_placeholders(reader: _Reader) -> dict[str, PlaceholderDefinition]:
+    placeholders = {}
+    for _ in range(reader.varint()):
+        name = reader.string()
+        placeholders[name] = PlaceholderDefinition.model_construct(
+            dtype=_dtype_from_name(reader.string()),
+            description=reader.string(),
+            by_reference=bool(reader.byte()),
+        )
+    return placeholders
+
+
+def _write_agent(writer: _Writer, agent):
+    from planning_agent_demo.callables.base import unwrap_callable
+    from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+    writer.payload += agent.instance_id.bytes
+    writer.string(agent.name)
+    writer.string(agent.instructions)
+    writer.byte(agent.trusted | agent.inline_agents << 1)
+    _write_placeholders(writer, agent.inputs)
+    _write_placeholders(writer, agent.expected_outputs)
+    # The rest of the agent's configuration, as JSON
+    writer.raw(agent.model_dump_json(exclude=set(_AGENT_FIELDS)).encode())
+    writer.varint(len(agent.callables))
+    for fn in agent.callables:
+        # Wrappers (concurrency limits, coalescing) are applied by whoever hosts the agent, so
+        # only what they wrap is stored
+        fn = unwrap_callable(fn)
+        if isinstance(fn, SelfProgrammer):
+            writer.byte(_CALLABLE_AGENT)
+            _write_agent(writer, fn)
+        else:
+            writer.byte(_CALLABLE_BY_NAME)
+            writer.string(fn.definition.name)
+    writer.byte(agent.program is not None)
+    if agent.program is not None:
+        _write_program(writer, agent.program)
+
+
+def _read_agent_flags(flags: int) -> dict[str, bool]:
+    return dict(trusted=bool(flags & 1), inline_agents=bool(flags & 2))
+
+
+def _read_agent(reader: _Reader, callables: Mapping[str, Any]):
+    from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+    instance_id = uuid.UUID(bytes=bytes(reader.data[reader.offset : reader.offset + 16]))
+    reader.offset += 16
+    fields = dict(
+        instance_id=instance_id,
+        name=reader.string(),
+        instructions=reader.string(),
+        **_read_agent_flags(reader.byte()),
+        inputs=_read_placeholders(reader),
+        expected_outputs=_read_placeholders(reader),
+    )
+    fields.update(_read_agent_settings(reader.raw()))
+    agent_callables = []
+    for _ in range(reader.varint()):
+        tag = reader.byte()
+        if tag == _CALLABLE_BY_NAME:
+            name = reader.string()
+            if name not in callables:
+                raise BinaryFormatError(f"Agent refers to unknown callable `{name}`")
+            agent_callables.append(callables[name])
+        elif tag == _CALLABLE_AGENT:
+            agent_callables.append(_read_agent(reader, callables))
+        else:
+            raise BinaryFormatError(f"Unknown callable tag {tag}")
+    program = _read_program(reader) if reader.byte() else None
+    return SelfProgrammer.model_construct(callables=agent_callables, program=program, **fields)
+
+
+def _read_agent_settings(data: memoryview) -> dict[str, Any]:
+    settings = json.loads(bytes(data))
+    adapters = _setting_adapters()
+    unknown = set(settings) - set(adapters)
+    if unknown:
+        raise BinaryFormatError(f"Agent has unknown settings {sorted(unknown)}")
+    return {name: adapters[name].validate_python(value) for name, value in settings.items()}
+
+
+@functools.cache
+def _setting_adapters() -> dict[str, TypeAdapter]:
+    from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+    return {
+        name: TypeAdapter(Annotated[field.annotation, field])
+        for name, field in SelfProgrammer.model_fields.items()
+        if name not in _AGENT_FIELDS
+    }
+
+
+def dumps(obj) -> bytes:
+    """Encode a `Program`, a `SelfProgrammer` (including nested agents and its program), or a
+    record of plain values, such as an agent's inputs or outputs.
+
+    Non-agent callables are stored by name only and must be supplied again when loading, while an
+    agent's settings (its backends, planning and checkpointing options, etc.) are stored as JSON.
+    """
+    from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+    writer = _Writer()
+    if isinstance(obj, Program):
+        _write_program(writer, obj)
+        return writer.getvalue(KIND_PROGRAM)
+    elif isinstance(obj, SelfProgrammer):
+        _write_agent(writer, obj)
+        return writer.getvalue(KIND_AGENT)
+    elif isinstance(obj, dict):
+        _write_value(writer, obj)
+        return writer.getvalue(KIND_VALUES)
+    raise BinaryFormatError(f"Cannot encode {type(obj).__name__}")
+
+
+def loads(data: bytes | memoryview, callables: Iterable | None = None):
+    """Decode a blob produced by `dumps`, without running pydantic validation.
+
+    `callables` resolves the non-agent callables an agent refers to by name; by default the
+    registered callables (`BaseCallable.__registry__`) are used.
+    """
+    return _read(_Reader(data), _callables_by_name(callables))
+
+
+def _read(reader: _Reader, callables: Mapping[str, Any]):
+    if reader.kind == KIND_PROGRAM:
+        return _read_program(reader)
+    elif reader.kind == KIND_AGENT:
+        return _read_agent(reader, callables)
+    elif reader.kind == KIND_VALUES:
+        return _read_value(reader)
+    raise BinaryFormatError(f"Unknown payload kind {reader.kind}")
+
+
+def _callables_by_name(callables: Iterable | None) -> dict[str, Any]:
+    if callables is None:
+        from planning_agent_demo.callables.base import BaseCallable
+
+        callables = BaseCallable.__registry__
+    return {fn.definition.name: fn for fn in callables}
+
+
+def write_archive(path, objs: Iterable) -> int:
+    """Write many programs, agents and/or records of values into a single archive file, returning
+    how many were written."""
+    blobs = [dumps(obj) for obj in objs]
+    offset = _ARCHIVE_HEADER.size + _ARCHIVE_ENTRY.size * len(blobs)
+    with open(path, "wb") as f:
+        f.write(_ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, FORMAT_VERSION, len(blobs)))
+        for blob in blobs:
+            f.write(_ARCHIVE_ENTRY.pack(offset, len(blob)))
+            offset += len(blob)
+        for blob in blobs:
+            f.write(blob)
+    return len(blobs)
+
+
+class ProgramArchive:
+    """A memory-mapped archive written by `write_archive`; entries are decoded on access."""
+
+    def __init__(self, path, callables: Iterable | None = None):
+        self._callables = _callables_by_name(callables)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = _ARCHIVE_HEADER.unpack_from(self._mmap)
+        if magic != ARCHIVE_MAGIC:
+            self.close()
+            raise BinaryFormatError("Not a planning agent archive")
+        if version != FORMAT_VERSION:
+            self.close()
+            raise BinaryFormatError(f"Unsupported archive format version {version}")
+        self._entries = [
+            _ARCHIVE_ENTRY.unpack_from(self._mmap, _ARCHIVE_HEADER.size + i * _ARCHIVE_ENTRY.size)
+            for i in range(count)
+        ]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index: int):
+        offset, length = self._entries[index]
+        # Slicing copies just this entry out of the map, so no buffer stays exported past decoding
+        return _read(_Reader(self._mmap[offset : offset + length]), self._callables)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,209 @@
+"""Append-only checkpoints of program runs, so a failed or interrupted run can carry on from the
+last statement it completed instead of starting over.
+
+Each run gets one log file in the store's directory. The log starts with the run's arguments and a
+fingerprint of its program, and then, every few statements, gets one more record holding only the
+variables those statements assigned; nothing already written is ever rewritten. Records are
+checksummed, so a record torn by a crash mid-write is simply ignored, along with anything after it.
+
+A run's log is deleted once the run succeeds, and logs left untouched for `retention` seconds (runs
+that failed and were never resumed) are garbage-collected as new runs start.
+"""
+
+import hashlib
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any
+
+import planning_agent_demo
+from planning_agent_demo.ast.memory import materialize
+
+# Kind, payload length, payload CRC-32
+_RECORD = struct.Struct("<BII")
+
+_RECORD_START = 0
+_RECORD_STATEMENTS = 1
+
+_SUFFIX = ".ckpt"
+
+
+class CheckpointMismatch(ValueError):
+    pass
+
+
+def program_fingerprint(program: "planning_agent_demo.ast.expression.Program") -> str:
+    return hashlib.sha256(str(program).encode()).hexdigest()
+
+
+class Checkpoint:
+    """The log of one run, appended to as its statements complete."""
+
+    def __init__(self, path: Path, completed: int = 0, every: int = 1):
+        self.path = path
+        # Statements completed as of the last record, which a resumed run skips
+        self.completed = completed
+        self.every = every
+        self._assigned: dict[str, None] = {}
+        self._unwritten = 0
+        # Set once a record couldn't be written, after which the run carries on without them
+        self.disabled = False
+
+    def record(self, index: int, statement, run_state):
+        """Note that statement `index` completed, writing a record if enough have since the last."""
+        if self.disabled:
+            return
+        self._assigned.update(dict.fromkeys(statement.assignments))
+        self._unwritten = index + 1 - self.completed
+        if self._unwritten >= self.every:
+            self.flush(run_state)
+
+    def flush(self, run_state):
+        """Write a record for every completed statement not written yet.
+
+        A record that can't be written (a value that can't be pickled, a full disk) stops the
+        checkpointing of this run rather than failing it; resuming it would start over from the
+        last record that was written.
+        """
+        if self.disabled or not self._unwritten:
+            return
+        completed = self.completed + self._unwritten
+        # Only the variables assigned since the last record; earlier ones are already in the log
+        # Spilled buffers are read back as views of their mapped files, which can't be pickled
+        variables = {
+            name: materialize(run_state.variables[name])
+            for name in self._assigned
+            if name in run_state.variables
+        }
+        try:
+            _append(self.path, _RECORD_STATEMENTS, (completed, variables))
+        except Exception as e:
+            print(f"Stopped checkpointing {self.path.name}, a record couldn't be written: {e!r}")
+            self.disabled = True
+            return
+        self.completed = completed
+        self._assigned.clear()
+        self._unwritten = 0
+
+
+class CheckpointStore:
+    def __init__(
+        self,
+        directory: str | os.PathLike,
+        *,
+        every: int = 1,
+        retention: float = 7 * 24 * 3600,
+        gc_interval: float = 600,
+    ):
+        """Keep checkpoints in `directory`, writing a record every `every` statements.
+
+        Logs not written to for `retention` seconds are deleted, checked for at most every
+        `gc_interval` seconds when a run starts.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.every = every
+        self.retention = retention
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._last_gc = float("-inf")
+
+    def _path(self, run_id: str) -> Path:
+        if not run_id or os.sep in run_id or run_id.startswith("."):
+            raise ValueError(f"Invalid run id {run_id!r}")
+        return self.directory / f"{run_id}{_SUFFIX}"
+
+    def start(self, run_id: str, program, arguments: Mapping[str, Any]) -> Checkpoint:
+        """Begin the log of a new run, replacing any earlier run with the same id.
+
+        If the run's arguments can't be written, the checkpoint returned is disabled.
+        """
+        with self._lock:
+            if time.monotonic() - self._last_gc >= self.gc_interval:
+                self._last_gc = time.monotonic()
+                self.collect_garbage()
+        path = self._path(run_id)
+        path.unlink(missing_ok=True)
+        checkpoint = Checkpoint(path, every=self.every)
+        try:
+            _append(path, _RECORD_START, (program_fingerprint(program), dict(arguments)))
+        except Exception as e:
+            # As with any other record, the run carries on without checkpoints
+            print(f"Not checkpointing {path.name}, its arguments couldn't be written: {e!r}")
+            path.unlink(missing_ok=True)
+            checkpoint.disabled = True
+        return checkpoint
+
+    def restore(self, run_id: str, program) -> tuple[Checkpoint, dict[str, Any], dict[str, Any]]:
+        """Load a run's log, returning its checkpoint, its arguments, and its variables so far.
+
+        Raises `KeyError` for an unknown run, and `CheckpointMismatch` if the run was of a different
+        program.
+        """
+        path = self._path(run_id)
+        if not path.exists():
+            raise KeyError(f"No checkpoint for run {run_id!r}")
+        records, length = _read(path)
+        if length < path.stat().st_size:
+            # Drop a torn record, so that the records the resumed run appends can be read back
+            os.truncate(path, length)
+        if not records or records[0][0] != _RECORD_START:
+            raise CheckpointMismatch(f"Checkpoint for run {run_id!r} is incomplete")
+        fingerprint, arguments = records[0][1]
+        if fingerprint != program_fingerprint(program):
+            raise CheckpointMismatch(f"Run {run_id!r} was of a different program")
+
+        completed = 0
+        variables = {}
+        for _, (completed, assigned) in records[1:]:
+            variables.update(assigned)
+        return Checkpoint(path, completed, self.every), arguments, variables
+
+    def finish(self, run_id: str):
+        self._path(run_id).unlink(missing_ok=True)
+
+    def runs(self) -> list[str]:
+        return sorted(
+            path.name.removesuffix(_SUFFIX) for path in self.directory.glob(f"*{_SUFFIX}")
+        )
+
+    def collect_garbage(self, retention: float | None = None) -> int:
+        """Delete the logs not written to for `retention` seconds, returning how many there were."""
+        cutoff = time.time() - (self.retention if retention is None else retention)
+        removed = 0
+        for path in self.directory.glob(f"*{_SUFFIX}"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+def _append(path: Path, kind: int, value: Any):
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    # One unbuffered write per record, so concurrent runs never interleave within a record
+    with open(path, "ab", buffering=0) as f:
+        f.write(_RECORD.pack(kind, len(payload), zlib.crc32(payload)) + payload)
+
+
+def _read(path: Path) -> tuple[list[tuple[int, Any]], int]:
+    """The complete records in a log, and the length of the log they make up."""
+    data = path.read_bytes()
+    records = []
+    offset = 0
+    while offset + _RECORD.size <= len(data):
+        kind, length, crc = _RECORD.unpack_from(data, offset)
+        payload = data[offset + _RECORD.size : offset + _RECORD.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            # Torn by a crash mid-write; nothing after it can be trusted
+            break
+        records.append((kind, pickle.loads(payload)))
+        offset += _RECORD.size + length
+    return records, offset
@@ -0,0 +1,149 @@
+"""Deadlines, timeouts, and cooperative cancellation for planning and running agents.
+
+An `ExecutionContext` is made current with `execution_context(...)`, and everything run inside it,
+including nested agents and the worker threads of map expressions, sees it through
+`current_context()`. Programs check it between statements, and callables and planning LLM calls
+are abandoned once their time is up, so a caller always gets control back by the deadline:
+
+    with execution_context(timeout=2.0, callable_timeouts=dict(search=0.5)):
+        agent.execute(dict(query="..."))
+
+Python threads can't be killed, so abandoned work is cancelled cooperatively instead: its context is
+marked cancelled, and any program running under it stops at its next statement.
+"""
+
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Future
+from typing import Any
+
+
+class ExecutionTimeout(TimeoutError):
+    pass
+
+
+class ExecutionCancelled(RuntimeError):
+    pass
+
+
+_current: ContextVar["ExecutionContext | None"] = ContextVar("execution_context", default=None)
+
+
+def current_context() -> "ExecutionContext | None":
+    return _current.get()
+
+
+class ExecutionContext:
+    def __init__(
+        self,
+        timeout: float | None = None,
+        *,
+        callable_timeouts: dict[str, float] | None = None,
+        stage_timeouts: dict[str, float] | None = None,
+        parent: "ExecutionContext | None" = None,
+    ):
+        """A deadline `timeout` seconds from now, never later than the parent's.
+
+        `callable_timeouts` bounds each call of the named callables, and `stage_timeouts` each LLM
+        call of the named planning stage; both are inherited from the parent unless overridden.
+        """
+        self.parent = parent
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        if parent is not None and parent.deadline is not None:
+            self.deadline = min(self.deadline or parent.deadline, parent.deadline)
+        self.callable_timeouts = {
+            **(parent.callable_timeouts if parent else {}),
+            **(callable_timeouts or {}),
+        }
+        self.stage_timeouts = {
+            **(parent.stage_timeouts if parent else {}),
+            **(stage_timeouts or {}),
+        }
+        self._cancelled = threading.Event()
+
+    def child(self, timeout: float | None = None) -> "ExecutionContext":
+        """A context that is cancelled along with this one, but can be cancelled on its own."""
+        return ExecutionContext(timeout, parent=self)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def remaining(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self.cancelled:
+            raise ExecutionCancelled("Execution was cancelled")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise ExecutionTimeout("Execution deadline exceeded")
+
+    def call_in(self, fn: Callable, *args, **kwargs) -> Any:
+        """Call `fn` with this as the current context."""
+        token = _current.set(self)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    def run(self, fn: Callable, *args, timeout: float | None = None, what: str = "Call") -> Any:
+        """Call `fn`, giving up after `timeout` seconds or at the deadline, whichever comes first.
+
+        When there is a limit, `fn` runs on its own thread under a child context, which is
+        cancelled if it is abandoned.
+        """
+        self.check()
+        remaining = self.remaining()
+        limits = [limit for limit in (timeout, remaining) if limit is not None]
+        if not limits:
+            return self.call_in(fn, *args)
+
+        limit = min(limits)
+        child = self.child(limit)
+        future = Future()
+
+        def target():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(child.call_in(fn, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, daemon=True, name="deadline").start()
+        try:
+            return future.result(timeout=limit)
+        except TimeoutError:
+            if future.done():
+                raise
+            child.cancel()
+            raise ExecutionTimeout(f"{what} timed out after {limit:.3g}s") from None
+
+
+@contextmanager
+def execution_context(
+    timeout: float | None = None,
+    *,
+    callable_timeouts: dict[str, float] | None = None,
+    stage_timeouts: dict[str, float] | None = None,
+) -> Iterator[ExecutionContext]:
+    """Run the body under a new context, nested in the current one if there is one."""
+    context = ExecutionContext(
+        timeout,
+        callable_timeouts=callable_timeouts,
+        stage_timeouts=stage_timeouts,
+        parent=current_context(),
+    )
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
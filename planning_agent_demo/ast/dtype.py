@@ -15,6 +15,7 @@ class BaseDtype(RootModel):
                 "float": decimal.Decimal,
                 "decimal": decimal.Decimal,
                 "bool": bool,
+                "bytes": bytes,
             }.get(v, v)
         return v
 
@@ -1,10 +1,24 @@
+import contextlib
+import functools
+import time
 import traceback
+import types
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Annotated, Any, Literal
 
-from pydantic import Field
+from pydantic import BaseModel, Field
 
 import planning_agent_demo
 from planning_agent_demo.ast.base import BaseExpression, BaseStatement
+from planning_agent_demo.ast.deadline import (
+    ExecutionCancelled,
+    ExecutionContext,
+    ExecutionTimeout,
+    current_context,
+)
+from planning_agent_demo.ast.memory import is_spilled, keep_views, materialize
+from planning_agent_demo.ast.stats import callable_latency
 
 
 class VariableExpr(BaseExpression):
@@ -17,6 +31,14 @@ class VariableExpr(BaseExpression):
     def evaluate(self, run_state):
         return run_state.variables[self.name]
 
+    def verify(self, defined_variables, callables) -> list[str]:
+        if self.name not in defined_variables:
+            return [f"variable `{self.name}` is used before it is assigned"]
+        return []
+
+    def reads(self) -> set[str]:
+        return {self.name}
+
 
 class LiteralExpr(BaseExpression):
     expr_type: Literal["literal"] = Field("literal", frozen=True)
@@ -28,6 +50,12 @@ class LiteralExpr(BaseExpression):
     def evaluate(self, run_state):
         return self.value
 
+    def verify(self, defined_variables, callables) -> list[str]:
+        return []
+
+    def reads(self) -> set[str]:
+        return set()
+
 
 class CallableInvocation(BaseExpression):
     expr_type: Literal["func_call"] = Field("func_call", frozen=True)
@@ -41,13 +69,263 @@ class CallableInvocation(BaseExpression):
     def evaluate(self, run_state: "planning_agent_demo.ast.run_state.RunState") -> Any:
         callable_instance = run_state.callables[self.name]
         args = {key: value.evaluate(run_state) for key, value in self.arguments.items()}
-        args = callable_instance.inputs_type(**args)
-        result = callable_instance.execute(args)
-        return result.model_dump()
+        result, seconds = _call(self.name, callable_instance, args, run_state.trusted)
+        callable_latency.record(self.name, seconds)
+        return result
+
+    def verify(self, defined_variables, callables) -> list[str]:
+        errors = [
+            error
+            for value in self.arguments.values()
+            for error in value.verify(defined_variables, callables)
+        ]
+        return errors + _verify_call(self.name, set(self.arguments), callables)
+
+    def reads(self) -> set[str]:
+        return set().union(*(value.reads() for value in self.arguments.values()))
+
+
+def _invoke(callable_instance, args: dict[str, Any], trusted: bool) -> tuple[dict[str, Any], float]:
+    # Module-level, so process pools can run it
+    start = time.perf_counter()
+    if trusted and _conforms(callable_instance.inputs_type, args):
+        # Values flowing along a verified program's edges already have the right shape, so
+        # skip input validation and let the callable hand back plain values
+        args = callable_instance.inputs_type.model_construct(**args)
+        result = callable_instance.execute_trusted(args)
+    elif trusted:
+        # Something needs coercing (a `str` literal for an `int` parameter, say), which
+        # verification doesn't check for, so validate as an untrusted call would
+        args = _copy_spilled(callable_instance.inputs_type, args)
+        result = callable_instance.execute_trusted(callable_instance.inputs_type(**args))
+    else:
+        args = callable_instance.inputs_type(**_copy_spilled(callable_instance.inputs_type, args))
+        # Shallow, so large values are handed on by reference rather than copied
+        result = dict(callable_instance.execute(args))
+    return result, time.perf_counter() - start
+
+
+def _conforms(inputs_type: type[BaseModel], args: dict[str, Any]) -> bool:
+    """Whether every argument already has its parameter's type, so validating it changes nothing."""
+    fields, extra = _parameter_types(inputs_type)
+    for key, value in args.items():
+        accepted = fields.get(key, extra)
+        if accepted is None or not isinstance(value, accepted):
+            return False
+        # `bool` is an `int`, but validation turns it into one
+        if isinstance(value, bool) and not issubclass(bool, accepted):
+            return False
+    return True
+
+
+def _copy_spilled(inputs_type: type[BaseModel], args: dict[str, Any]) -> dict[str, Any]:
+    # Validation only passes views of spilled buffers for `Buffer` parameters; the rest get a copy
+    views = _view_parameters(inputs_type)
+    return {
+        key: materialize(value) if is_spilled(value) and key not in views else value
+        for key, value in args.items()
+    }
+
+
+@functools.cache
+def _view_parameters(inputs_type: type[BaseModel]) -> frozenset[str]:
+    return frozenset(
+        name for name, field in inputs_type.model_fields.items() if keep_views in field.metadata
+    )
+
+
+@functools.cache
+def _parameter_types(
+    inputs_type: type[BaseModel],
+) -> tuple[dict[str, tuple[type, ...] | None], tuple[type, ...] | None]:
+    """The types each parameter (and any extra parameter) takes as is, or `None` if it can't tell."""
+    fields = {
+        name: None
+        if field.metadata and field.metadata != [keep_views]
+        else _accepted_types(field.annotation)
+        for name, field in inputs_type.model_fields.items()
+    }
+    extra = None
+    if inputs_type.model_config.get("extra") == "allow":
+        extras = inputs_type.__annotations__.get("__pydantic_extra__")
+        value_type = typing.get_args(extras)[1] if typing.get_args(extras) else Any
+        extra = _accepted_types(value_type)
+    return fields, extra
+
+
+def _accepted_types(annotation) -> tuple[type, ...] | None:
+    if annotation is Any:
+        return (object,)
+    if annotation is None or annotation is type(None):
+        return (type(None),)
+    if annotation is bytes:
+        # Spilled buffers are handed to trusted calls as read-only views
+        return bytes, memoryview
+    if isinstance(annotation, type) and not typing.get_args(annotation):
+        return (annotation,)
+    origin = typing.get_origin(annotation)
+    if origin in (typing.Union, types.UnionType):
+        members = [_accepted_types(member) for member in typing.get_args(annotation)]
+        if None in members:
+            return None
+        return tuple(cls for member in members for cls in member)
+    if isinstance(origin, type) and origin is not type:
+        # Only checked shallowly, so the items of a `list[int]` holding `str`s aren't coerced
+        return (origin,)
+    return None
+
+
+def _call(name: str, callable_instance, args: dict[str, Any], trusted: bool):
+    context = current_context()
+    if context is None:
+        return _invoke(callable_instance, args, trusted)
+    return context.run(
+        _invoke,
+        callable_instance,
+        args,
+        trusted,
+        timeout=context.callable_timeouts.get(name),
+        what=f"`{name}`",
+    )
+
+
+def _gather(futures: list, siblings: ExecutionContext) -> list:
+    # In order; the first failure (or the deadline) cancels every sibling call still to finish
+    try:
+        return [future.result(timeout=siblings.remaining()) for future in futures]
+    except BaseException as e:
+        siblings.cancel()
+        for future in futures:
+            future.cancel()
+        if isinstance(e, TimeoutError) and not isinstance(e, ExecutionTimeout):
+            raise ExecutionTimeout("Execution deadline exceeded") from None
+        raise
+
+
+def _verify_call(name: str, arguments: set[str], callables) -> list[str]:
+    if name not in callables:
+        return [f"callable `{name}` is not available"]
+
+    errors = []
+    definition = callables[name].definition
+    missing = set(definition.parameters) - arguments
+    if missing:
+        errors.append(f"`{name}` is missing parameters {sorted(missing)}")
+    unexpected = arguments - set(definition.parameters)
+    if unexpected and not definition.allow_extra_parameters:
+        errors.append(f"`{name}` does not accept parameters {sorted(unexpected)}")
+    return errors
+
+
+class MapExpr(BaseExpression):
+    """Call a callable once for each item in a collection, possibly in parallel.
+
+    Each item is passed to the callable as `item_parameter`, along with the same `arguments` every
+    time. Evaluates to a record of lists: for each value the callable returns, the values returned
+    for each item, in the same order as the collection.
+    """
+
+    expr_type: Literal["map"] = Field("map", frozen=True)
+
+    name: str
+    item_parameter: str = Field(..., description="The parameter each item is passed as")
+    collection: "RhsExpression" = Field(..., description="The items to call the callable with")
+    arguments: dict[str, "RhsExpression"] = Field(
+        default_factory=dict, description="The other arguments, passed with every item"
+    )
+    parallelism: Literal["serial", "threads", "processes"] = "threads"
+    max_workers: int | None = Field(None, gt=0)
+
+    def __str__(self):
+        arguments = ", ".join(
+            [f"{self.item_parameter}=_"] + [f"{k}={v}" for k, v in self.arguments.items()]
+        )
+        return f"[{self.name}({arguments}) for _ in {self.collection}]"
+
+    def evaluate(self, run_state: "planning_agent_demo.ast.run_state.RunState") -> Any:
+        callable_instance = run_state.callables[self.name]
+        items = self.collection.evaluate(run_state)
+        args = {key: value.evaluate(run_state) for key, value in self.arguments.items()}
+        calls = [
+            (callable_instance, {**args, self.item_parameter: item}, run_state.trusted)
+            for item in items
+        ]
+
+        if self.parallelism == "serial" or len(calls) <= 1:
+            results = [_call(self.name, *call) for call in calls]
+        else:
+            context = current_context()
+            siblings = context.child() if context is not None else ExecutionContext()
+            if self.parallelism == "threads":
+                executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                futures = [
+                    executor.submit(siblings.call_in, _call, self.name, *call) for call in calls
+                ]
+            else:
+                # Worker processes can't see the context, so the deadline is enforced from here;
+                # nor can they see spilled buffers, which are sent as copies
+                executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                futures = [
+                    executor.submit(_invoke, fn, materialize(args), trusted)
+                    for fn, args, trusted in calls
+                ]
+            try:
+                results = _gather(futures, siblings)
+            except BaseException:
+                # Don't wait for abandoned calls to finish
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            executor.shutdown()
+
+        for _, seconds in results:
+            callable_latency.record(self.name, seconds)
+        return {
+            name: [result[name] for result, _ in results]
+            for name in callable_instance.definition.returns
+        }
+
+    def verify(self, defined_variables, callables) -> list[str]:
+        errors = self.collection.verify(defined_variables, callables) + [
+            error
+            for value in self.arguments.values()
+            for error in value.verify(defined_variables, callables)
+        ]
+        if self.item_parameter in self.arguments:
+            errors.append(f"`{self.item_parameter}` is both the item parameter and an argument")
+        return errors + _verify_call(
+            self.name, set(self.arguments) | {self.item_parameter}, callables
+        )
+
+    def reads(self) -> set[str]:
+        return self.collection.reads().union(*(value.reads() for value in self.arguments.values()))
+
+
+class RecordExpr(BaseExpression):
+    expr_type: Literal["record"] = Field("record", frozen=True)
+    values: dict[str, "RhsExpression"] = Field(
+        ..., description="The named expressions to evaluate into a record"
+    )
+
+    def __str__(self):
+        return "{" + ", ".join(f"{k}: {v}" for k, v in self.values.items()) + "}"
+
+    def evaluate(self, run_state):
+        return {k: v.evaluate(run_state) for k, v in self.values.items()}
+
+    def verify(self, defined_variables, callables) -> list[str]:
+        return [
+            error
+            for value in self.values.values()
+            for error in value.verify(defined_variables, callables)
+        ]
+
+    def reads(self) -> set[str]:
+        return set().union(*(value.reads() for value in self.values.values()))
 
 
 RhsExpression = Annotated[
-    VariableExpr | LiteralExpr | CallableInvocation, Field(discriminator="expr_type")
+    VariableExpr | LiteralExpr | CallableInvocation | RecordExpr | MapExpr,
+    Field(discriminator="expr_type"),
 ]
 
 
@@ -68,6 +346,25 @@ class AssignmentStatement(BaseStatement):
         for k, v in self.assignments.items():
             run_state.variables[k] = result[v]
 
+    def verify(self, defined_variables, callables) -> list[str]:
+        errors = self.rhs_expression.verify(defined_variables, callables)
+        if (
+            isinstance(self.rhs_expression, CallableInvocation | MapExpr)
+            and self.rhs_expression.name in callables
+        ):
+            returns = callables[self.rhs_expression.name].definition.returns
+            unknown = set(self.assignments.values()) - set(returns)
+            if unknown:
+                errors.append(f"`{self.rhs_expression.name}` does not return {sorted(unknown)}")
+        elif isinstance(self.rhs_expression, RecordExpr):
+            unknown = set(self.assignments.values()) - set(self.rhs_expression.values)
+            if unknown:
+                errors.append(f"record has no values {sorted(unknown)}")
+        return errors
+
+    def reads(self) -> set[str]:
+        return self.rhs_expression.reads()
+
 
 class ReturnStatement(BaseStatement):
     stmt_type: Literal["return"] = Field("return", frozen=True)
@@ -85,6 +382,16 @@ class ReturnStatement(BaseStatement):
             values={k: v.evaluate(run_state) for k, v in self.return_values.items()}
         )
 
+    def verify(self, defined_variables, callables) -> list[str]:
+        return [
+            error
+            for value in self.return_values.values()
+            for error in value.verify(defined_variables, callables)
+        ]
+
+    def reads(self) -> set[str]:
+        return set().union(*(value.reads() for value in self.return_values.values()))
+
 
 NonterminalStatement = Annotated[AssignmentStatement, Field(discriminator="stmt_type")]
 TerminalStatement = Annotated[ReturnStatement, Field(discriminator="stmt_type")]
@@ -108,15 +415,99 @@ class Program(BaseExpression):
             + str(self.return_statement)
         )
 
-    def evaluate(self, run_state):
+    def verify(self, defined_variables, callables, expected_outputs=None) -> list[str]:
+        """Statically check the program against the callables it will run with.
+
+        Every variable must be assigned before it is read, every call must match its callable's
+        parameters and return names, and (if given) the return statement must produce exactly
+        `expected_outputs`. Returns the problems found; an empty list means the program is sound.
+        """
+        defined_variables = set(defined_variables)
+        errors = []
+        for i, statement in enumerate(self.statements, 1):
+            errors.extend(
+                f"statement {i}: {error}"
+                for error in statement.verify(defined_variables, callables)
+            )
+            defined_variables.update(statement.assignments)
+        errors.extend(
+            f"return: {error}"
+            for error in self.return_statement.verify(defined_variables, callables)
+        )
+        if expected_outputs is not None and set(self.return_statement.return_values) != set(
+            expected_outputs
+        ):
+            errors.append(
+                f"return: expected outputs {sorted(expected_outputs)}, "
+                f"got {sorted(self.return_statement.return_values)}"
+            )
+        return errors
+
+    def dead_variables(self) -> list[list[str]]:
+        """For each statement, the variables no later statement (or the return) reads once it's run.
+
+        Those are the variables the statement reads or assigns for the last time before they are
+        next assigned, if ever, and so can be freed as soon as it completes.
+        """
+        live = self.return_statement.reads()
+        dead = []
+        for statement in reversed(self.statements):
+            reads = statement.reads()
+            dead.append(sorted((reads | set(statement.assignments)) - live))
+            live = (live - set(statement.assignments)) | reads
+        return dead[::-1]
+
+    def reads(self) -> set[str]:
+        """The variables read before the program assigns them: its inputs."""
+        live = self.return_statement.reads()
+        for statement in reversed(self.statements):
+            live = (live - set(statement.assignments)) | statement.reads()
+        return live
+
+    def evaluate(
+        self,
+        run_state,
+        checkpoint: "planning_agent_demo.ast.checkpoint.Checkpoint | None" = None,
+        *,
+        free_dead: bool = False,
+    ):
+        """Run the program, leaving its result in `run_state.result`.
+
+        With a `checkpoint`, the statements it has already completed are skipped (the run state
+        must hold the variables they assigned), and each statement is recorded as it completes.
+        With `free_dead`, each variable is deleted from the run state once nothing reads it anymore.
+        """
+        context = current_context()
+        dead = self.dead_variables() if free_dead else None
         try:
-            for statement in self.statements:
-                statement.execute(run_state)
-                if run_state.result is not None:
-                    return
+            for index, statement in enumerate(self.statements):
+                if checkpoint is None or index >= checkpoint.completed:
+                    if context is not None:
+                        context.check()
+                    statement.execute(run_state)
+                    if checkpoint is not None:
+                        checkpoint.record(index, statement, run_state)
+                    if run_state.result is not None:
+                        return
+                if dead is not None:
+                    # Also for skipped statements, whose variables a restored run state may hold
+                    for name in dead[index]:
+                        if name in run_state.variables:
+                            del run_state.variables[name]
             self.return_statement.execute(run_state)
-        except Exception:
+        except Exception as e:
             message = traceback.format_exc()
+            if checkpoint is not None:
+                # Keep whatever completed before the failure, even if it isn't due a record yet
+                with contextlib.suppress(Exception):
+                    checkpoint.flush(run_state)
             from planning_agent_demo.ast.result import ResultError
 
-            run_state.result = ResultError(error=message)
+            match e:
+                case ExecutionTimeout():
+                    kind = "timeout"
+                case ExecutionCancelled():
+                    kind = "cancelled"
+                case _:
+                    kind = "error"
+            run_state.result = ResultError(error=message, kind=kind)
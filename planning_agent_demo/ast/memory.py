@@ -0,0 +1,125 @@
+"""Bound how much of a run's large intermediate data is held in memory at once.
+
+`SpillingScope` is a `Scope` with a memory budget for buffer values (`bytes`, `bytearray`,
+`memoryview`). Once the buffers it holds would go over budget, each further large buffer assigned to
+it is written to an anonymous temporary file instead, and mapped back into memory read-only. Reading
+the variable gives a `memoryview` of the mapping, so the value is paged in by the OS as it's used
+rather than copied, and its pages can be dropped again under memory pressure.
+
+Callables declaring a buffer parameter as `Buffer` rather than `bytes` are handed such views as they
+are, even when their inputs are validated; a plain `bytes` parameter gets a copy when validated.
+"""
+
+import mmap
+import os
+import tempfile
+from collections.abc import Mapping
+from typing import Annotated, Any
+
+from pydantic import WrapValidator
+
+from planning_agent_demo.ast.scope import Scope
+
+
+def _keep_views(value, handler):
+    return value if isinstance(value, memoryview) else handler(value)
+
+
+keep_views = WrapValidator(_keep_views)
+
+# `bytes` that also takes a `memoryview` as is, without copying it
+Buffer = Annotated[bytes, keep_views]
+
+
+class _Spilled:
+    def __init__(self, value, directory: str | None):
+        with tempfile.TemporaryFile(dir=directory) as f:
+            f.write(value)
+            f.flush()
+            # The mapping keeps the (already unlinked) file alive until the last view of it goes
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def buffer_size(value: Any) -> int | None:
+    """The size in bytes of a buffer value, or `None` for anything else."""
+    if isinstance(value, bytes | bytearray):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    return None
+
+
+def is_spilled(value: Any) -> bool:
+    """Whether `value` is a view of a spilled buffer."""
+    return isinstance(value, memoryview) and isinstance(value.obj, mmap.mmap)
+
+
+def materialize(value: Any) -> Any:
+    """Copy spilled buffers (in `value`, or in the lists and dicts it holds) back into `bytes`."""
+    match value:
+        case memoryview() if is_spilled(value):
+            return value.tobytes()
+        case dict():
+            return {key: materialize(item) for key, item in value.items()}
+        case list():
+            return [materialize(item) for item in value]
+    return value
+
+
+class SpillingScope(Scope):
+    def __init__(
+        self,
+        parent: Mapping[str, Any] | None = None,
+        budget: int = 256 << 20,
+        *,
+        min_spill_bytes: int = 64 << 10,
+        directory: str | os.PathLike | None = None,
+        zero_copy: bool = True,
+    ):
+        """A scope keeping at most `budget` bytes of buffers in memory, spilling the rest to disk.
+
+        Buffers smaller than `min_spill_bytes` are always kept in memory (and count towards the
+        budget). Spill files go in `directory`, the system's temporary directory by default. Spilled
+        values read back as read-only `memoryview`s; without `zero_copy`, they read back as fresh
+        `bytes`, for callables that validate their inputs as such.
+        """
+        super().__init__(parent)
+        self.budget = budget
+        self.min_spill_bytes = max(1, min_spill_bytes)
+        self.directory = None if directory is None else os.fspath(directory)
+        self.zero_copy = zero_copy
+        self._resident: dict[str, int] = {}
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        self.spilled_bytes = 0
+        self.spills = 0
+
+    def __getitem__(self, key: str) -> Any:
+        value = super().__getitem__(key)
+        if isinstance(value, _Spilled):
+            return memoryview(value.map) if self.zero_copy else value.map[:]
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._forget(key)
+        size = buffer_size(value)
+        if (
+            size is not None
+            and size >= self.min_spill_bytes
+            and self.resident_bytes + size > self.budget
+        ):
+            value = _Spilled(value, self.directory)
+            self.spilled_bytes += size
+            self.spills += 1
+        elif size is not None:
+            self._resident[key] = size
+            self.resident_bytes += size
+            self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self._forget(key)
+
+    def _forget(self, key: str):
+        self.resident_bytes -= self._resident.pop(key, 0)
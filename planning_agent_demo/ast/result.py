@@ -11,3 +11,8 @@ class ResultOk(BaseModel):
 class ResultError(BaseModel):
     result_type: Literal["error"] = Field("error", frozen=True)
     error: str = Field(..., description="The error message")
+    kind: Literal["error", "timeout", "cancelled"] = Field(
+        "error",
+        description="`timeout` if the run hit its deadline or a timeout, `cancelled` if it was "
+        "cancelled, e.g. because sibling work failed",
+    )
@@ -1,6 +1,7 @@
-from typing import Any
+from collections.abc import MutableMapping
+from typing import Annotated, Any
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, InstanceOf, PlainSerializer
 
 import planning_agent_demo.callables.base
 from planning_agent_demo.ast.result import ResultError, ResultOk
@@ -12,10 +13,17 @@ class RunState(BaseModel):
         description="The callable functions",
     )
 
-    variables: dict[str, Any] = Field(
-        default_factory=dict, description="The current state of the variables"
-    )
+    # Any mapping is kept as-is rather than copied into a new dict, so a `Scope` can be used to share
+    # another scope's values by reference
+    variables: Annotated[
+        InstanceOf[MutableMapping], PlainSerializer(dict, return_type=dict[str, Any])
+    ] = Field(default_factory=dict, description="The current state of the variables")
     result: ResultOk | ResultError | None = None
+    trusted: bool = Field(
+        False,
+        description="Whether the program being run was statically verified, allowing callables to skip "
+        "re-validating the values passed between statements",
+    )
 
     @property
     def callables(self):
@@ -0,0 +1,77 @@
+from collections.abc import Iterator, Mapping, MutableMapping
+from typing import Any
+
+from pydantic import BaseModel
+
+# Marks a name deleted in a scope, hiding the parent's value without touching the parent
+_DELETED = object()
+
+
+class ModelView(Mapping[str, Any]):
+    """A read-only mapping over a model's field values, without copying them out of the model."""
+
+    def __init__(self, model: BaseModel):
+        self._model = model
+        self._names = list(type(model).model_fields) + list(model.model_extra or {})
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._names:
+            raise KeyError(key)
+        return getattr(self._model, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+class Scope(MutableMapping[str, Any]):
+    """A copy-on-write variable environment layered over a parent mapping.
+
+    Reads fall through to the parent, while writes and deletes only ever change this scope, so a
+    child execution can see all of its parent's values by reference without copying any of them,
+    and without any risk of changing them. Values themselves are shared, not copied.
+    """
+
+    def __init__(self, parent: Mapping[str, Any] | None = None, **values: Any):
+        self.parent = parent if parent is not None else {}
+        self.local: dict[str, Any] = dict(values)
+
+    def child(self, **values: Any) -> "Scope":
+        return Scope(self, **values)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.local:
+            value = self.local[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self.parent[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.local[key] = value
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.local[key] = _DELETED
+
+    def __contains__(self, key) -> bool:
+        if key in self.local:
+            return self.local[key] is not _DELETED
+        return key in self.parent
+
+    def __iter__(self) -> Iterator[str]:
+        for key, value in self.local.items():
+            if value is not _DELETED:
+                yield key
+        for key in self.parent:
+            if key not in self.local:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"Scope({dict(self)!r})"
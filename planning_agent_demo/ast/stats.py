@@ -0,0 +1,93 @@
+import threading
+
+import planning_agent_demo
+
+
+class CallableLatencyStats:
+    """Running latency statistics for each callable, keyed by name, collected as programs run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: dict[str, int] = {}
+        self._totals: dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._totals[name] = self._totals.get(name, 0.0) + seconds
+
+    def mean(self, name: str) -> float | None:
+        with self._lock:
+            if name not in self._counts:
+                return None
+            return self._totals[name] / self._counts[name]
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                name: dict(count=count, mean_seconds=self._totals[name] / count)
+                for name, count in self._counts.items()
+            }
+
+    def estimate(self, program: "planning_agent_demo.ast.expression.Program") -> float:
+        """Estimate the cost of running `program` once, in seconds, from the recorded latencies.
+
+        Callables with no recorded runs are assumed to cost the average of the ones that have,
+        or one second if nothing has been recorded yet.
+        """
+        snapshot = self.snapshot()
+        means = [stats["mean_seconds"] for stats in snapshot.values()]
+        default = sum(means) / len(means) if means else 1.0
+        return sum(
+            snapshot[name]["mean_seconds"] if name in snapshot else default
+            for name in invoked_callables(program)
+        )
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._totals.clear()
+
+
+def invoked_callables(program: "planning_agent_demo.ast.expression.Program") -> list[str]:
+    """The name of every callable invocation in `program`, once per call site."""
+    names = []
+    for statement in program.statements:
+        _collect_invocations(statement.rhs_expression, names)
+    for value in program.return_statement.return_values.values():
+        _collect_invocations(value, names)
+    return names
+
+
+def _collect_invocations(expression, names: list[str]):
+    # Imported here since the expressions themselves record into `callable_latency`
+    from planning_agent_demo.ast.expression import (
+        CallableInvocation,
+        LiteralExpr,
+        MapExpr,
+        RecordExpr,
+        VariableExpr,
+    )
+
+    match expression:
+        case VariableExpr() | LiteralExpr():
+            pass
+        case CallableInvocation(name=name, arguments=arguments):
+            names.append(name)
+            for value in arguments.values():
+                _collect_invocations(value, names)
+        case RecordExpr(values=values):
+            for value in values.values():
+                _collect_invocations(value, names)
+        case MapExpr(name=name, collection=collection, arguments=arguments):
+            # Counted once; how many items there will be isn't known until run time
+            names.append(name)
+            _collect_invocations(collection, names)
+            for value in arguments.values():
+                _collect_invocations(value, names)
+        case _:
+            raise TypeError(f"Unknown expression type {type(expression).__name__}")
+
+
+# Shared by every program run in this process
+callable_latency = CallableLatencyStats()
@@ -1,10 +1,11 @@
 import typing
 from typing import Any, Literal
 
-from pydantic import BaseModel, ConfigDict, Field, create_model
+from pydantic import BaseModel, ConfigDict, Field, InstanceOf, create_model
 
 from planning_agent_demo.ast.expression import CallableInvocation
 from planning_agent_demo.ast.dtype import BaseDtype
+from planning_agent_demo.ast.memory import Buffer
 from planning_agent_demo.ast.variable import PlaceholderDefinition
 
 
@@ -56,9 +57,20 @@ class PlaceholderDict(BaseModel):
             else:
                 return tp
 
+        def _annotation(placeholder: PlaceholderDefinition):
+            tp = _as_type(placeholder.dtype)
+            if placeholder.by_reference:
+                # An isinstance check passes the value through as-is, where validating a container
+                # would build a copy of it
+                return InstanceOf[typing.get_origin(tp) or tp]
+            if tp is bytes:
+                # So that views of spilled buffers are passed into nested agents without a copy
+                return Buffer
+            return tp
+
         fields = {
             name: (
-                _as_type(placeholder.dtype),
+                _annotation(placeholder),
                 Field(..., description=placeholder.description or ""),
             )
             for name, placeholder in self.placeholders.items()
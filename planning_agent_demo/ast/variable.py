@@ -1,6 +1,6 @@
 from typing import Any
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from planning_agent_demo.ast.dtype import BaseDtype
 
@@ -18,3 +18,8 @@ class RuntimeVariable(BaseModel):
 
 class PlaceholderDefinition(VariableDefinition):
     description: str
+    by_reference: bool = Field(
+        False,
+        description="Only check the value's type when it is passed in or out, rather than validating "
+        "(and so copying) its contents; for large values like long lists, documents, or arrays",
+    )
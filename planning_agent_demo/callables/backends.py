@@ -0,0 +1,444 @@
+import collections
+import functools
+import hashlib
+import json
+import threading
+import time
+import types
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from functools import cache
+from typing import Annotated, Any, Literal, Union, get_args, get_origin
+
+import httpx
+from pydantic import BaseModel, Field, PlainValidator, SerializeAsAny, TypeAdapter
+
+from planning_agent_demo.ast.deadline import (
+    ExecutionCancelled,
+    ExecutionTimeout,
+    current_context,
+)
+from planning_agent_demo.callables.planning import estimate_tokens
+
+# DEFAULT_MODEL = "llama3.2"
+DEFAULT_MODEL = "deepseek-r1"
+
+# The LLM calls made while planning; each one can be sent to a different backend
+PlanningStageName = Literal["overview", "rough_plan", "formal_step", "return", "program"]
+
+
+@cache
+def llm(temperature: float = 0.0, model: str = DEFAULT_MODEL, base_url: str | None = None):
+    # Imported here so the fake backend works without Ollama's client installed
+    from langchain_ollama import ChatOllama
+
+    return ChatOllama(model=model, base_url=base_url, verbose=True, temperature=temperature)
+
+
+@functools.lru_cache(maxsize=1024)
+def type_adapter(tp) -> TypeAdapter:
+    """A (cached) adapter for validating against `tp`, which may be a union rather than a model."""
+    return TypeAdapter(tp)
+
+
+@functools.lru_cache(maxsize=1024)
+def is_instance_of(cls: type, tp) -> bool:
+    """Whether instances of `cls` are already valid instances of `tp` (a model, or a possibly
+    annotated union of models), so they can be used as they are without converting them.
+
+    That's so for subclasses that add nothing and don't change any field's type; subclasses that
+    narrow a field's type may also have changed what its values are, e.g. dicts into models.
+    """
+    if get_origin(tp) is Annotated:
+        return is_instance_of(cls, get_args(tp)[0])
+    if get_origin(tp) in (Union, types.UnionType):
+        return any(is_instance_of(cls, arg) for arg in get_args(tp))
+    return (
+        isinstance(tp, type)
+        and issubclass(cls, tp)
+        and issubclass(tp, BaseModel)
+        and cls.model_fields.keys() == tp.model_fields.keys()
+        and all(
+            field.annotation == tp.model_fields[name].annotation
+            for name, field in cls.model_fields.items()
+        )
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def schema_fingerprint(tp) -> str:
+    """A digest of the JSON schema the model is asked to fill in for `tp`.
+
+    Models built separately but with the same name and fields, like the per-agent step models built
+    while planning, have the same fingerprint.
+    """
+    schema = type_adapter(tp).json_schema()
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=1024)
+def schema_size(tp) -> int:
+    """The size in bytes of the JSON schema for `tp`, roughly what it adds to every prompt."""
+    return len(json.dumps(type_adapter(tp).json_schema()).encode())
+
+
+class TokenUsage(BaseModel):
+    input_tokens: int | None = Field(None, description="Prompt tokens the model processed")
+    output_tokens: int | None = Field(None, description="Completion tokens the model generated")
+
+
+class StructuredRunnableCache:
+    """Structured-output runnables, keyed by backend settings, temperature, and schema fingerprint.
+
+    Preparing a runnable converts the schema into a tool definition and builds a parsing chain,
+    which costs about as much every time, so each one is built once and reused. A runnable parses
+    into the model it was built for, which may only be an identical copy of the one asked for.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._runnables: collections.OrderedDict[tuple, Any] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, backend: "OllamaBackend", generate_model: type, temperature: float) -> Any:
+        key = (backend.model, backend.base_url, temperature, schema_fingerprint(generate_model))
+        with self._lock:
+            if key in self._runnables:
+                self._runnables.move_to_end(key)
+                self.hits += 1
+                return self._runnables[key]
+            self.misses += 1
+        # With the raw message too, for its token counts
+        runnable = llm(temperature, backend.model, backend.base_url).with_structured_output(
+            generate_model, include_raw=True
+        )
+        with self._lock:
+            self._runnables[key] = runnable
+            if len(self._runnables) > self.maxsize:
+                self._runnables.popitem(last=False)
+        return runnable
+
+    def clear(self):
+        with self._lock:
+            self._runnables.clear()
+            self.hits = self.misses = 0
+
+
+structured_runnables = StructuredRunnableCache()
+
+# Every backend class, by `backend_type`
+_backend_types: dict[str, type["BaseBackend"]] = {}
+
+
+class BaseBackend(BaseModel):
+    """A model to plan with.
+
+    Subclasses give `backend_type` a unique literal default, by which they are registered, so
+    that any backend can be loaded back from its serialized settings, e.g. from an agent archive
+    (as long as the module defining it has been imported).
+    """
+
+    backend_type: str
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        backend_type = cls.model_fields["backend_type"].default
+        if isinstance(backend_type, str):
+            _backend_types[backend_type] = cls
+
+    def structured_call(
+        self,
+        generate_model: type,
+        messages: list[tuple[str, str]],
+        *,
+        stage: str,
+        temperature: float,
+    ) -> tuple[BaseModel, TokenUsage | None]:
+        """Generate an instance of `generate_model` (a model, or a union of models) from `messages`.
+
+        Also returns the call's token usage, if the backend knows it.
+        """
+        raise NotImplementedError()
+
+    def prepare(self, generate_model: type, *, temperature: float):
+        """Do any per-schema setup for `generate_model` ahead of the first call that uses it."""
+
+
+class OllamaBackend(BaseBackend):
+    backend_type: Literal["ollama"] = Field("ollama", frozen=True)
+    model: str = DEFAULT_MODEL
+    base_url: str | None = Field(
+        None, description="The Ollama server to use; the local one if unset"
+    )
+
+    def structured_call(self, generate_model, messages, *, stage, temperature):
+        response = structured_runnables.get(self, generate_model, temperature).invoke(messages)
+        if response["parsing_error"] is not None:
+            raise response["parsing_error"]
+        if response["parsed"] is None:
+            raise ValueError("The model didn't generate any structured output")
+        usage = getattr(response["raw"], "usage_metadata", None) or {}
+        return response["parsed"], TokenUsage(
+            input_tokens=usage.get("input_tokens"), output_tokens=usage.get("output_tokens")
+        )
+
+    def prepare(self, generate_model, *, temperature):
+        structured_runnables.get(self, generate_model, temperature)
+
+
+class FakeBackend(BaseBackend):
+    """Replays scripted responses, with no model involved; for tests and benchmarks.
+
+    Each stage's responses are returned in order, starting over once they run out, regardless of
+    the messages sent. Responses are validated against the requested schema just like a real
+    model's would be, so a script that doesn't fit the schema fails the same way.
+    """
+
+    backend_type: Literal["fake"] = Field("fake", frozen=True)
+    responses: dict[PlanningStageName, list[dict[str, Any]]] = Field(
+        ..., description="The responses to give at each planning stage, in order"
+    )
+    delays: dict[PlanningStageName, list[float]] = Field(
+        default_factory=dict,
+        description="Seconds to wait before each response at each stage, in order, to simulate a "
+        "model's latency",
+    )
+
+    _calls: dict[str, int] | None = None
+    _lock: "threading.Lock | None" = None
+
+    def model_post_init(self, context: Any):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def structured_call(self, generate_model, messages, *, stage, temperature):
+        if not self.responses.get(stage):
+            raise LookupError(f"The fake backend has no responses for the `{stage}` stage")
+        with self._lock:
+            call = self._calls.get(stage, 0)
+            self._calls[stage] = call + 1
+        if delays := self.delays.get(stage):
+            time.sleep(delays[call % len(delays)])
+        response = self.responses[stage][call % len(self.responses[stage])]
+        # Estimated like a real model's counts would be reported, for profiling without one
+        usage = TokenUsage(
+            input_tokens=sum(estimate_tokens(str(content)) for _, content in messages),
+            output_tokens=estimate_tokens(json.dumps(response, default=str)),
+        )
+        return type_adapter(generate_model).validate_python(response), usage
+
+
+def _validate_backend(value: Any) -> BaseBackend:
+    if isinstance(value, BaseBackend):
+        return value
+    if isinstance(value, dict):
+        backend_type = value.get("backend_type")
+        if backend_type not in _backend_types:
+            raise ValueError(f"Unknown backend type {backend_type!r}")
+        return _backend_types[backend_type].model_validate(value)
+    raise ValueError(f"Expected a backend, got {type(value).__name__}")
+
+
+# Any backend instance, or the settings of a registered backend type
+Backend = Annotated[SerializeAsAny[BaseBackend], PlainValidator(_validate_backend)]
+
+
+class RetryPolicy(BaseModel):
+    """Retry failed LLM calls (malformed output, or transport errors) with exponential backoff."""
+
+    max_attempts: int = Field(3, ge=1, description="Attempts in total, including the first")
+    initial_backoff: float = Field(0.5, ge=0, description="Seconds to wait before the first retry")
+    backoff_multiplier: float = Field(2.0, ge=1)
+    max_backoff: float = Field(8.0, ge=0)
+
+    def backoff(self, retry: int) -> float:
+        return min(self.max_backoff, self.initial_backoff * self.backoff_multiplier**retry)
+
+
+class HedgePolicy(BaseModel):
+    """Send a duplicate LLM call when the first is slow, and take whichever valid response is first.
+
+    The hedge is sent once a call has taken longer than the given percentile of that stage's recent
+    latencies, so only the slowest calls are duplicated and the median is unaffected.
+    """
+
+    percentile: float = Field(0.95, gt=0, lt=1)
+    min_samples: int = Field(
+        20, ge=1, description="Don't hedge a stage until this many of its latencies are known"
+    )
+    delay: float | None = Field(
+        None, ge=0, description="Hedge after this many seconds instead of a percentile"
+    )
+    max_hedges: int = Field(1, ge=1, description="How many duplicates one call can have at most")
+
+
+class PlanningBackends(BaseModel):
+    """Which backend to use for each planning stage, e.g. a small fast model for the overview."""
+
+    default: Backend = Field(default_factory=OllamaBackend)
+    stages: dict[PlanningStageName, Backend] = Field(
+        default_factory=dict, description="Backends to use instead of the default, by stage"
+    )
+    retry: RetryPolicy = Field(default_factory=RetryPolicy)
+    hedge: HedgePolicy | None = Field(None, description="Hedge slow calls; off if unset")
+
+    def for_stage(self, stage: PlanningStageName) -> BaseBackend:
+        return self.stages.get(stage, self.default)
+
+    def prepare(self, models: dict[PlanningStageName, type], temperatures: list[float]):
+        """Prepare each stage's backend for the given model at each temperature."""
+        for stage, generate_model in models.items():
+            for temperature in temperatures:
+                self.for_stage(stage).prepare(generate_model, temperature=temperature)
+
+
+class LLMCallStats:
+    """Counters and recent latencies of planning LLM calls, by stage."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._latencies: dict[str, collections.deque] = {}
+        self._counters: dict[str, collections.Counter] = {}
+
+    def record_latency(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self._latencies:
+                self._latencies[stage] = collections.deque(maxlen=self._window)
+            self._latencies[stage].append(seconds)
+
+    def count(self, stage: str, counter: str):
+        with self._lock:
+            self._counters.setdefault(stage, collections.Counter())[counter] += 1
+
+    def percentile(self, stage: str, q: float, min_samples: int = 1) -> float | None:
+        with self._lock:
+            latencies = sorted(self._latencies.get(stage, ()))
+        if len(latencies) < min_samples or not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            stages = set(self._latencies) | set(self._counters)
+            counters = {stage: dict(self._counters.get(stage, {})) for stage in stages}
+        snapshot = {}
+        for stage in stages:
+            stats = dict.fromkeys(
+                ["calls", "attempts", "retries", "failures", "hedges", "hedge_wins"], 0
+            )
+            stats.update(counters[stage])
+            stats["hedge_win_rate"] = (
+                stats["hedge_wins"] / stats["hedges"] if stats["hedges"] else 0.0
+            )
+            stats["p50_seconds"] = self.percentile(stage, 0.50)
+            stats["p99_seconds"] = self.percentile(stage, 0.99)
+            snapshot[stage] = stats
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self._counters.clear()
+
+
+# Shared by every planning call in this process
+llm_call_stats = LLMCallStats()
+
+# Errors that a fresh attempt might not hit: malformed or invalid output (validation errors and
+# output parser errors are both ValueErrors), and network trouble talking to the model server
+RETRYABLE_ERRORS = (ValueError, ConnectionError, httpx.TransportError)
+
+
+def reliable_call(
+    attempt: Callable[[], Any],
+    *,
+    stage: str,
+    retry: RetryPolicy | None = None,
+    hedge: HedgePolicy | None = None,
+) -> Any:
+    """Call `attempt`, hedging slow attempts and retrying failed ones according to the policies."""
+    llm_call_stats.count(stage, "calls")
+    max_attempts = retry.max_attempts if retry is not None else 1
+    for attempt_number in range(max_attempts):
+        try:
+            return _hedged(attempt, stage=stage, hedge=hedge)
+        except (ExecutionTimeout, ExecutionCancelled):
+            raise
+        except RETRYABLE_ERRORS as e:
+            if attempt_number + 1 >= max_attempts:
+                llm_call_stats.count(stage, "failures")
+                raise
+            backoff = retry.backoff(attempt_number)
+            print(f"Planning stage `{stage}` failed ({e!r}), retrying in {backoff:.2f}s")
+            llm_call_stats.count(stage, "retries")
+            context = current_context()
+            if context is not None and (remaining := context.remaining()) is not None:
+                if remaining <= backoff:
+                    raise
+            time.sleep(backoff)
+        except Exception:
+            llm_call_stats.count(stage, "failures")
+            raise
+
+
+def _timed(attempt: Callable[[], Any], stage: str) -> Any:
+    llm_call_stats.count(stage, "attempts")
+    start = time.perf_counter()
+    result = attempt()
+    llm_call_stats.record_latency(stage, time.perf_counter() - start)
+    return result
+
+
+def _spawn(fn: Callable[[], Any]) -> Future:
+    # A daemon thread per call, so an attempt that hangs never holds up a pool or interpreter exit
+    future = Future()
+    context = current_context()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn() if context is None else context.call_in(fn)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    threading.Thread(target=target, daemon=True, name="planning-hedge").start()
+    return future
+
+
+def _hedged(attempt: Callable[[], Any], *, stage: str, hedge: HedgePolicy | None) -> Any:
+    delay = None
+    if hedge is not None:
+        delay = hedge.delay
+        if delay is None:
+            delay = llm_call_stats.percentile(stage, hedge.percentile, hedge.min_samples)
+    if delay is None:
+        return _timed(attempt, stage)
+
+    primary = _spawn(lambda: _timed(attempt, stage))
+    pending = [primary]
+    hedges = 0
+    error = None
+    while pending:
+        can_hedge = hedges < hedge.max_hedges
+        done, _ = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+        if not done:
+            hedges += 1
+            llm_call_stats.count(stage, "hedges")
+            pending.append(_spawn(lambda: _timed(attempt, stage)))
+            continue
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    llm_call_stats.count(stage, "hedge_wins")
+                return future.result()
+            error = future.exception()
+        # Any attempts still running may yet succeed
+        pending = [future for future in pending if future not in done]
+    raise error
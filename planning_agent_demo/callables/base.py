@@ -1,7 +1,7 @@
 import abc
 import shelve
 import uuid
-from typing import ClassVar, Self
+from typing import Any, ClassVar, Self
 
 from pydantic import BaseModel, Field
 
@@ -78,6 +78,21 @@ class BaseCallable[I: BaseModel, O: BaseModel](BaseModel, abc.ABC):
     def execute(self, arguments: I) -> O:
         raise NotImplementedError()
 
+    def execute_trusted(self, arguments: I) -> dict[str, Any]:
+        """Execute with arguments already known to match `inputs_type`, returning the raw result values.
+
+        Used along the edges of a statically verified program, where validating the inputs again and
+        dumping the outputs to a fresh dict is redundant. Subclasses can override this with a cheaper path.
+        """
+        return dict(self.execute(arguments))
+
+
+def unwrap_callable(fn: BaseCallable) -> BaseCallable:
+    """The callable inside any wrappers (like `ConcurrencyLimitedCallable`) around `fn`."""
+    while isinstance(getattr(fn, "inner", None), BaseCallable):
+        fn = fn.inner
+    return fn
+
 
 class SimpleCallable[I: BaseCallableInputs, O: BaseCallableOutputs](BaseCallable[I, O], abc.ABC):
     __register_callable__: ClassVar[bool] = False
@@ -110,6 +125,13 @@ class SimpleCallable[I: BaseCallableInputs, O: BaseCallableOutputs](BaseCallable
     def result_type(self) -> type[BaseCallableOutputs]:
         return self.outputs
 
+    def execute_trusted(self, arguments: I) -> dict[str, Any]:
+        # Skip any `@validate_call` wrapper around `execute`, since the arguments are already trusted
+        raw_execute = getattr(type(self).execute, "raw_function", None)
+        if raw_execute is None:
+            return super().execute_trusted(arguments)
+        return dict(raw_execute(self, arguments))
+
 
 class BaseStatefulCallable(BaseCallable, abc.ABC):
     __register_callable__: ClassVar[bool] = False
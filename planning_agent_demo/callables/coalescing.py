@@ -0,0 +1,226 @@
+"""Coalesce concurrent identical invocations of a callable into a single execution.
+
+A result cache only helps once the first call has finished; under bursty load, every identical call
+that arrives while it is still running would repeat the work. `CoalescingCallable` keys each call by
+the callable's name and a canonical hash of its arguments, and callers that arrive while a call with
+the same key is running wait for it and share its result instead.
+"""
+
+import decimal
+import hashlib
+import math
+import struct
+import threading
+from enum import Enum
+from typing import Any
+
+from pydantic import BaseModel
+
+from planning_agent_demo.ast.callable import CallableDefinition
+from planning_agent_demo.ast.deadline import ExecutionCancelled, ExecutionTimeout, current_context
+from planning_agent_demo.ast.expression import CallableInvocation
+from planning_agent_demo.callables.base import BaseCallable
+from planning_agent_demo.callables.single_flight import SingleFlight
+
+
+class CoalescingStats:
+    """How often calls to each callable, keyed by name, were served by another caller's execution."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, int] = {}
+        self._coalesced: dict[str, int] = {}
+        self._unkeyed: dict[str, int] = {}
+        self._in_flight: dict[str, int] = {}
+
+    def enter(self, name: str):
+        with self._lock:
+            self._in_flight[name] = self._in_flight.get(name, 0) + 1
+            for counts in (self._calls, self._coalesced, self._unkeyed):
+                counts.setdefault(name, 0)
+
+    def exit(self, name: str, *, coalesced: bool, keyed: bool = True):
+        with self._lock:
+            self._in_flight[name] -= 1
+            self._calls[name] += 1
+            self._coalesced[name] += coalesced
+            self._unkeyed[name] += not keyed
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                name: dict(
+                    calls=calls,
+                    executions=calls - self._coalesced[name],
+                    coalesced=self._coalesced[name],
+                    # Calls whose arguments couldn't be hashed, and so always ran on their own
+                    unkeyed=self._unkeyed[name],
+                    in_flight=self._in_flight[name],
+                    coalescing_ratio=self._coalesced[name] / calls if calls else 0.0,
+                )
+                for name, calls in self._calls.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._coalesced.clear()
+            self._unkeyed.clear()
+            # Calls still running when reset are counted afresh as they finish
+            for name in self._in_flight:
+                self._calls[name] = self._coalesced[name] = self._unkeyed[name] = 0
+
+
+class _Unhashable(Exception):
+    pass
+
+
+_LENGTH = struct.Struct("<Q")
+
+
+def argument_key(arguments: Any) -> str | None:
+    """A canonical hash of `arguments`, equal for equal arguments however they were built.
+
+    Mappings hash the same whatever their key order, and values are tagged with their type, so
+    that `1`, `1.0` and `True` are told apart. Returns `None` for arguments holding anything that
+    can't be hashed canonically, which are then never coalesced.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        _update(digest, arguments)
+    except _Unhashable:
+        return None
+    return digest.hexdigest()
+
+
+def _update(digest, value: Any):
+    match value:
+        case None:
+            digest.update(b"N")
+        case bool():
+            digest.update(b"T" if value else b"F")
+        case Enum():
+            _tagged(digest, b"E", f"{type(value).__qualname__}.{value.name}".encode())
+        case decimal.Decimal():
+            if value.is_nan():
+                raise _Unhashable()
+            # Normalized, so that equal decimals (`1`, `1.0`, `1E+0`) hash the same
+            _tagged(digest, b"d", str(value.normalize()).encode())
+        case int():
+            _tagged(digest, b"i", str(value).encode())
+        case float():
+            if math.isnan(value):
+                # NaN never equals itself, so neither should its calls
+                raise _Unhashable()
+            _tagged(digest, b"f", value.hex().encode())
+        case str():
+            _tagged(digest, b"s", value.encode("utf-8", "surrogatepass"))
+        case bytes() | bytearray():
+            _tagged(digest, b"b", value)
+        case memoryview():
+            # Hashed in place where possible, since it may be a view of a large spilled buffer
+            _tagged(digest, b"b", value.cast("B") if value.c_contiguous else value.tobytes())
+        case BaseModel():
+            _tagged(digest, b"M", type(value).__qualname__.encode())
+            # Extras included, in field order then insertion order, which `_mapping` sorts anyway
+            _mapping(digest, dict(value))
+        case dict():
+            _mapping(digest, value)
+        case list() | tuple():
+            digest.update(b"L" + _LENGTH.pack(len(value)))
+            for item in value:
+                _update(digest, item)
+        case set() | frozenset():
+            digest.update(b"S" + _LENGTH.pack(len(value)))
+            for item in sorted(_hash_each(item) for item in value):
+                digest.update(item)
+        case _:
+            raise _Unhashable()
+
+
+def _tagged(digest, tag: bytes, data):
+    digest.update(tag + _LENGTH.pack(len(data)))
+    digest.update(data)
+
+
+def _hash_each(value: Any) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    _update(digest, value)
+    return digest.digest()
+
+
+def _mapping(digest, value: dict):
+    digest.update(b"D" + _LENGTH.pack(len(value)))
+    # Sorted by the hash of each key, so insertion order doesn't matter and keys needn't be orderable
+    items = sorted(((_hash_each(key), item) for key, item in value.items()), key=lambda kv: kv[0])
+    for key_hash, item in items:
+        digest.update(key_hash)
+        _update(digest, item)
+
+
+# Shared by every coalescing callable in this process
+coalescing_stats = CoalescingStats()
+
+_flights = SingleFlight()
+
+
+class CoalescingCallable(BaseCallable):
+    """Wraps another callable, sharing one execution among concurrent calls with equal arguments.
+
+    Every caller gets its own shallow copy of the shared result. A caller whose execution runs out
+    of time or is cancelled doesn't pass that on to the callers waiting on it: they run the call
+    themselves instead. The wrapper is transparent to programs: it reports the wrapped callable's
+    definition, so it can stand in for it in any `callables` list.
+    """
+
+    inner: BaseCallable
+
+    @property
+    def definition(self) -> CallableDefinition:
+        return self.inner.definition
+
+    @property
+    def invocation_template(self) -> type[CallableInvocation]:
+        return self.inner.invocation_template
+
+    @property
+    def inputs_type(self) -> type[BaseModel]:
+        return self.inner.inputs_type
+
+    @property
+    def result_type(self) -> type[BaseModel]:
+        return self.inner.result_type
+
+    def execute(self, arguments: BaseModel) -> BaseModel:
+        result = self._coalesce(False, arguments, self.inner.execute)
+        return result.model_copy() if isinstance(result, BaseModel) else result
+
+    def execute_trusted(self, arguments: BaseModel) -> dict[str, Any]:
+        return dict(self._coalesce(True, arguments, self.inner.execute_trusted))
+
+    def _coalesce(self, trusted: bool, arguments: BaseModel, execute) -> Any:
+        name = self.definition.name
+        key = argument_key(arguments)
+        coalesced = True
+
+        def run():
+            nonlocal coalesced
+            coalesced = False
+            return execute(arguments)
+
+        coalescing_stats.enter(name)
+        try:
+            if key is None:
+                return run()
+            context = current_context()
+            return _flights.do(
+                # Keyed by the wrapped callable too, since different callables can share a name; and
+                # the two paths return results of different shapes, so never share between them
+                (name, id(self.inner), trusted, key),
+                run,
+                timeout=None if context is None else context.remaining(),
+                retry_on=(ExecutionTimeout, ExecutionCancelled),
+                what=f"`{name}`",
+            )
+        finally:
+            coalescing_stats.exit(name, coalesced=coalesced, keyed=key is not None)
@@ -0,0 +1,140 @@
+import itertools
+import re
+
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    LiteralExpr,
+    MapExpr,
+    Program,
+    RecordExpr,
+    VariableExpr,
+)
+from planning_agent_demo.callables.base import BaseCallable
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class _NotInlinable(Exception):
+    pass
+
+
+def inline_program(
+    program: Program, callables: list[BaseCallable]
+) -> tuple[Program, list[BaseCallable]]:
+    """Splice the programs of planned nested agents into `program`, recursively.
+
+    Each call to a `SelfProgrammer` that already has a program is replaced by that program's
+    statements, with the child's variables renamed so they cannot clash with the parent's, followed
+    by a record assignment that binds the child's return values to the parent's variables. The
+    result runs as one flat program, against the returned list of callables (the parent's plus
+    everything the inlined children call).
+
+    Inlined children skip their own input and output validation; the outermost agent still
+    validates its boundary. Calls are left alone when the child has no program yet, or when inlining
+    would make two different callables share a name.
+    """
+    counter = itertools.count()
+    flat_program, flat_callables = _inline(program, callables, counter)
+    return flat_program, list(flat_callables.values())
+
+
+def _inline(program: Program, callables: list[BaseCallable], counter) -> tuple[Program, dict]:
+    available = {fn.definition.name: fn for fn in callables}
+    flat_callables = dict(available)
+    statements = []
+    for statement in program.statements:
+        rhs = statement.rhs_expression
+        child = available.get(rhs.name) if isinstance(rhs, CallableInvocation) else None
+        if not isinstance(child, SelfProgrammer) or child.program is None:
+            statements.append(statement)
+            continue
+
+        child_program, child_callables = _inline(child.program, child.callables, counter)
+        if any(
+            name in flat_callables and flat_callables[name] is not fn
+            for name, fn in child_callables.items()
+        ):
+            statements.append(statement)
+            continue
+
+        try:
+            statements.extend(_splice(statement, child_program, prefix=_prefix(child, counter)))
+        except _NotInlinable:
+            statements.append(statement)
+            continue
+        flat_callables.update(child_callables)
+
+    return (
+        Program(statements=statements, return_statement=program.return_statement),
+        flat_callables,
+    )
+
+
+def _prefix(child: SelfProgrammer, counter) -> str:
+    name = re.sub(r"\W", "_", child.name)
+    return f"__{name}{next(counter)}_"
+
+
+def _splice(
+    statement: AssignmentStatement, child_program: Program, prefix: str
+) -> list[AssignmentStatement]:
+    # Maps each child variable name to the parent-scope expression that currently holds its value
+    scope = {}
+    statements = []
+    for name, value in statement.rhs_expression.arguments.items():
+        if isinstance(value, VariableExpr | LiteralExpr):
+            scope[name] = value
+        else:
+            # Evaluate anything more complex exactly once, like the call would have
+            scope[name] = VariableExpr(name=prefix + name)
+            statements.append(
+                AssignmentStatement(
+                    assignments={prefix + name: "value"},
+                    rhs_expression=RecordExpr(values=dict(value=value)),
+                )
+            )
+
+    for child_statement in child_program.statements:
+        rhs_expression = _rename(child_statement.rhs_expression, scope, prefix)
+        for name in child_statement.assignments:
+            scope[name] = VariableExpr(name=prefix + name)
+        statements.append(
+            AssignmentStatement(
+                assignments={prefix + k: v for k, v in child_statement.assignments.items()},
+                rhs_expression=rhs_expression,
+            )
+        )
+
+    returned = {
+        k: _rename(v, scope, prefix)
+        for k, v in child_program.return_statement.return_values.items()
+    }
+    statements.append(
+        AssignmentStatement(
+            assignments=statement.assignments, rhs_expression=RecordExpr(values=returned)
+        )
+    )
+    return statements
+
+
+def _rename(expression, scope, prefix):
+    match expression:
+        case VariableExpr(name=name):
+            return scope.get(name, VariableExpr(name=prefix + name))
+        case LiteralExpr():
+            return expression
+        case CallableInvocation(name=name, arguments=arguments):
+            return CallableInvocation(
+                name=name, arguments={k: _rename(v, scope, prefix) for k, v in arguments.items()}
+            )
+        case RecordExpr(values=values):
+            return RecordExpr(values={k: _rename(v, scope, prefix) for k, v in values.items()})
+        case MapExpr(collection=collection, arguments=arguments):
+            return expression.model_copy(
+                update=dict(
+                    collection=_rename(collection, scope, prefix),
+                    arguments={k: _rename(v, scope, prefix) for k, v in arguments.items()},
+                )
+            )
+        case _:
+            raise _NotInlinable(type(expression).__name__)
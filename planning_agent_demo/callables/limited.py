@@ -0,0 +1,48 @@
+import threading
+from typing import Any
+
+from pydantic import BaseModel, Field
+
+from planning_agent_demo.ast.callable import CallableDefinition
+from planning_agent_demo.ast.expression import CallableInvocation
+from planning_agent_demo.callables.base import BaseCallable
+
+
+class ConcurrencyLimitedCallable(BaseCallable):
+    """Wraps another callable, allowing at most `max_concurrency` executions of it at any one time.
+
+    Callers beyond the limit block until a slot frees up. The wrapper is transparent to programs:
+    it reports the wrapped callable's definition, so it can stand in for it in any `callables` list.
+    """
+
+    inner: BaseCallable
+    max_concurrency: int = Field(..., gt=0)
+
+    _semaphore: threading.BoundedSemaphore | None = None
+
+    def model_post_init(self, context: Any):
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+
+    @property
+    def definition(self) -> CallableDefinition:
+        return self.inner.definition
+
+    @property
+    def invocation_template(self) -> type[CallableInvocation]:
+        return self.inner.invocation_template
+
+    @property
+    def inputs_type(self) -> type[BaseModel]:
+        return self.inner.inputs_type
+
+    @property
+    def result_type(self) -> type[BaseModel]:
+        return self.inner.result_type
+
+    def execute(self, arguments: BaseModel) -> BaseModel:
+        with self._semaphore:
+            return self.inner.execute(arguments)
+
+    def execute_trusted(self, arguments: BaseModel) -> dict[str, Any]:
+        with self._semaphore:
+            return self.inner.execute_trusted(arguments)
@@ -0,0 +1,258 @@
+import collections
+import threading
+import time
+from typing import Any
+
+from pydantic import BaseModel, Field
+
+# A rough rule of thumb for English prose and code; good enough to compare stages against each other
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+class PlanningStage(BaseModel):
+    stage: str = Field(..., description="Which planning call this was, e.g. `overview` or `step_2`")
+    kind: str | None = Field(
+        None, description="The kind of planning call, e.g. `formal_step` for every step"
+    )
+    messages: int = Field(..., description="How many messages were sent")
+    history_chars: int = Field(..., description="Characters in the whole message history sent")
+    prompt_tokens: int = Field(..., description="Estimated tokens in the whole prompt")
+    shared_prefix_tokens: int = Field(
+        ...,
+        description="Estimated tokens at the start of the prompt that are identical to the previous "
+        "call's prompt, and so can be served from the model server's prompt cache",
+    )
+    schema_bytes: int | None = Field(
+        None, description="Size of the JSON schema of the type the model was asked to generate"
+    )
+    seconds: float | None = Field(
+        None, description="Wall time of the call, retries included; unset if it failed"
+    )
+    input_tokens: int | None = Field(
+        None, description="Prompt tokens processed, as reported by the model server"
+    )
+    output_tokens: int | None = Field(
+        None, description="Completion tokens generated, as reported by the model server"
+    )
+
+    @property
+    def spent_prompt_tokens(self) -> int:
+        # The reported count where there is one, since the estimate is rough
+        return self.input_tokens if self.input_tokens is not None else self.prompt_tokens
+
+
+class PlanningBudgetExceeded(RuntimeError):
+    pass
+
+
+class PlanningBudget(BaseModel):
+    """Limits on a single planning run, checked before each of its LLM calls.
+
+    Planning stops with `PlanningBudgetExceeded` as soon as a limit has been reached, rather than
+    carrying on and producing a plan that cost more than it was worth.
+    """
+
+    max_calls: int | None = Field(None, ge=1, description="LLM calls in total")
+    max_seconds: float | None = Field(None, gt=0, description="Wall time since planning started")
+    max_prompt_tokens: int | None = Field(None, ge=1, description="Prompt tokens across all calls")
+    max_completion_tokens: int | None = Field(
+        None, ge=1, description="Completion tokens across all calls"
+    )
+
+    def check(self, stages: list[PlanningStage], seconds: float):
+        spent = dict(
+            calls=(len(stages), self.max_calls),
+            seconds=(seconds, self.max_seconds),
+            prompt_tokens=(
+                sum(stage.spent_prompt_tokens for stage in stages),
+                self.max_prompt_tokens,
+            ),
+            completion_tokens=(
+                sum(stage.output_tokens or 0 for stage in stages),
+                self.max_completion_tokens,
+            ),
+        )
+        for name, (value, limit) in spent.items():
+            if limit is not None and value >= limit:
+                raise PlanningBudgetExceeded(
+                    f"Planning used {value:.4g} {name.replace('_', ' ')}, the budget is {limit}"
+                )
+
+
+class PlanningBudgetTracker:
+    """What one planning run has spent so far, across every context it plans with.
+
+    A run may plan more than once, e.g. falling back from single-shot to staged planning, or
+    generating several candidates at once, and its budget covers all of that together.
+    """
+
+    def __init__(self, budget: PlanningBudget | None = None):
+        self.budget = budget
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages: list[PlanningStage] = []
+
+    def add(self, stage: PlanningStage):
+        """Count `stage` against the budget, raising `PlanningBudgetExceeded` if it's used up."""
+        with self._lock:
+            if self.budget is not None:
+                self.budget.check(self.stages, time.perf_counter() - self._started)
+            self.stages.append(stage)
+
+
+class PlanningContext:
+    """The conversation that every planning stage builds on.
+
+    The shared prefix (instructions, tools, overview, outline) is only ever appended to, and each
+    call sends that prefix plus a small stage-specific suffix. The bytes a call shares with the
+    previous one therefore stay identical, so the model server can reuse its prompt cache, and the
+    prompt size per call stays bounded instead of growing with every step already written.
+    """
+
+    def __init__(
+        self,
+        messages: list[tuple[str, str]],
+        *,
+        agent: str | None = None,
+        budget: PlanningBudget | None = None,
+        tracker: PlanningBudgetTracker | None = None,
+    ):
+        """Start a planning run with the shared `messages`.
+
+        The stages of a run for a named `agent` are added to the `planning_profiler` as they
+        happen, and a `budget` is checked before each stage. Contexts sharing a `tracker` share its
+        budget instead.
+        """
+        self._prefix = list(messages)
+        self._previous_prompt: list[tuple[str, str]] = []
+        self.tracker = tracker if tracker is not None else PlanningBudgetTracker(budget)
+        self.stages: list[PlanningStage] = []
+        if agent is not None:
+            planning_profiler.record(agent, self.stages)
+
+    def extend(self, *messages: tuple[str, str]):
+        self._prefix.extend(messages)
+
+    def prompt(self, stage: str, *suffix: tuple[str, str]) -> list[tuple[str, str]]:
+        """The messages to send for `stage`; also records the stage's prompt size.
+
+        Raises `PlanningBudgetExceeded` if the run has used up its budget.
+        """
+        messages = self._prefix + list(suffix)
+
+        shared = 0
+        for previous, current in zip(self._previous_prompt, messages):
+            if previous != current:
+                break
+            shared += 1
+        self._previous_prompt = messages
+
+        recorded = PlanningStage(
+            stage=stage,
+            messages=len(messages),
+            history_chars=sum(len(content) for _, content in messages),
+            prompt_tokens=sum(estimate_tokens(content) for _, content in messages),
+            shared_prefix_tokens=sum(estimate_tokens(content) for _, content in messages[:shared]),
+        )
+        self.tracker.add(recorded)
+        self.stages.append(recorded)
+        return messages
+
+    @property
+    def latest(self) -> PlanningStage:
+        """The stage recorded by the last `prompt`, for the call made with its messages to fill in."""
+        return self.stages[-1]
+
+    @property
+    def total_prompt_tokens(self) -> int:
+        return sum(stage.prompt_tokens for stage in self.stages)
+
+    def report(self) -> str:
+        lines = []
+        for stage in self.stages:
+            line = (
+                f"- {stage.stage}: ~{stage.prompt_tokens} prompt tokens "
+                f"(~{stage.shared_prefix_tokens} shared with the previous call)"
+            )
+            if stage.seconds is not None:
+                line += f", {stage.seconds:.2f}s"
+            if stage.output_tokens is not None:
+                line += f", {stage.input_tokens} in / {stage.output_tokens} out"
+            if stage.schema_bytes is not None:
+                line += f", {stage.schema_bytes} byte schema"
+            lines.append(line)
+        lines.append(f"Total: ~{self.total_prompt_tokens} prompt tokens")
+        return "\n".join(lines)
+
+
+class PlanningProfiler:
+    """The stages of recent planning runs, by agent, for finding where planning time goes."""
+
+    def __init__(self, max_runs: int = 1000):
+        self._lock = threading.Lock()
+        self._runs: collections.deque[tuple[str, list[PlanningStage]]] = collections.deque(
+            maxlen=max_runs
+        )
+
+    def record(self, agent: str, stages: list[PlanningStage]):
+        # The list is kept, not copied, so stages show up as the run records them
+        with self._lock:
+            self._runs.append((agent, stages))
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        """Totals and means for each kind of planning call, and each agent, across recent runs."""
+        with self._lock:
+            runs = [(agent, list(stages)) for agent, stages in self._runs]
+
+        def totals(stages: list[PlanningStage]) -> dict[str, Any]:
+            timed = [stage.seconds for stage in stages if stage.seconds is not None]
+            return dict(
+                calls=len(stages),
+                seconds=sum(timed),
+                mean_seconds=sum(timed) / len(timed) if timed else None,
+                max_seconds=max(timed, default=None),
+                prompt_tokens=sum(stage.spent_prompt_tokens for stage in stages),
+                completion_tokens=sum(stage.output_tokens or 0 for stage in stages),
+                max_history_chars=max((stage.history_chars for stage in stages), default=0),
+                max_schema_bytes=max((stage.schema_bytes or 0 for stage in stages), default=0),
+            )
+
+        by_kind: dict[str, list[PlanningStage]] = {}
+        by_agent: dict[str, list[PlanningStage]] = {}
+        for agent, stages in runs:
+            by_agent.setdefault(agent, []).extend(stages)
+            for stage in stages:
+                by_kind.setdefault(stage.kind or stage.stage, []).append(stage)
+        return dict(
+            runs=len(runs),
+            stages={kind: totals(stages) for kind, stages in by_kind.items()},
+            agents={agent: totals(stages) for agent, stages in by_agent.items()},
+        )
+
+    def report(self) -> str:
+        summary = self.summary()
+        lines = [f"Planning profile of {summary['runs']} runs"]
+        for heading in ("stages", "agents"):
+            lines.append(f"By {heading[:-1]}:")
+            for name, totals in sorted(
+                summary[heading].items(), key=lambda item: -item[1]["seconds"]
+            ):
+                lines.append(
+                    f"- {name}: {totals['calls']} calls, {totals['seconds']:.2f}s, "
+                    f"{totals['prompt_tokens']} prompt / {totals['completion_tokens']} completion "
+                    f"tokens, up to {totals['max_history_chars']} history chars and "
+                    f"{totals['max_schema_bytes']} schema bytes"
+                )
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._runs.clear()
+
+
+# Shared by every agent planned in this process
+planning_profiler = PlanningProfiler()
@@ -0,0 +1,76 @@
+import math
+import re
+from collections import Counter
+
+from planning_agent_demo.ast.callable import CallableDefinition
+from planning_agent_demo.callables.base import BaseCallable
+
+
+def tokenize(text: str) -> list[str]:
+    # Split camelCase and snake_case identifiers into words, so `sumValues` matches "sum"
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def definition_text(definition: CallableDefinition) -> str:
+    parts = [definition.name, definition.description]
+    for name, placeholder in {**definition.parameters, **definition.returns}.items():
+        parts.extend([name, placeholder.description])
+    return " ".join(parts)
+
+
+class ToolIndex:
+    """A BM25 index over callables' names, descriptions, parameters, and return values.
+
+    Used to shortlist the callables worth showing to the LLM when planning, so prompt and schema
+    size don't grow with the number of callables available. Everything is computed locally, once,
+    when the index is built.
+    """
+
+    def __init__(self, callables: list[BaseCallable], *, k1: float = 1.5, b: float = 0.75):
+        self.callables = list(callables)
+        self.k1 = k1
+        self.b = b
+
+        documents = [tokenize(definition_text(fn.definition)) for fn in self.callables]
+        self._term_counts = [Counter(document) for document in documents]
+        self._lengths = [len(document) for document in documents]
+        self._average_length = sum(self._lengths) / len(documents) if documents else 0.0
+
+        document_frequency = Counter(term for counts in self._term_counts for term in counts)
+        n = len(documents)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        terms = [term for term in tokenize(query) if term in self._idf]
+        scores = []
+        for counts, length in zip(self._term_counts, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self._average_length or 1))
+            scores.append(
+                sum(
+                    self._idf[term] * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                    for term in terms
+                    if term in counts
+                )
+            )
+        return scores
+
+    def search(
+        self, query: str, top_k: int, among: list[BaseCallable] | None = None
+    ) -> list[BaseCallable]:
+        """The `top_k` callables most relevant to `query`, best first.
+
+        If `among` is given, only those callables are considered. Ties keep the index's order.
+        """
+        allowed = None if among is None else {id(fn) for fn in among}
+        ranked = sorted(
+            (
+                (-score, i)
+                for i, score in enumerate(self.scores(query))
+                if allowed is None or id(self.callables[i]) in allowed
+            ),
+        )
+        return [self.callables[i] for _, i in ranked[:top_k]]
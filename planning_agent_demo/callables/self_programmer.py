@@ -1,26 +1,61 @@
 import decimal
+import functools
+import hashlib
+import os
 import textwrap
-from functools import cache
-from typing import Literal, Union, ClassVar
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Annotated, Any, Literal, Union, ClassVar
 
-from langchain_ollama import ChatOllama
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 from planning_agent_demo.ast.callable import CallableDefinition
+from planning_agent_demo.ast.checkpoint import CheckpointStore
+from planning_agent_demo.ast.deadline import ExecutionCancelled, ExecutionTimeout, current_context
 from planning_agent_demo.ast.expression import (
     AssignmentStatement,
     Program,
     ReturnStatement,
     VariableExpr,
     CallableInvocation,
+    LiteralExpr,
+    MapExpr,
 )
+from planning_agent_demo.ast.memory import SpillingScope, materialize
 from planning_agent_demo.ast.result import ResultError, ResultOk
+from planning_agent_demo.ast.scope import ModelView, Scope
 from planning_agent_demo.ast.utils import PlaceholderDict
 from planning_agent_demo.ast.variable import PlaceholderDefinition
-from planning_agent_demo.callables.base import BaseCallable, BaseStatefulCallable
+from planning_agent_demo.callables.backends import (
+    PlanningBackends,
+    TokenUsage,
+    is_instance_of,
+    reliable_call,
+    schema_size,
+    type_adapter,
+)
+from planning_agent_demo.callables.base import (
+    BaseCallable,
+    BaseStatefulCallable,
+    unwrap_callable,
+)
+from planning_agent_demo.callables.planning import (
+    PlanningBudget,
+    PlanningBudgetExceeded,
+    PlanningBudgetTracker,
+    PlanningContext,
+    PlanningStage,
+)
+from planning_agent_demo.callables.retrieval import ToolIndex
+from planning_agent_demo.callables.single_flight import SingleFlight, file_lock
 
-# DEFAULT_MODEL = "llama3.2"
-DEFAULT_MODEL = "deepseek-r1"
+# Extra plan candidates are sampled at this temperature, so they differ from the greedy plan
+CANDIDATE_TEMPERATURE = 0.7
+
+# Concurrent first requests to agents with the same plan key share a single planning run
+_plan_flights = SingleFlight()
 
 
 def str_choice(choices: list[str]) -> type:
@@ -73,14 +108,15 @@ class VariableArgument(BaseModel):
 class LiteralArgument(BaseModel):
     literal_value: str | decimal.Decimal | bool
 
-    # def __str__(self):
-    #     return repr(self.constant)
-    #
-    # def to_expression(self) -> LiteralExpr:
-    #     return LiteralExpr(value=self.constant)
+    def __str__(self):
+        return repr(self.literal_value)
+
+    def to_expression(self) -> LiteralExpr:
+        return LiteralExpr(value=self.literal_value)
 
 
 class ProgramFormalStep(BaseModel):
+    step_type: Literal["call"] = Field("call", frozen=True)
     function: str
     arguments: dict[str, VariableArgument | LiteralArgument]
     result_assignments: dict[str, str]
@@ -95,11 +131,15 @@ class ProgramFormalStep(BaseModel):
         cls,
         function_name: str,
         args_type: type[BaseModel],
-        existing_variables: list[str],
+        existing_variables: list[str] | None,
         returned_variables: list[str],
     ):
+        # With no list of existing variables (e.g. when writing a whole program at once), any name
+        # is allowed and the program is checked by static verification afterward
         class ConstrainedVariableArgument(VariableArgument):
-            variable_name: str_choice(existing_variables)
+            variable_name: (
+                str_var_name if existing_variables is None else str_choice(existing_variables)
+            )
 
         args_type = (
             PlaceholderDict.from_pydantic(args_type)
@@ -130,6 +170,109 @@ class ProgramFormalStep(BaseModel):
         )
 
 
+class ProgramMapStep(BaseModel):
+    step_type: Literal["map"] = Field("map", frozen=True)
+    function: str
+    item_parameter: str
+    collection: VariableArgument
+    arguments: dict[str, VariableArgument | LiteralArgument]
+    result_assignments: dict[str, str]
+
+    def __str__(self):
+        assignments = ", ".join(f"{k} <- {v}" for k, v in self.result_assignments.items())
+        arguments = ", ".join(
+            [f"{self.item_parameter}=_"] + [f"{k}={v}" for k, v in self.arguments.items()]
+        )
+        return f"({assignments}) = [{self.function}({arguments}) for _ in {self.collection}]"
+
+    @classmethod
+    def create_specified_map_step(
+        cls,
+        function_name: str,
+        args_type: type[BaseModel],
+        item_parameter: str,
+        existing_variables: list[str] | None,
+        returned_variables: list[str],
+    ):
+        class ConstrainedVariableArgument(VariableArgument):
+            variable_name: (
+                str_var_name if existing_variables is None else str_choice(existing_variables)
+            )
+
+        parameters = PlaceholderDict.from_pydantic(args_type)
+        args_type = (
+            PlaceholderDict(
+                placeholders={
+                    k: v for k, v in parameters.placeholders.items() if k != item_parameter
+                },
+                extras=parameters.extras,
+            )
+            .with_values_as(ConstrainedVariableArgument | LiteralArgument)
+            .to_pydantic(name="Arguments")
+        )
+
+        # The class body can't see `item_parameter` itself, since it defines a field of that name
+        parameter_name = item_parameter
+
+        class SpecifiedProgramMapStep(ProgramMapStep):
+            function: Literal[function_name] = Field(function_name, frozen=True)
+            item_parameter: Literal[parameter_name] = Field(parameter_name, frozen=True)
+            collection: ConstrainedVariableArgument = Field(
+                ...,
+                description=f"The list variable to call the function on each item of; each item is passed as `{parameter_name}`",
+            )
+            arguments: args_type = Field(
+                ...,
+                description="The other arguments to pass into the function, the same ones for every item. Keys are the parameter names in the function, and the values are the expressions to evaluate to pass to those parameters at runtime.",
+            )
+            result_assignments: dict[str_var_name, str_choice(returned_variables)] = Field(
+                ...,
+                description="A map from local variable names to return-value names to bind to those local variables. Each local variable gets a list of the values returned for every item, in order.",
+            )
+
+        return SpecifiedProgramMapStep
+
+    def to_statement(self) -> AssignmentStatement:
+        return AssignmentStatement(
+            assignments=self.result_assignments,
+            rhs_expression=MapExpr(
+                name=self.function,
+                item_parameter=self.item_parameter,
+                collection=self.collection.to_expression(),
+                arguments={k: v.to_expression() for k, v in self.arguments.items()},
+            ),
+        )
+
+
+ProgramStep = Annotated[ProgramFormalStep | ProgramMapStep, Field(discriminator="step_type")]
+
+
+def specified_steps(
+    fn: BaseCallable, existing_variables: list[str] | None, *, map_steps: bool
+) -> list[type[BaseModel]]:
+    """The step schemas for calling `fn`: a plain call, and a map over each of its parameters."""
+    steps = [
+        ProgramFormalStep.create_specified_formal_step(
+            function_name=fn.definition.name,
+            args_type=fn.inputs_type,
+            existing_variables=existing_variables,
+            returned_variables=list(fn.definition.returns),
+        )
+    ]
+    if map_steps:
+        steps.extend(
+            ProgramMapStep.create_specified_map_step(
+                function_name=fn.definition.name,
+                args_type=fn.inputs_type,
+                item_parameter=parameter,
+                existing_variables=existing_variables,
+                returned_variables=list(fn.definition.returns),
+            )
+            for parameter in fn.definition.parameters
+        )
+    return steps
+
+
 class ProgramReturnStep(BaseModel):
     return_values: dict[str_var_name, str_var_name] = Field(
         ...,
@@ -156,22 +299,120 @@ class ProgramReturnStep(BaseModel):
         )
 
 
-@cache
-def llm():
-    return ChatOllama(model=DEFAULT_MODEL, verbose=True, temperature=0.0)
+class ProgramDraft(BaseModel):
+    """A whole program, written in one go rather than one step at a time."""
+
+    steps: list[ProgramStep] = Field(
+        ...,
+        description="The lines of the program, in order; each line calls exactly one function and "
+        "can only use the function's inputs and variables assigned by earlier lines",
+    )
+    return_values: dict[str_var_name, str_var_name] = Field(
+        ...,
+        description="The variables to return to the calling function; the key is the name to return, and must be one of the pre-defined output names; the value must be the current-scope variable whose value should be returned under that name.",
+    )
+
+    @classmethod
+    def create_specified_draft(
+        cls, callables: list[BaseCallable], expected_outputs: list[str], *, map_steps: bool
+    ):
+        step_type = Union[
+            *[
+                step
+                for fn in callables
+                for step in specified_steps(fn, existing_variables=None, map_steps=map_steps)
+            ]
+        ]
+
+        class SpecifiedProgramDraft(ProgramDraft):
+            steps: list[step_type] = Field(
+                ...,
+                description="The lines of the program, in order; each line calls exactly one function and can only use the function's inputs and variables assigned by earlier lines",
+            )
+            return_values: dict[str_choice(expected_outputs), str_var_name] = Field(
+                ...,
+                description="The variables to return to the calling function; the key is the name to return, and must be one of the pre-defined output names; the value must be the current-scope variable whose value should be returned under that name.",
+            )
+
+        return SpecifiedProgramDraft
+
+    def to_program(self) -> Program:
+        return Program(
+            statements=[step.to_statement() for step in self.steps],
+            return_statement=ProgramReturnStep(return_values=self.return_values).to_statement(),
+        )
 
 
 def structured_llm_call[O: BaseModel](
-    output_model: type[O], generate_model: type[BaseModel] | None = None, *, messages
+    output_model: type[O],
+    generate_model: type[BaseModel] | None = None,
+    *,
+    messages,
+    stage: str,
+    temperature: float = 0.0,
+    backends: PlanningBackends | None = None,
+    profile: PlanningStage | None = None,
 ) -> O:
+    """Generate an `output_model` from `messages` with the stage's backend.
+
+    `generate_model` is what the model is actually asked for, when that's more specific than the
+    output model. The call's time, token usage, and schema size are filled into `profile`.
+    """
     if generate_model is None:
         generate_model = output_model
-    structured_llm = llm().with_structured_output(generate_model)
-    result = structured_llm.invoke(messages)
-    result = output_model(**result.model_dump())
+    if backends is None:
+        backends = PlanningBackends()
+    backend = backends.for_stage(stage)
+
+    def attempt() -> tuple[O, TokenUsage | None]:
+        result, usage = backend.structured_call(
+            generate_model, messages, stage=stage, temperature=temperature
+        )
+        # `output_model` may also be a union, like `ProgramStep`
+        if not is_instance_of(type(result), output_model):
+            result = type_adapter(output_model).validate_python(result.model_dump())
+        return result, usage
+
+    call = functools.partial(
+        reliable_call, attempt, stage=stage, retry=backends.retry, hedge=backends.hedge
+    )
+    start = time.perf_counter()
+    context = current_context()
+    if context is None:
+        result, usage = call()
+    else:
+        result, usage = context.run(
+            call, timeout=context.stage_timeouts.get(stage), what=f"Planning stage `{stage}`"
+        )
+    if profile is not None:
+        profile.kind = stage
+        profile.seconds = time.perf_counter() - start
+        profile.schema_bytes = schema_size(generate_model)
+        if usage is not None:
+            profile.input_tokens = usage.input_tokens
+            profile.output_tokens = usage.output_tokens
     return result
 
 
+class PlanExample(BaseModel):
+    inputs: dict[str, Any] = Field(..., description="Input values to run a candidate program with")
+    expected_outputs: dict[str, Any] | None = Field(
+        None,
+        description="The outputs a correct program must produce; if omitted, a candidate only "
+        "needs to run without errors",
+    )
+
+
+class WarmUpTiming(BaseModel):
+    name: str
+    instance_id: uuid.UUID
+    planned: bool = Field(
+        ...,
+        description="Whether the agent was planned during warm-up, rather than already having a program",
+    )
+    seconds: float = Field(..., description="Time spent warming up this agent")
+
+
 class SelfProgrammer(BaseStatefulCallable):
     type_prefix: ClassVar[str] = "self_programmer"
 
@@ -181,8 +422,98 @@ class SelfProgrammer(BaseStatefulCallable):
     inputs: dict[str, PlaceholderDefinition]
     expected_outputs: dict[str, PlaceholderDefinition]
     program: Program | None = None
+    trusted: bool = Field(
+        False,
+        description="Once the program passes static verification, skip re-validating the values passed "
+        "between its statements; inputs and outputs are still validated at this agent's boundary",
+    )
+    inline_agents: bool = Field(
+        False,
+        description="Splice the programs of planned nested agents into this agent's program, so the "
+        "whole agent tree runs as one flat program",
+    )
+
+    planning_mode: Literal["staged", "single_shot"] = Field(
+        "staged",
+        description="`single_shot` asks for the whole program in one LLM call, and only falls back to "
+        "the step-by-step `staged` planning when that program fails static verification",
+    )
+    max_tools: int | None = Field(
+        None,
+        gt=0,
+        description="Only show the LLM this many callables when planning, shortlisted by relevance "
+        "to the instructions; all of them are shown if unset",
+    )
+    step_tools: int | None = Field(
+        None,
+        gt=0,
+        description="Narrow the shortlist further for each step of the plan, to the callables most "
+        "relevant to that step's description",
+    )
+    backends: PlanningBackends = Field(
+        default_factory=PlanningBackends,
+        description="The LLM backend to plan with, optionally a different one for each planning stage",
+    )
+    plan_map_steps: bool = Field(
+        False,
+        description="Let planned steps map a callable over a list variable, calling it on each item "
+        "in parallel, rather than only calling it once; off by default, since it adds a map variant "
+        "of every callable to the planning schemas",
+    )
+    plan_candidates: int = Field(
+        1,
+        ge=1,
+        description="How many candidate programs to generate concurrently when planning; the "
+        "cheapest one that is correct on `plan_examples` is kept",
+    )
+    plan_examples: list[PlanExample] = Field(
+        default_factory=list,
+        description="Example inputs (and optionally expected outputs) used to check candidate "
+        "programs; note that candidates really run, so their callables are invoked",
+    )
+    plan_wait_timeout: float | None = Field(
+        None,
+        gt=0,
+        description="How long a request waits for another request that is already planning this "
+        "agent, in seconds, before failing with `ExecutionTimeout`; no limit if unset",
+    )
+    plan_cache_dir: str | None = Field(
+        None,
+        description="Save plans to this directory by `plan_key`, so that an identical agent in any "
+        "process on this host reuses the plan instead of planning again",
+    )
+    planning_budget: PlanningBudget | None = Field(
+        None,
+        description="Limits on the LLM calls, time, and tokens one planning run may use; planning "
+        "that reaches one fails with `PlanningBudgetExceeded`",
+    )
+    checkpoint_dir: str | None = Field(
+        None,
+        description="Checkpoint each run's progress to this directory, so a run that fails can be "
+        "carried on with `resume` rather than started over",
+    )
+    checkpoint_every: int = Field(
+        1, ge=1, description="Write a checkpoint after this many statements complete"
+    )
+    memory_budget: int | None = Field(
+        None,
+        gt=0,
+        description="Bytes of buffer values (bytes, bytearray, memoryview) one run may hold in "
+        "memory; large buffers beyond it are spilled to memory-mapped temporary files. Spilled "
+        "buffers are read without a copy by trusted programs and by callables declaring them as "
+        "`Buffer`; an untrusted call validating a plain `bytes` parameter gets a copy",
+    )
+    spill_dir: str | None = Field(
+        None, description="Where to spill buffers over the memory budget; the temp dir by default"
+    )
 
     _input_model: type[BaseModel] | None = None
+    _output_model: type[BaseModel] | None = None
+    _verified_program: Program | None = None
+    _inlined: tuple[tuple, Program, list[BaseCallable]] | None = None
+    _planning_stages: list[PlanningStage] | None = None
+    _tool_index: ToolIndex | None = None
+    _checkpoints: CheckpointStore | None = None
 
     @property
     def definition(self) -> CallableDefinition:
@@ -222,17 +553,72 @@ class SelfProgrammer(BaseStatefulCallable):
 
     @property
     def result_type(self):
-        return self._outputs_definition.to_pydantic("SelfProgrammerOutputs")
+        if self._output_model is None:
+            self._output_model = self._outputs_definition.to_pydantic("SelfProgrammerOutputs")
+        return self._output_model
+
+    def _executable_program(self) -> tuple[Program, list[BaseCallable]]:
+        if not self.inline_agents:
+            return self.program, self.callables
+
+        from planning_agent_demo.callables.inline import inline_program
+
+        # Inline again whenever any agent in the tree has been (re)planned since last time
+        programs = tuple(agent.program for agent in self.agent_tree())
+        if (
+            self._inlined is None
+            or len(self._inlined[0]) != len(programs)
+            or any(old is not new for old, new in zip(self._inlined[0], programs))
+        ):
+            self._inlined = (programs, *inline_program(self.program, self.callables))
+        return self._inlined[1], self._inlined[2]
+
+    def _is_trusted(self, program: Program, callables: list[BaseCallable]) -> bool:
+        if not self.trusted:
+            return False
+        if self._verified_program is not program:
+            errors = program.verify(
+                self.inputs,
+                {fn.definition.name: fn for fn in callables},
+                expected_outputs=self.expected_outputs,
+            )
+            if errors:
+                print(f"Program failed verification, running with full validation: {errors}")
+                return False
+            self._verified_program = program
+        return True
+
+    def _index(self) -> ToolIndex:
+        # Rebuilt only if the list of callables is changed
+        if self._tool_index is None or [id(fn) for fn in self._tool_index.callables] != [
+            id(fn) for fn in self.callables
+        ]:
+            self._tool_index = ToolIndex(self.callables)
+        return self._tool_index
+
+    def _planning_tools(self) -> list[BaseCallable]:
+        """The callables to show the LLM while planning this agent."""
+        if self.max_tools is None or len(self.callables) <= self.max_tools:
+            return self.callables
+        query = " ".join(
+            [self.instructions]
+            + [f"{name} {p.description}" for name, p in self.inputs.items()]
+            + [f"{name} {p.description}" for name, p in self.expected_outputs.items()]
+        )
+        return self._index().search(query, self.max_tools)
 
-    def _generate_plan(self, arguments: BaseModel) -> Program:
-        arguments = self.inputs_type.model_validate(arguments)
+    def _step_tools(self, step: ProgramRoughStep, tools: list[BaseCallable]) -> list[BaseCallable]:
+        if self.step_tools is None or len(tools) <= self.step_tools:
+            return tools
+        query = " ".join([step.step_description, *step.expected_output_variable_names])
+        return self._index().search(query, self.step_tools, among=tools)
 
-        print("Generating program")
+    def _planning_messages(self, tools: list[BaseCallable]) -> list[tuple[str, str]]:
         tool_descriptions = "\n".join(
-            f"- `{fn.definition.name}`: {fn.definition.description}" for fn in self.callables
+            f"- `{fn.definition.name}`: {fn.definition.description}" for fn in tools
         )
 
-        messages = [
+        return [
             (
                 "system",
                 textwrap.dedent("""
@@ -262,76 +648,187 @@ class SelfProgrammer(BaseStatefulCallable):
             ("human", f"Here are the tools you have available:\n{tool_descriptions}"),
         ]
 
-        print("Generating initial ideas...")
-        plan_overview: ProgramOverview = structured_llm_call(ProgramOverview, messages=messages)
-        messages.extend(
-            [
-                ("assistant", plan_overview.initial_thoughts),
-                ("assistant", plan_overview.detailed_thoughts),
-                ("assistant", plan_overview.concluding_thoughts),
+    def _generate_program(
+        self,
+        arguments: BaseModel | None = None,
+        *,
+        temperature: float = 0.0,
+        tracker: PlanningBudgetTracker | None = None,
+    ) -> Program:
+        # The fallback to staged planning draws on the same budget as the single-shot attempt
+        if tracker is None:
+            tracker = PlanningBudgetTracker(self.planning_budget)
+        if self.planning_mode == "single_shot":
+            try:
+                program = self._generate_single_shot_plan(temperature=temperature, tracker=tracker)
+            except PlanningBudgetExceeded:
+                raise
+            except Exception as e:
+                print(f"Single-shot planning failed, planning step by step instead: {e}")
+            else:
+                callables = {fn.definition.name: fn for fn in self.callables}
+                if not (errors := program.verify(self.inputs, callables, self.expected_outputs)):
+                    return program
+                print(
+                    f"Single-shot program failed verification, planning step by step instead: {errors}"
+                )
+        return self._generate_plan(arguments, temperature=temperature, tracker=tracker)
+
+    def _generate_single_shot_plan(
+        self, *, temperature: float = 0.0, tracker: PlanningBudgetTracker | None = None
+    ) -> Program:
+        print("Generating whole program")
+        tools = self._planning_tools()
+        context = PlanningContext(
+            self._planning_messages(tools),
+            agent=self.name,
+            budget=self.planning_budget,
+            tracker=tracker,
+        )
+        draft = structured_llm_call(
+            ProgramDraft,
+            ProgramDraft.create_specified_draft(
+                tools, list(self.expected_outputs), map_steps=self.plan_map_steps
+            ),
+            stage="program",
+            backends=self.backends,
+            messages=context.prompt(
+                "program",
                 (
                     "assistant",
-                    "Ok, now I need to plan out what my function will look like, one line of code at a time. I need to remember that each line will be exactly one function call.",
+                    textwrap.dedent(f"""
+                        I'll write the whole program at once, one function call per line.
+
+                        I start with the following variables available: {sorted(self.inputs)}
+
+                        I'm expected to return the following values: {list(self.expected_outputs)}.
+                        """).strip(),
                 ),
-            ]
+            ),
+            profile=context.latest,
+            temperature=temperature,
+        )
+        self._planning_stages = context.stages
+        print(f"Planning prompt sizes:\n{context.report()}")
+        return draft.to_program()
+
+    def _generate_plan(
+        self,
+        arguments: BaseModel | None = None,
+        *,
+        temperature: float = 0.0,
+        tracker: PlanningBudgetTracker | None = None,
+    ) -> Program:
+        if arguments is not None:
+            arguments = self.inputs_type.model_validate(arguments)
+
+        print("Generating program")
+        tools = self._planning_tools()
+        messages = self._planning_messages(tools)
+
+        # Every call sends this shared prefix plus a short stage-specific suffix, so the prefix stays
+        # byte-identical between calls and each prompt stays bounded however many steps there are
+        context = PlanningContext(
+            messages, agent=self.name, budget=self.planning_budget, tracker=tracker
+        )
+
+        print("Generating initial ideas...")
+        plan_overview: ProgramOverview = structured_llm_call(
+            ProgramOverview,
+            messages=context.prompt("overview"),
+            profile=context.latest,
+            stage="overview",
+            backends=self.backends,
+            temperature=temperature,
+        )
+        context.extend(
+            ("assistant", plan_overview.initial_thoughts),
+            ("assistant", plan_overview.detailed_thoughts),
+            ("assistant", plan_overview.concluding_thoughts),
+            (
+                "assistant",
+                "Ok, now I need to plan out what my function will look like, one line of code at a time. I need to remember that each line will be exactly one function call.",
+            ),
         )
 
         print("Converting ideas into logical plan...")
         plan_rough_draft: ProgramRoughPlan = structured_llm_call(
             ProgramRoughPlan,
-            messages=messages,
+            messages=context.prompt("rough_plan"),
+            profile=context.latest,
+            stage="rough_plan",
+            backends=self.backends,
+            temperature=temperature,
         )
-        numbered_outline = "\n".join(
+        outline = [
             f"{i}. {step.step_description.rstrip('.')}. This will generate the following variables: {step.expected_output_variable_names}"
             for i, step in enumerate(plan_rough_draft.implementation_steps, 1)
-        )
-        messages.append(("assistant", numbered_outline))
+        ]
+        context.extend(("assistant", "\n".join(outline)))
 
-        formal_steps: list[ProgramFormalStep] = []
+        formal_steps: list[ProgramFormalStep | ProgramMapStep] = []
         available_variables: set[str] = set(self.inputs)
 
         for i, step in enumerate(plan_rough_draft.implementation_steps, 1):
             available_tool_calls = [
-                ProgramFormalStep.create_specified_formal_step(
-                    function_name=fn.definition.name,
-                    args_type=fn.inputs_type,
-                    existing_variables=list(available_variables),
-                    returned_variables=list(fn.definition.returns),
+                specified_step
+                for fn in self._step_tools(step, tools)
+                for specified_step in specified_steps(
+                    fn, sorted(available_variables), map_steps=self.plan_map_steps
                 )
-                for fn in self.callables
             ]
             tool_call_type = Union[*available_tool_calls]
 
             print(f"Generating function call for step {i}...")
-            messages.append(("assistant", f"Let's finish defining step {i}"))
-            formal_step = structured_llm_call(ProgramFormalStep, tool_call_type, messages=messages)
+            # Rather than replaying every step written so far, only say which variables exist now
+            formal_step = structured_llm_call(
+                ProgramStep,
+                tool_call_type,
+                stage="formal_step",
+                backends=self.backends,
+                messages=context.prompt(
+                    f"step_{i}",
+                    (
+                        "assistant",
+                        f"Let's finish defining step {outline[i - 1]}\n\n"
+                        f"I have the following variables available: {sorted(available_variables)}",
+                    ),
+                ),
+                profile=context.latest,
+                temperature=temperature,
+            )
             formal_steps.append(formal_step)
             available_variables.update(formal_step.result_assignments.keys())
-            messages.append(("assistant", str(formal_step)))
 
         print("Generating return definition...")
-        messages.append(
-            (
-                "assistant",
-                textwrap.dedent(f"""
-                    Now, let's define what values should be returned.
-
-                    I'm expected to return the following values: {list(self.expected_outputs)}.
-
-                    I have the following variables available: {list(available_variables)}
-
-                    I just need to assign those variables to the expected output names.
-                    """).strip(),
-            )
-        )
         return_step = structured_llm_call(
             ProgramReturnStep,
             ProgramReturnStep.create_specified_return_step(
-                existing_variables=list(available_variables),
+                existing_variables=sorted(available_variables),
                 expected_outputs=list(self.expected_outputs),
             ),
-            messages=messages,
+            stage="return",
+            backends=self.backends,
+            messages=context.prompt(
+                "return",
+                (
+                    "assistant",
+                    textwrap.dedent(f"""
+                        Now, let's define what values should be returned.
+
+                        I'm expected to return the following values: {list(self.expected_outputs)}.
+
+                        I have the following variables available: {sorted(available_variables)}
+
+                        I just need to assign those variables to the expected output names.
+                        """).strip(),
+                ),
+            ),
+            profile=context.latest,
+            temperature=temperature,
         )
+        self._planning_stages = context.stages
+        print(f"Planning prompt sizes:\n{context.report()}")
 
         print("Finalizing...")
         return Program(
@@ -339,28 +836,304 @@ class SelfProgrammer(BaseStatefulCallable):
             return_statement=return_step.to_statement(),
         )
 
-    def _run_plan(self, arguments: BaseModel) -> BaseModel:
-        print("Executing plan...")
+    @property
+    def checkpoints(self) -> CheckpointStore | None:
+        if self.checkpoint_dir is None:
+            return None
+        if self._checkpoints is None or self._checkpoints.directory != Path(self.checkpoint_dir):
+            self._checkpoints = CheckpointStore(self.checkpoint_dir, every=self.checkpoint_every)
+        return self._checkpoints
+
+    def _evaluate_plan(
+        self, arguments: BaseModel, run_id: str | None = None, *, resume: bool = False
+    ) -> dict[str, Any]:
         from planning_agent_demo.ast.run_state import RunState
 
-        run_state = RunState(available_callables=self.callables, variables=arguments.model_dump())
-
-        self.program.evaluate(run_state)
+        program, callables = self._executable_program()
+        trusted = self._is_trusted(program, callables)
+        # The program's variables sit in a scope over the arguments, which are read in place
+        if self.memory_budget is None:
+            variables = Scope(ModelView(arguments))
+        else:
+            variables = SpillingScope(
+                ModelView(arguments), self.memory_budget, directory=self.spill_dir
+            )
+        checkpoints = self.checkpoints
+        checkpoint = None
+        if checkpoints is not None:
+            run_id = run_id or uuid.uuid4().hex
+            if resume:
+                checkpoint, _, restored = checkpoints.restore(run_id, program)
+                variables.update(restored)
+                print(f"Resuming run {run_id!r} after statement {checkpoint.completed}")
+            else:
+                checkpoint = checkpoints.start(run_id, program, ModelView(arguments))
+        run_state = RunState(available_callables=callables, variables=variables, trusted=trusted)
+
+        program.evaluate(run_state, checkpoint, free_dead=True)
         print(f"{run_state.result=}")
+        if isinstance(variables, SpillingScope) and variables.spills:
+            print(f"Spilled {variables.spills} values ({variables.spilled_bytes} bytes) to disk")
 
         match run_state.result:
+            # Timeouts and cancellations keep their type, so callers up the tree can tell them apart
+            case ResultError(error=msg, kind="timeout"):
+                error = ExecutionTimeout(f"Program timed out: {msg}")
+            case ResultError(error=msg, kind="cancelled"):
+                error = ExecutionCancelled(f"Program was cancelled: {msg}")
             case ResultError(error=msg):
-                raise RuntimeError(f"Program failed to execute successfully: {msg}")
+                error = RuntimeError(f"Program failed to execute successfully: {msg}")
             case ResultOk(values=data):
-                return self.result_type.model_validate(data)
+                if checkpoints is not None:
+                    checkpoints.finish(run_id)
+                if isinstance(variables, SpillingScope):
+                    return materialize(data)
+                return data
+        # Not if its arguments couldn't be checkpointed, in which case there's no log to resume from
+        if checkpoint is not None and checkpoint.path.exists():
+            error.add_note(f"Resume it with `{self.name}.resume({run_id!r})`")
+        raise error
+
+    def _run_plan(self, arguments: BaseModel, run_id: str | None = None) -> BaseModel:
+        print("Executing plan...")
+        return self.result_type.model_validate(self._evaluate_plan(arguments, run_id))
+
+    def resume(self, run_id: str) -> BaseModel:
+        """Carry on a checkpointed run that failed, from the last statement it completed.
+
+        The agent must have the same program it had when the run started.
+        """
+        if self.checkpoints is None:
+            raise ValueError(f"`{self.name}` has no `checkpoint_dir` to resume runs from")
+        if self.program is None:
+            raise ValueError(f"`{self.name}` has no program to resume runs of")
+        program, _ = self._executable_program()
+        _, arguments, _ = self.checkpoints.restore(run_id, program)
+        arguments = self.inputs_type.model_construct(**arguments)
+        print("Resuming plan...")
+        return self.result_type.model_validate(self._evaluate_plan(arguments, run_id, resume=True))
+
+    def _search_plan(self, tracker: PlanningBudgetTracker) -> Program:
+        print(f"Generating {self.plan_candidates} candidate programs")
+        # The first candidate is the usual greedy plan; the rest sample for variety. They all draw
+        # on the one budget, so the search as a whole costs no more than it allows
+        temperatures = [0.0] + [CANDIDATE_TEMPERATURE] * (self.plan_candidates - 1)
+        with ThreadPoolExecutor(max_workers=self.plan_candidates) as executor:
+            futures = [
+                executor.submit(self._generate_program, temperature=temperature, tracker=tracker)
+                for temperature in temperatures
+            ]
+
+        candidates = []
+        over_budget = None
+        for future in futures:
+            try:
+                candidates.append(future.result())
+            except PlanningBudgetExceeded as e:
+                print(f"Candidate program ran out of planning budget: {e}")
+                over_budget = e
+            except Exception as e:
+                print(f"Candidate program failed to generate: {e}")
+        if not candidates and over_budget is not None:
+            raise over_budget
+        return self._select_program(candidates)
+
+    def _select_program(self, candidates: list[Program]) -> Program:
+        """Pick the candidate that is correct on every example and cheapest to run.
+
+        Cost is estimated from the per-callable latencies recorded at run time, which the example
+        runs themselves also update.
+        """
+        from planning_agent_demo.ast.stats import callable_latency
+
+        callables = {fn.definition.name: fn for fn in self.callables}
+        correct: dict[str, Program] = {}
+        for program in candidates:
+            if str(program) in correct:
+                continue
+            if errors := program.verify(self.inputs, callables, self.expected_outputs):
+                print(f"Rejecting candidate program, it failed verification: {errors}")
+            elif self._passes_examples(program):
+                correct[str(program)] = program
+
+        if not correct:
+            raise RuntimeError(f"None of the {len(candidates)} candidate programs was correct")
+        costs = {key: callable_latency.estimate(program) for key, program in correct.items()}
+        best = min(costs, key=costs.get)
+        print(f"Selected the cheapest of {len(correct)} correct candidates ({costs[best]:.4f}s)")
+        return correct[best]
+
+    def _passes_examples(self, program: Program) -> bool:
+        from planning_agent_demo.ast.run_state import RunState
+
+        for example in self.plan_examples:
+            arguments = self.inputs_type.model_validate(example.inputs)
+            run_state = RunState(
+                available_callables=self.callables, variables=Scope(ModelView(arguments))
+            )
+            program.evaluate(run_state)
+            match run_state.result:
+                case ResultError(error=msg):
+                    print(f"Rejecting candidate program, it failed on an example: {msg}")
+                    return False
+                case ResultOk(values=data):
+                    try:
+                        outputs = self.result_type.model_validate(data)
+                    except ValidationError as e:
+                        print(f"Rejecting candidate program, its outputs are invalid: {e}")
+                        return False
+                    if example.expected_outputs is None:
+                        continue
+                    if outputs != self.result_type.model_validate(example.expected_outputs):
+                        print(f"Rejecting candidate program, it returned {outputs}")
+                        return False
+        return True
 
-    def execute(self, arguments: BaseModel) -> BaseModel:
+    @property
+    def plan_key(self) -> str:
+        """A digest of everything planning this agent depends on; identical agents share plans."""
+        planning = (
+            self.definition,
+            [fn.definition for fn in self.callables],
+            self.planning_mode,
+            self.plan_map_steps,
+            self.plan_candidates,
+            self.plan_examples,
+            self.planning_budget,
+            self.max_tools,
+            self.step_tools,
+            self.backends.default,
+            self.backends.stages,
+        )
+        return hashlib.sha256(repr(planning).encode()).hexdigest()
+
+    def _ensure_program(self, arguments: BaseModel | None = None):
+        if self.program is not None:
+            return
+        # Only one of any number of concurrent first requests plans; the rest wait for its plan. A
+        # timeout or cancellation only ends the request that was planning, and another takes over
+        program = _plan_flights.do(
+            self.plan_key,
+            functools.partial(self._plan, arguments),
+            timeout=self._plan_wait_timeout(),
+            retry_on=(ExecutionTimeout, ExecutionCancelled),
+            what=f"`{self.name}` to be planned",
+        )
+        if self.program is None:
+            self.program = program
+
+    def _plan_wait_timeout(self) -> float | None:
+        # Never wait past the current deadline
+        timeout = self.plan_wait_timeout
+        context = current_context()
+        if context is not None and (remaining := context.remaining()) is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _plan(self, arguments: BaseModel | None) -> Program:
+        if self.plan_cache_dir is None:
+            return self._plan_program(arguments)
+
+        from planning_agent_demo.ast import binary
+
+        os.makedirs(self.plan_cache_dir, exist_ok=True)
+        path = os.path.join(self.plan_cache_dir, f"{self.plan_key}.plan")
+        # Processes planning the same agent take turns, and all but the first find its plan saved
+        with file_lock(f"{path}.lock", timeout=self._plan_wait_timeout()):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    program = binary.loads(f.read())
+                print(f"Loaded cached program:\n```\n{program}\n```")
+                return program
+            program = self._plan_program(arguments)
+            try:
+                data = binary.dumps(program)
+            except binary.BinaryFormatError as e:
+                print(f"Not caching the program: {e}")
+                return program
+            # Written whole and renamed into place, so it's never read half-written
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+            return program
+
+    def _plan_program(self, arguments: BaseModel | None) -> Program:
+        # One budget for the whole run, however many times it plans
+        tracker = PlanningBudgetTracker(self.planning_budget)
+        if self.plan_candidates > 1:
+            program = self._search_plan(tracker)
+        else:
+            program = self._generate_program(arguments, tracker=tracker)
+        print(f"Program generated:\n```\n{program}\n```")
+        return program
+
+    def agent_tree(self) -> list["SelfProgrammer"]:
+        """This agent and every agent nested in its callables, children before their parents."""
+        agents: dict[uuid.UUID, SelfProgrammer] = {}
+
+        def visit(agent: SelfProgrammer):
+            for fn in agent.callables:
+                fn = unwrap_callable(fn)
+                if isinstance(fn, SelfProgrammer) and fn.instance_id not in agents:
+                    visit(fn)
+            agents[agent.instance_id] = agent
+
+        visit(self)
+        return list(agents.values())
+
+    def _warm_up(self) -> WarmUpTiming:
+        start = time.perf_counter()
+        planned = self.program is None
+        if planned:
+            # The first stages' schemas are the same for every agent, so get them ready up front
+            temperatures = [0.0] + [CANDIDATE_TEMPERATURE] * (self.plan_candidates > 1)
+            self.backends.prepare(
+                dict(overview=ProgramOverview, rough_plan=ProgramRoughPlan), temperatures
+            )
+        self._ensure_program()
+        # Built lazily and cached on first use, so build them now rather than on the first request
+        _ = self.inputs_type
+        _ = self.result_type
+        return WarmUpTiming(
+            name=self.name,
+            instance_id=self.instance_id,
+            planned=planned,
+            seconds=time.perf_counter() - start,
+        )
+
+    def warm_up(self, max_workers: int | None = None) -> list[WarmUpTiming]:
+        """Plan this agent and all of its nested agents up front, so no request hits cold planning.
+
+        Planning an agent only needs its callables' definitions, not their programs, so every
+        un-planned agent in the tree is planned concurrently. Agents are submitted bottom-up, so with
+        fewer workers than agents the children (which run first at execution time) are ready first.
+        """
+        agents = self.agent_tree()
+        with ThreadPoolExecutor(max_workers=max_workers or len(agents)) as executor:
+            timings = list(executor.map(SelfProgrammer._warm_up, agents))
+        # Inlining and verification need the whole tree planned
+        for agent in agents:
+            agent._is_trusted(*agent._executable_program())
+        return timings
+
+    def execute(self, arguments: BaseModel, run_id: str | None = None) -> BaseModel:
+        """Run the agent's program (planning it first if need be) on `arguments`.
+
+        With a `checkpoint_dir`, the run is checkpointed under `run_id` (a random id by default),
+        which a failed run's exception notes so that it can be passed to `resume`.
+        """
         if not isinstance(arguments, BaseModel):
             arguments = self.inputs_type(**arguments)
 
-        if self.program is None:
-            self.program = self._generate_plan(arguments)
+        self._ensure_program(arguments)
+        return self._run_plan(arguments, run_id)
 
-            print(f"Program generated:\n```\n{self.program}\n```")
+    def execute_trusted(self, arguments: BaseModel) -> dict[str, Any]:
+        # Called from a trusted parent program: if this agent is trusted too, its outputs flow back
+        # unvalidated and only the outermost agent validates its results
+        if not self.trusted:
+            return dict(self.execute(dict(arguments)))
 
-        return self._run_plan(arguments)
+        self._ensure_program(arguments)
+        print("Executing plan...")
+        return self._evaluate_plan(arguments)
@@ -0,0 +1,108 @@
+"""Make sure expensive work (like planning an agent) is only done once when many callers ask for it at
+the same time.
+
+`SingleFlight` does this within a process: the first caller for a key runs the work, and everyone
+else asking for the same key meanwhile waits for its outcome rather than repeating it. `file_lock`
+does the same across processes, for work whose outcome is saved somewhere they can all read it.
+"""
+
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any
+
+from planning_agent_demo.ast.deadline import ExecutionTimeout
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Any, Future] = {}
+
+    def do(
+        self,
+        key: Any,
+        fn: Callable[[], Any],
+        *,
+        timeout: float | None = None,
+        retry_on: tuple[type[BaseException], ...] = (),
+        what: str = "the result",
+    ) -> Any:
+        """Call `fn`, unless a call for `key` is already running, in which case wait for its result.
+
+        A waiter gets the same result or exception as the caller that ran `fn`, except for those in
+        `retry_on`, which only concern that caller (its own deadline passing, say): on those the
+        waiter runs `fn` itself, or waits for whoever got there first. Waiters give up with
+        `ExecutionTimeout` after `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+            if leader:
+                return self._lead(key, future, fn)
+
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                return future.result(timeout=remaining)
+            except TimeoutError as e:
+                if not (future.done() and future.exception() is e):
+                    raise ExecutionTimeout(
+                        f"Timed out after {timeout:.3g}s waiting for {what}"
+                    ) from None
+                # Raised by `fn` itself, rather than by waiting for it
+                if isinstance(e, retry_on):
+                    continue
+                raise
+            except retry_on:
+                continue
+
+    def _lead(self, key: Any, future: Future, fn: Callable[[], Any]) -> Any:
+        future.set_running_or_notify_cancel()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+@contextmanager
+def file_lock(path: str | os.PathLike, timeout: float | None = None) -> Iterator[None]:
+    """Hold an exclusive lock on `path` (created if need be), shared by every process on the host.
+
+    Raises `ExecutionTimeout` if the lock can't be taken within `timeout` seconds.
+    """
+    import fcntl
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with open(path, "a") as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (fcntl.LOCK_NB if deadline is not None else 0))
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise ExecutionTimeout(
+                        f"Timed out after {timeout:.3g}s waiting for the lock on {path}"
+                    ) from None
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -31,4 +31,4 @@ class SummationTool(SimpleCallable[SummationInputs, SummationOutputs]):
 
     @validate_call
     def execute(self, arguments: SummationInputs) -> SummationOutputs:
-        return SummationOutputs(sum=sum(arguments.model_dump(exclude_unset=True).values()))
+        return SummationOutputs(sum=sum(dict(arguments).values()))
@@ -0,0 +1,476 @@
+"""Shard batches of agent executions across worker processes, on this machine or others.
+
+A `Coordinator` listens on a TCP or Unix socket. Each worker connects to it, receives the agent
+(in the compact format of `planning_agent_demo.ast.binary`, so its planned program comes along and
+is never re-planned) once, and then executes the input records streamed to it, sending back each
+record's output values.
+
+Every frame on the socket is a fixed header (message kind, sequence number, payload length)
+followed by the payload, and records and results are encoded with `binary.dumps` too.
+
+Records are handed out as workers ask for them: each worker holds at most `prefetch` records, so a
+worker stuck on a slow record doesn't collect a backlog while the others sit idle. Once every record
+has been handed out, an idle worker steals the last record queued on the busiest worker. Results
+are put back in input order, so `Coordinator.map` behaves like the builtin `map`:
+
+    with Coordinator(agent) as coordinator:
+        coordinator.spawn_workers(4)
+        for outputs in coordinator.map(records):
+            ...
+
+Workers on other machines are started with, for example:
+
+    python -m planning_agent_demo.serving.distributed worker --connect coordinator:7000 \\
+        --callables-module planning_agent_demo.callables.summation
+"""
+
+import argparse
+import collections
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+from planning_agent_demo.ast import binary
+from planning_agent_demo.callables.base import BaseCallable
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+# Kind, sequence number, payload length
+_FRAME = struct.Struct("<BQI")
+
+_MSG_AGENT = 0
+_MSG_TASK = 1
+_MSG_CANCEL = 2
+_MSG_RESULT = 3
+_MSG_ERROR = 4
+_MSG_STOP = 5
+
+_END = object()
+
+Address = str | tuple[str, int]
+
+
+class RemoteExecutionError(RuntimeError):
+    pass
+
+
+class WorkersLost(ConnectionError):
+    pass
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self._send_lock = threading.Lock()
+
+    def send(self, kind: int, seq: int = 0, payload: bytes = b""):
+        with self._send_lock:
+            self.sock.sendall(_FRAME.pack(kind, seq, len(payload)) + payload)
+
+    def receive(self) -> tuple[int, int, bytes] | None:
+        """The next frame, or `None` once the peer has gone away."""
+        try:
+            header = self.rfile.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                return None
+            kind, seq, length = _FRAME.unpack(header)
+            payload = self.rfile.read(length)
+        except OSError:
+            return None
+        return (kind, seq, payload) if len(payload) == length else None
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class _Worker:
+    def __init__(self, connection: _Connection, index: int):
+        self.connection = connection
+        self.index = index
+        # Sequence numbers sent to the worker and not yet answered, oldest (running) first
+        self.outstanding: list[int] = []
+        self.completed = 0
+        self.alive = True
+
+
+class Coordinator:
+    def __init__(
+        self,
+        agent: SelfProgrammer,
+        address: Address = ("127.0.0.1", 0),
+        *,
+        prefetch: int = 2,
+        steal: bool = True,
+    ):
+        """Listen for workers on `address`, a Unix socket path or a `(host, port)` pair.
+
+        The default picks a free local port; see `address` for the one actually bound. Each worker
+        holds at most `prefetch` records at once, and with `steal`, idle workers take over records
+        still queued behind a slow one once every record has been handed out.
+
+        The agent (and any agent nested in it) is planned here first if need be, so that workers
+        all run the same plan rather than each planning on its own.
+        """
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        self.prefetch = prefetch
+        self.steal = steal
+        for timing in agent.warm_up():
+            if timing.planned:
+                print(f"Planned `{timing.name}` in {timing.seconds:.2f}s", file=sys.stderr)
+        self._agent_blob = binary.dumps(agent)
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(address)
+            self._listener.listen()
+        else:
+            self._listener = socket.create_server(address)
+        self.address: Address = self._listener.getsockname()
+
+        self._changed = threading.Condition()
+        self._workers: list[_Worker] = []
+        self._pending: collections.deque[tuple[int, bytes]] = collections.deque()
+        self._records: dict[int, bytes] = {}
+        self._results: dict[int, tuple[bool, bytes]] = {}
+        self._next_seq = 0
+        self._stolen = 0
+        self._duplicates = 0
+        self._processes: list[multiprocessing.Process] = []
+
+    def accept_workers(self, count: int, timeout: float | None = 30.0):
+        """Wait for `count` more workers to connect, sending each of them the agent."""
+        self._listener.settimeout(timeout)
+        for _ in range(count):
+            sock, _ = self._listener.accept()
+            sock.settimeout(None)
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _Connection(sock)
+            connection.send(_MSG_AGENT, payload=self._agent_blob)
+            with self._changed:
+                worker = _Worker(connection, len(self._workers))
+                self._workers.append(worker)
+                self._dispatch()
+            threading.Thread(
+                target=self._receive, args=(worker,), daemon=True, name=f"worker-{worker.index}"
+            ).start()
+
+    def spawn_workers(self, count: int, callables: Iterable[BaseCallable] | None = None):
+        """Start `count` local worker processes and wait for them to connect.
+
+        The workers aren't forked from this process, which would copy whatever locks its threads
+        hold at the time, but from a single-threaded fork server with this module preloaded. So
+        `callables` (by default, the registered callables) are pickled over to them, and their
+        classes must be importable.
+        """
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["planning_agent_demo.serving.distributed"])
+        callables = list(callables if callables is not None else BaseCallable.__registry__)
+        for _ in range(count):
+            process = context.Process(
+                target=run_worker, args=(self.address, callables), daemon=True
+            )
+            process.start()
+            self._processes.append(process)
+        self.accept_workers(count)
+
+    def map(self, records: Iterable[dict[str, Any]], *, window: int = 1024) -> Iterator[dict]:
+        """Execute the agent on each record, yielding each one's output values in input order.
+
+        Records are read lazily, with at most `window` of them submitted and not yet yielded. A
+        record that fails raises `RemoteExecutionError` when its turn comes.
+        """
+        records = iter(records)
+        submitted: collections.deque[int] = collections.deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(submitted) < window:
+                    record = next(records, _END)
+                    if record is _END:
+                        exhausted = True
+                    else:
+                        submitted.append(self._submit(binary.dumps(dict(record))))
+                if not submitted:
+                    return
+                succeeded, payload = self._take(submitted.popleft())
+                if not succeeded:
+                    raise RemoteExecutionError(payload.decode())
+                yield binary.loads(payload)
+        finally:
+            # Stopped early, so nobody will collect the remaining results
+            if submitted:
+                self._forget(set(submitted))
+
+    def _submit(self, record: bytes) -> int:
+        with self._changed:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._records[seq] = record
+            self._pending.append((seq, record))
+            self._dispatch()
+        return seq
+
+    def _take(self, seq: int) -> tuple[bool, bytes]:
+        with self._changed:
+            while seq not in self._results:
+                if not any(worker.alive for worker in self._workers):
+                    raise WorkersLost("No workers are connected")
+                self._changed.wait()
+            return self._results.pop(seq)
+
+    def _forget(self, seqs: set[int]):
+        with self._changed:
+            self._pending = collections.deque(
+                (seq, record) for seq, record in self._pending if seq not in seqs
+            )
+            for seq in seqs:
+                self._records.pop(seq, None)
+                self._results.pop(seq, None)
+
+    def _dispatch(self):
+        # Must be called with the lock held
+        for worker in self._workers:
+            while worker.alive and len(worker.outstanding) < self.prefetch:
+                if self._pending:
+                    seq, record = self._pending.popleft()
+                elif self.steal and not worker.outstanding:
+                    seq = self._steal_for(worker)
+                    if seq is None:
+                        break
+                    record = self._records[seq]
+                else:
+                    break
+                self._send(worker, _MSG_TASK, seq, record)
+                worker.outstanding.append(seq)
+
+    def _steal_for(self, thief: _Worker) -> int | None:
+        # The busiest worker's newest record is the one furthest from starting
+        victim = max(self._workers, key=lambda worker: len(worker.outstanding))
+        if len(victim.outstanding) < 2:
+            return None
+        seq = victim.outstanding.pop()
+        self._send(victim, _MSG_CANCEL, seq)
+        self._stolen += 1
+        return seq
+
+    def _send(self, worker: _Worker, kind: int, seq: int, payload: bytes = b""):
+        try:
+            worker.connection.send(kind, seq, payload)
+        except OSError:
+            # The receiving thread notices the lost connection and hands its records out again
+            pass
+
+    def _receive(self, worker: _Worker):
+        while (frame := worker.connection.receive()) is not None:
+            kind, seq, payload = frame
+            with self._changed:
+                if seq in worker.outstanding:
+                    worker.outstanding.remove(seq)
+                if seq in self._records:
+                    del self._records[seq]
+                    self._results[seq] = (kind == _MSG_RESULT, payload)
+                    worker.completed += 1
+                    # A stolen record its victim had already started may still be running elsewhere
+                    for other in self._workers:
+                        if seq in other.outstanding:
+                            other.outstanding.remove(seq)
+                            self._send(other, _MSG_CANCEL, seq)
+                else:
+                    self._duplicates += 1
+                self._dispatch()
+                self._changed.notify_all()
+
+        with self._changed:
+            worker.alive = False
+            # Hand the lost worker's unanswered records to the others, ahead of everything else
+            self._pending.extendleft(
+                (seq, self._records[seq])
+                for seq in reversed(worker.outstanding)
+                if seq in self._records
+            )
+            worker.outstanding.clear()
+            self._dispatch()
+            self._changed.notify_all()
+
+    def metrics(self) -> dict[str, Any]:
+        with self._changed:
+            return dict(
+                workers=sum(worker.alive for worker in self._workers),
+                pending=len(self._pending),
+                in_flight=len(self._records) - len(self._pending),
+                stolen=self._stolen,
+                duplicates=self._duplicates,
+                completed={worker.index: worker.completed for worker in self._workers},
+            )
+
+    def close(self):
+        with self._changed:
+            workers = list(self._workers)
+        for worker in workers:
+            self._send(worker, _MSG_STOP, 0)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+        for worker in workers:
+            worker.connection.close()
+        self._listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _connect(address: Address) -> socket.socket:
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def run_worker(address: Address, callables: Iterable[BaseCallable] | None = None):
+    """Connect to a coordinator and execute the records it sends until it says to stop."""
+    connection = _Connection(_connect(address))
+    frame = connection.receive()
+    if frame is None or frame[0] != _MSG_AGENT:
+        raise ConnectionError("Expected the coordinator to send an agent")
+    agent = binary.loads(frame[2], callables)
+
+    # Frames are read on their own thread, so a cancellation can overtake the records queued ahead
+    # of the one it cancels
+    inbox = collections.deque()
+    cancelled = set()
+    changed = threading.Condition()
+    stopped = False
+
+    def receive():
+        nonlocal stopped
+        while (frame := connection.receive()) is not None and frame[0] != _MSG_STOP:
+            kind, seq, payload = frame
+            with changed:
+                if kind == _MSG_TASK:
+                    inbox.append((seq, payload))
+                elif kind == _MSG_CANCEL:
+                    cancelled.add(seq)
+                changed.notify()
+        with changed:
+            stopped = True
+            changed.notify()
+
+    threading.Thread(target=receive, daemon=True, name="receive").start()
+    # Keep stdout for the coordinator's output when the worker was started by it
+    with contextlib.redirect_stdout(sys.stderr):
+        _work(agent, connection, inbox, cancelled, changed, lambda: stopped)
+    connection.close()
+
+
+def _work(agent, connection, inbox, cancelled, changed, stopped):
+    while True:
+        with changed:
+            while not inbox and not stopped():
+                changed.wait()
+            if stopped():
+                break
+            seq, payload = inbox.popleft()
+            if seq in cancelled:
+                cancelled.discard(seq)
+                continue
+        try:
+            result = agent.execute(binary.loads(payload)).model_dump()
+            kind, payload = _MSG_RESULT, binary.dumps(result)
+        except Exception as e:
+            kind, payload = _MSG_ERROR, f"{type(e).__name__}: {e}".encode()
+        try:
+            connection.send(kind, seq, payload)
+        except OSError:
+            break
+
+
+def _parse_address(args) -> Address:
+    if args.unix_socket:
+        return args.unix_socket
+    host, _, port = args.connect.rpartition(":")
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker = subparsers.add_parser("worker", help="Execute records sent by a coordinator")
+    worker.add_argument("--connect", metavar="HOST:PORT", help="The coordinator's address")
+    worker.add_argument("--unix-socket", help="Connect over this Unix socket instead of TCP")
+
+    run = subparsers.add_parser(
+        "run", help="Execute JSON lines of records from stdin, writing JSON lines of outputs"
+    )
+    run.add_argument("--archive", required=True, help="Agent archive to load the agent from")
+    run.add_argument("--agent", required=True, help="Name of the agent to run")
+    run.add_argument("--workers", type=int, default=4, help="Local worker processes to start")
+    run.add_argument(
+        "--remote-workers", type=int, default=0, help="Other workers to wait for before starting"
+    )
+    run.add_argument("--listen", metavar="HOST:PORT", default="127.0.0.1:0")
+    run.add_argument("--unix-socket", help="Listen on this Unix socket instead of TCP")
+    run.add_argument("--prefetch", type=int, default=2)
+
+    for subparser in (worker, run):
+        subparser.add_argument(
+            "--callables-module",
+            action="append",
+            default=[],
+            metavar="MODULE",
+            help="Import a module that registers callables the agent uses (repeatable)",
+        )
+    args = parser.parse_args(argv)
+
+    for module in args.callables_module:
+        importlib.import_module(module)
+
+    if args.command == "worker":
+        if not (args.connect or args.unix_socket):
+            parser.error("worker needs --connect or --unix-socket")
+        run_worker(_parse_address(args))
+        return
+
+    with binary.ProgramArchive(args.archive) as archive:
+        agents = {agent.name: agent for agent in archive if isinstance(agent, SelfProgrammer)}
+    if args.agent not in agents:
+        parser.error(f"No agent named {args.agent!r} in {args.archive}")
+    if args.unix_socket:
+        address = args.unix_socket
+    else:
+        host, _, port = args.listen.rpartition(":")
+        address = (host, int(port))
+
+    with Coordinator(agents[args.agent], address, prefetch=args.prefetch) as coordinator:
+        print(f"Coordinating on {coordinator.address}", file=sys.stderr)
+        coordinator.spawn_workers(args.workers)
+        coordinator.accept_workers(args.remote_workers, timeout=None)
+        records = (json.loads(line) for line in sys.stdin if line.strip())
+        for outputs in coordinator.map(records):
+            print(json.dumps(outputs, default=str), flush=True)
+
+
+if __name__ == "__main__":
+    main()
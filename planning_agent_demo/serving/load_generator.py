@@ -0,0 +1,101 @@
+"""Drive load against a running agent server and report throughput and latency.
+
+For example, against a server on a Unix socket:
+
+    python -m planning_agent_demo.serving.load_generator --unix-socket /tmp/agents.sock \\
+        --agent "summation agent" --arguments '{"a": 1, "b": 2}' --concurrency 32 --requests 5000
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from typing import Any
+
+import httpx
+
+
+def run_load(
+    client: httpx.Client,
+    agent_name: str,
+    arguments: dict[str, Any],
+    *,
+    concurrency: int,
+    requests: int,
+) -> dict[str, Any]:
+    """Send `requests` execute requests from `concurrency` threads and summarize the outcome."""
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            response = client.post(f"/agents/{agent_name}/execute", json=arguments)
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return dict(
+        requests=requests,
+        duration_seconds=duration,
+        throughput_per_second=len(latencies) / duration,
+        statuses=statuses,
+        latency_seconds=dict(
+            p50=_percentile(latencies, 0.50),
+            p95=_percentile(latencies, 0.95),
+            p99=_percentile(latencies, 0.99),
+            mean=statistics.fmean(latencies) if latencies else None,
+        ),
+    )
+
+
+def _percentile(ordered: list[float], q: float) -> float | None:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--unix-socket", help="Connect over this Unix socket instead of TCP")
+    parser.add_argument("--agent", required=True)
+    parser.add_argument("--arguments", default="{}", help="JSON object of input values")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    transport = httpx.HTTPTransport(uds=args.unix_socket) if args.unix_socket else None
+    base_url = "http://agents" if args.unix_socket else args.url
+    limits = httpx.Limits(max_connections=args.concurrency)
+    with httpx.Client(base_url=base_url, transport=transport, limits=limits) as client:
+        report = run_load(
+            client,
+            args.agent,
+            json.loads(args.arguments),
+            concurrency=args.concurrency,
+            requests=args.requests,
+        )
+        report["server_metrics"] = client.get("/metrics").json()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
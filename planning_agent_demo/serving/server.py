@@ -0,0 +1,464 @@
+"""A local daemon that hosts planned agents and executes requests against them.
+
+Agents are kept in memory with their programs planned and their input/output models built, and
+`execute` requests are dispatched onto a bounded worker pool. Each agent has its own concurrency
+limit, individual callables can be limited across all hosted agents (or have concurrent identical
+calls coalesced into one), and requests beyond the queue limit are rejected immediately rather than
+piling up.
+
+The server speaks plain HTTP, over TCP or a Unix socket:
+
+- `POST /agents/<name>/execute` with a JSON object of input values
+- `GET /agents` to list the hosted agents
+- `GET /metrics` for throughput, queue depth, and latency counters
+
+Run it with, for example:
+
+    python -m planning_agent_demo.serving.server --archive agents.bin \\
+        --callables-module planning_agent_demo.callables.summation --unix-socket /tmp/agents.sock
+"""
+
+import argparse
+import collections
+import decimal
+import importlib
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+from pydantic import BaseModel
+from pydantic_core import to_jsonable_python
+
+from planning_agent_demo.ast.deadline import ExecutionTimeout, execution_context
+from planning_agent_demo.callables.backends import llm_call_stats
+from planning_agent_demo.callables.base import BaseCallable, unwrap_callable
+from planning_agent_demo.callables.coalescing import CoalescingCallable, coalescing_stats
+from planning_agent_demo.callables.limited import ConcurrencyLimitedCallable
+from planning_agent_demo.callables.planning import planning_profiler
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class ServerOverloaded(RuntimeError):
+    pass
+
+
+class UnknownAgent(KeyError):
+    pass
+
+
+class _HostedAgent:
+    def __init__(self, agent: SelfProgrammer, max_concurrency: int):
+        self.agent = agent
+        self.max_concurrency = max_concurrency
+        self.pending: collections.deque = collections.deque()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+
+class AgentServer:
+    def __init__(
+        self,
+        agents: Iterable[SelfProgrammer],
+        *,
+        max_workers: int = 8,
+        max_queue: int = 64,
+        agent_concurrency: int | dict[str, int] | None = None,
+        callable_limits: dict[str, int] | None = None,
+        coalesce: Iterable[str] = (),
+        request_timeout: float | None = None,
+    ):
+        """Host `agents`, keyed by name.
+
+        `max_queue` bounds the number of accepted requests that have not started running yet;
+        beyond it, `submit` raises `ServerOverloaded`. `agent_concurrency` limits how many requests
+        for one agent run at once (defaults to `max_workers`), and `callable_limits` maps callable
+        names to the maximum number of concurrent executions across every hosted agent. Concurrent
+        calls with equal arguments to the callables (or nested agents) named in `coalesce` share a
+        single execution.
+        `request_timeout` bounds each request's time from being accepted to finishing, queueing
+        included; requests that exceed it fail with `ExecutionTimeout`.
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.request_timeout = request_timeout
+
+        limited: dict[int, ConcurrencyLimitedCallable] = {}
+        coalesce = set(coalesce)
+        coalescing: dict[int, CoalescingCallable] = {}
+        self._agents: dict[str, _HostedAgent] = {}
+        for agent in agents:
+            if agent.name in self._agents:
+                raise ValueError(f"Multiple agents named `{agent.name}`")
+            if callable_limits:
+                _limit_callables(agent, callable_limits, limited)
+            if coalesce:
+                # Outside any limit, so that callers waiting on a shared call don't hold a slot
+                _coalesce_callables(agent, coalesce, coalescing)
+            if isinstance(agent_concurrency, dict):
+                max_concurrency = agent_concurrency.get(agent.name, max_workers)
+            else:
+                max_concurrency = agent_concurrency or max_workers
+            self._agents[agent.name] = _HostedAgent(agent, max_concurrency)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent")
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._waiting = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_latency = 0.0
+        self._total_queue_time = 0.0
+
+    @classmethod
+    def from_archive(cls, path, callables: Iterable[BaseCallable] | None = None, **kwargs):
+        """Host every agent stored in an archive written by `planning_agent_demo.ast.binary`."""
+        from planning_agent_demo.ast.binary import ProgramArchive
+
+        with ProgramArchive(path, callables=callables) as archive:
+            agents = [agent for agent in archive if isinstance(agent, SelfProgrammer)]
+        return cls(agents, **kwargs)
+
+    @property
+    def agent_names(self) -> list[str]:
+        return list(self._agents)
+
+    def warm(self):
+        """Plan every hosted agent (and its nested agents) that has no program yet."""
+        for hosted in self._agents.values():
+            for timing in hosted.agent.warm_up():
+                if timing.planned:
+                    print(f"Planned `{timing.name}` in {timing.seconds:.2f}s")
+
+    def submit(self, agent_name: str, arguments: dict[str, Any]) -> Future:
+        """Queue a request, returning a future for the agent's JSON-compatible output values."""
+        if agent_name not in self._agents:
+            raise UnknownAgent(agent_name)
+        hosted = self._agents[agent_name]
+        # Validate up front so bad requests fail fast and never take a queue slot
+        arguments = hosted.agent.inputs_type.model_validate(arguments)
+
+        future = Future()
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._rejected += 1
+                raise ServerOverloaded(
+                    f"Request queue is full ({self._waiting} requests waiting), try again later"
+                )
+            self._waiting += 1
+            hosted.pending.append((future, arguments, time.perf_counter()))
+            self._dispatch(hosted)
+        return future
+
+    def execute(self, agent_name: str, arguments: dict[str, Any], timeout: float | None = None):
+        return self.submit(agent_name, arguments).result(timeout=timeout)
+
+    def _dispatch(self, hosted: _HostedAgent):
+        # Must be called with the lock held
+        while hosted.pending and hosted.running < hosted.max_concurrency:
+            future, arguments, enqueued_at = hosted.pending.popleft()
+            hosted.running += 1
+            self._executor.submit(self._run, hosted, future, arguments, enqueued_at)
+
+    def _run(self, hosted: _HostedAgent, future: Future, arguments, enqueued_at: float):
+        started_at = time.perf_counter()
+        # False if the caller cancelled the request while it was queued
+        running = future.set_running_or_notify_cancel()
+        with self._lock:
+            self._waiting -= 1
+            self._in_flight += 1
+            if running:
+                self._total_queue_time += started_at - enqueued_at
+
+        failed = timed_out = False
+        timeout = self.request_timeout
+        if timeout is not None:
+            timeout -= started_at - enqueued_at
+        try:
+            if running:
+                try:
+                    with execution_context(timeout=timeout):
+                        result = _json_outputs(hosted.agent.execute(arguments))
+                except Exception as e:
+                    failed = True
+                    timed_out = isinstance(e, ExecutionTimeout)
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            with self._lock:
+                hosted.running -= 1
+                self._in_flight -= 1
+                self._timed_out += timed_out
+                if not running:
+                    hosted.cancelled += 1
+                else:
+                    if failed:
+                        hosted.failed += 1
+                    else:
+                        hosted.completed += 1
+                    self._total_latency += time.perf_counter() - enqueued_at
+                self._dispatch(hosted)
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            uptime = time.monotonic() - self._started_at
+            completed = sum(hosted.completed for hosted in self._agents.values())
+            failed = sum(hosted.failed for hosted in self._agents.values())
+            finished = completed + failed
+            return dict(
+                uptime_seconds=uptime,
+                queue_depth=self._waiting,
+                in_flight=self._in_flight,
+                completed=completed,
+                failed=failed,
+                cancelled=sum(hosted.cancelled for hosted in self._agents.values()),
+                rejected=self._rejected,
+                timed_out=self._timed_out,
+                throughput_per_second=finished / uptime if uptime else 0.0,
+                mean_latency_seconds=self._total_latency / finished if finished else 0.0,
+                mean_queue_seconds=self._total_queue_time / finished if finished else 0.0,
+                planning=llm_call_stats.snapshot(),
+                planning_profile=planning_profiler.summary(),
+                coalescing=coalescing_stats.snapshot(),
+                agents={
+                    name: dict(
+                        queue_depth=len(hosted.pending),
+                        running=hosted.running,
+                        completed=hosted.completed,
+                        failed=hosted.failed,
+                        cancelled=hosted.cancelled,
+                    )
+                    for name, hosted in self._agents.items()
+                },
+            )
+
+    def make_http_server(self, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+        return ThreadingHTTPServer((host, port), _make_handler(self))
+
+    def make_unix_server(self, path: str) -> "_ThreadingUnixHTTPServer":
+        if os.path.exists(path):
+            os.unlink(path)
+        return _ThreadingUnixHTTPServer(path, _make_handler(self))
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _json_outputs(outputs: BaseModel) -> dict[str, Any]:
+    # Pydantic writes decimals as strings to keep their precision, but agents' numbers are numbers
+    return to_jsonable_python(_as_json_numbers(outputs.model_dump()))
+
+
+def _as_json_numbers(value: Any) -> Any:
+    match value:
+        case decimal.Decimal() if value.is_finite():
+            return int(value) if value == value.to_integral_value() else float(value)
+        case dict():
+            return {key: _as_json_numbers(item) for key, item in value.items()}
+        case list() | tuple():
+            return [_as_json_numbers(item) for item in value]
+    return value
+
+
+def _limit_callables(
+    agent: SelfProgrammer,
+    callable_limits: dict[str, int],
+    limited: dict[int, ConcurrencyLimitedCallable],
+):
+    # Wrappers are shared by callable instance, so a limit applies across every agent using that
+    # instance, while different callables that happen to share a name (two nested agents, say)
+    # each keep their own. Agents nested in several hosted agents are visited once per parent, so
+    # callables already limited anywhere in their wrapper chain are left as they are
+    callables = []
+    for fn in agent.callables:
+        inner = unwrap_callable(fn)
+        if isinstance(inner, SelfProgrammer):
+            _limit_callables(inner, callable_limits, limited)
+        name = fn.definition.name
+        if name in callable_limits and not _is_wrapped_in(fn, ConcurrencyLimitedCallable):
+            if id(fn) not in limited:
+                limited[id(fn)] = ConcurrencyLimitedCallable(
+                    inner=fn, max_concurrency=callable_limits[name]
+                )
+            fn = limited[id(fn)]
+        callables.append(fn)
+    agent.callables = callables
+
+
+def _is_wrapped_in(fn: BaseCallable, wrapper: type[BaseCallable]) -> bool:
+    while isinstance(fn, BaseCallable):
+        if isinstance(fn, wrapper):
+            return True
+        fn = getattr(fn, "inner", None)
+    return False
+
+
+def _coalesce_callables(
+    agent: SelfProgrammer, coalesce: set[str], coalescing: dict[int, CoalescingCallable]
+):
+    # Shared by callable instance, like the limits, so identical calls from different agents to
+    # the same callable coalesce too; and like them, applied at most once per wrapper chain
+    callables = []
+    for fn in agent.callables:
+        inner = unwrap_callable(fn)
+        if isinstance(inner, SelfProgrammer):
+            _coalesce_callables(inner, coalesce, coalescing)
+        name = fn.definition.name
+        if name in coalesce and not _is_wrapped_in(fn, CoalescingCallable):
+            if id(fn) not in coalescing:
+                coalescing[id(fn)] = CoalescingCallable(inner=fn)
+            fn = coalescing[id(fn)]
+        callables.append(fn)
+    agent.callables = callables
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(server: AgentServer) -> type[BaseHTTPRequestHandler]:
+    class AgentRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(HTTPStatus.OK, server.metrics())
+            elif self.path == "/agents":
+                self._reply(HTTPStatus.OK, dict(agents=server.agent_names))
+            else:
+                self._reply(HTTPStatus.NOT_FOUND, dict(error=f"No route for {self.path}"))
+
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 3 or parts[0] != "agents" or parts[2] != "execute":
+                self._reply(HTTPStatus.NOT_FOUND, dict(error=f"No route for {self.path}"))
+                return
+            agent_name = urllib.parse.unquote(parts[1])
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                arguments = json.loads(self.rfile.read(length) or b"{}")
+                future = server.submit(agent_name, arguments)
+            except UnknownAgent:
+                self._reply(HTTPStatus.NOT_FOUND, dict(error=f"No agent named {agent_name!r}"))
+                return
+            except ValueError as e:
+                self._reply(HTTPStatus.BAD_REQUEST, dict(error=str(e)))
+                return
+            except ServerOverloaded as e:
+                self._reply(HTTPStatus.SERVICE_UNAVAILABLE, dict(error=str(e)), retry_after=1)
+                return
+
+            try:
+                self._reply(HTTPStatus.OK, dict(result=future.result()))
+            except ExecutionTimeout as e:
+                self._reply(HTTPStatus.GATEWAY_TIMEOUT, dict(error=str(e)))
+            except Exception as e:
+                self._reply(HTTPStatus.INTERNAL_SERVER_ERROR, dict(error=str(e)))
+
+        def _reply(self, status: HTTPStatus, body: dict, retry_after: int | None = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if retry_after is not None:
+                self.send_header("Retry-After", str(retry_after))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def address_string(self):
+            # Unix socket peers have no address
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+    return AgentRequestHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--archive", required=True, help="Agent archive to serve")
+    parser.add_argument(
+        "--callables-module",
+        action="append",
+        default=[],
+        metavar="MODULE",
+        help="Import a module that registers callables the agents use (repeatable)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", help="Serve on this Unix socket instead of TCP")
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--agent-concurrency", type=int)
+    parser.add_argument(
+        "--request-timeout", type=float, help="Fail requests that take longer than this, in seconds"
+    )
+    parser.add_argument(
+        "--callable-limit",
+        action="append",
+        default=[],
+        metavar="NAME=N",
+        help="Limit concurrent executions of a callable (repeatable)",
+    )
+    parser.add_argument(
+        "--coalesce",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Share one execution among concurrent identical calls to a callable (repeatable)",
+    )
+    args = parser.parse_args(argv)
+
+    for module in args.callables_module:
+        importlib.import_module(module)
+
+    callable_limits = {}
+    for limit in args.callable_limit:
+        name, _, value = limit.rpartition("=")
+        callable_limits[name] = int(value)
+
+    with AgentServer.from_archive(
+        args.archive,
+        max_workers=args.max_workers,
+        max_queue=args.max_queue,
+        agent_concurrency=args.agent_concurrency,
+        callable_limits=callable_limits,
+        coalesce=args.coalesce,
+        request_timeout=args.request_timeout,
+    ) as agent_server:
+        agent_server.warm()
+        if args.unix_socket:
+            http_server = agent_server.make_unix_server(args.unix_socket)
+            print(f"Serving {agent_server.agent_names} on {args.unix_socket}")
+        else:
+            http_server = agent_server.make_http_server(args.host, args.port)
+            print(f"Serving {agent_server.agent_names} on http://{args.host}:{args.port}")
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import decimal
+
+import pytest
+
+from planning_agent_demo.ast import binary
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    LiteralExpr,
+    MapExpr,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.result import ResultOk
+from planning_agent_demo.ast.run_state import RunState
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.backends import (
+    FakeBackend,
+    HedgePolicy,
+    OllamaBackend,
+    PlanningBackends,
+    RetryPolicy,
+)
+from planning_agent_demo.callables.limited import ConcurrencyLimitedCallable
+from planning_agent_demo.callables.planning import PlanningBudget
+from planning_agent_demo.callables.self_programmer import PlanExample, SelfProgrammer
+from planning_agent_demo.callables.summation import SummationTool
+
+
+def _program() -> Program:
+    return Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(intermediate_result="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(
+                        a=VariableExpr(name="x"),
+                        b=LiteralExpr(value=-300),
+                    ),
+                ),
+            ),
+            AssignmentStatement(
+                assignments=dict(result="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(
+                        a=VariableExpr(name="intermediate_result"),
+                        b=VariableExpr(name="y"),
+                    ),
+                ),
+            ),
+            AssignmentStatement(
+                assignments=dict(results="sum"),
+                rhs_expression=MapExpr(
+                    name="summation",
+                    item_parameter="a",
+                    collection=LiteralExpr(value=[1, 2]),
+                    arguments=dict(b=VariableExpr(name="result")),
+                    parallelism="serial",
+                ),
+            ),
+        ],
+        return_statement=ReturnStatement(
+            return_values=dict(
+                final_result=VariableExpr(name="result"),
+                constant=LiteralExpr(value=[None, True, 1.5, decimal.Decimal("2.5"), "s", b"b"]),
+            )
+        ),
+    )
+
+
+def _agent() -> SelfProgrammer:
+    return SelfProgrammer(
+        name="summation agent",
+        instructions="Provided x and y, compute result=x+y-300",
+        callables=[SummationTool()],
+        inputs=dict(
+            x=PlaceholderDefinition(dtype="int", description="First number"),
+            y=PlaceholderDefinition(dtype="int", description="Second number"),
+        ),
+        expected_outputs=dict(
+            final_result=PlaceholderDefinition(dtype="int", description="The result"),
+            constant=PlaceholderDefinition(dtype=list, description="Some constant"),
+        ),
+        program=_program(),
+    )
+
+
+def test_program_round_trip():
+    program = _program()
+    data = binary.dumps(program)
+    assert len(data) < len(program.model_dump_json())
+
+    decoded = binary.loads(data)
+    assert decoded == program
+
+    run_state = RunState(variables=dict(x=1, y=2))
+    decoded.evaluate(run_state)
+    assert run_state.result == ResultOk(
+        values=dict(
+            final_result=-297,
+            constant=[None, True, 1.5, decimal.Decimal("2.5"), "s", b"b"],
+        )
+    )
+
+
+def test_agent_round_trip():
+    agent = _agent()
+    parent = SelfProgrammer(
+        name="parent agent",
+        instructions="Delegate to the summation agent",
+        callables=[agent],
+        inputs=agent.inputs,
+        expected_outputs=agent.expected_outputs,
+    )
+
+    decoded = binary.loads(binary.dumps(parent))
+    assert decoded.program is None
+    assert decoded.instance_id == parent.instance_id
+    assert decoded.inputs == parent.inputs
+
+    (child,) = decoded.callables
+    assert child.program == agent.program
+    assert child.expected_outputs == agent.expected_outputs
+    assert isinstance(child.callables[0], SummationTool)
+    assert child.execute(dict(x=1, y=2)).model_dump()["final_result"] == -297
+
+
+def test_agent_settings_round_trip(tmp_path):
+    agent = _agent()
+    settings = dict(
+        planning_mode="single_shot",
+        max_tools=5,
+        step_tools=3,
+        backends=PlanningBackends(
+            default=OllamaBackend(model="small", base_url="http://localhost:1234"),
+            stages=dict(overview=FakeBackend(responses=dict(overview=[dict(x=1)]))),
+            retry=RetryPolicy(max_attempts=5),
+            hedge=HedgePolicy(percentile=0.9),
+        ),
+        plan_map_steps=not agent.plan_map_steps,
+        plan_candidates=3,
+        plan_examples=[
+            PlanExample(inputs=dict(x=1, y=2), expected_outputs=dict(final_result=-297))
+        ],
+        plan_wait_timeout=12.5,
+        plan_cache_dir=str(tmp_path / "plans"),
+        planning_budget=PlanningBudget(max_calls=10, max_seconds=60),
+        checkpoint_dir=str(tmp_path / "checkpoints"),
+        checkpoint_every=4,
+        memory_budget=1 << 20,
+        spill_dir=str(tmp_path / "spill"),
+    )
+    structural = {"instance_id", "name", "instructions", "trusted", "inline_agents", "inputs"}
+    structural |= {"expected_outputs", "callables", "program"}
+    # Fails when a field is added to agents, so that it gets covered here too
+    assert set(settings) == set(SelfProgrammer.model_fields) - structural
+    for name, value in settings.items():
+        setattr(agent, name, value)
+
+    # Wrappers are left to whoever hosts the agent, but what they wrap is kept
+    parent = agent.model_copy(
+        update=dict(callables=[ConcurrencyLimitedCallable(inner=agent, max_concurrency=1)])
+    )
+    decoded = binary.loads(binary.dumps(parent))
+    (child,) = decoded.callables
+    for loaded in (decoded, child):
+        assert loaded.model_dump(include=set(settings)) == agent.model_dump(include=set(settings))
+
+
+def test_archive(tmp_path):
+    path = tmp_path / "agents.bin"
+    values = dict(a=1, b=["x", None])
+    assert binary.write_archive(path, [_program(), _agent(), _program(), values]) == 4
+
+    with binary.ProgramArchive(path) as archive:
+        assert len(archive) == 4
+        program, agent, _, loaded = archive
+        assert program == _program()
+        assert agent.program == _program()
+        assert loaded == values
+
+
+def test_rejects_unknown_blob():
+    with pytest.raises(binary.BinaryFormatError):
+        binary.loads(b"JUNK\x01\x01")
+    blob = bytearray(binary.dumps(_program()))
+    blob[len(binary.MAGIC)] = binary.FORMAT_VERSION + 1
+    with pytest.raises(binary.BinaryFormatError, match="version"):
+        binary.loads(blob)
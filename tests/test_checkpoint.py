@@ -0,0 +1,179 @@
+from typing import ClassVar
+
+import pytest
+
+from planning_agent_demo.ast.checkpoint import CheckpointMismatch, CheckpointStore
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.memory import Buffer
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class StepInputs(BaseCallableInputs):
+    value: int
+
+
+class StepOutputs(BaseCallableOutputs):
+    value: int
+
+
+class StepTool(SimpleCallable[StepInputs, StepOutputs]):
+    """Adds one, recording each call; fails on the values in `failing`."""
+
+    name: ClassVar[str] = "step"
+    description: ClassVar[str] = "Adds one"
+    inputs: ClassVar[type[BaseCallableInputs]] = StepInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = StepOutputs
+
+    calls: ClassVar[list[int]] = []
+    failing: ClassVar[set[int]] = set()
+
+    def execute(self, arguments: StepInputs) -> StepOutputs:
+        if arguments.value in self.failing:
+            raise RuntimeError(f"Step failed on {arguments.value}")
+        self.calls.append(arguments.value)
+        return StepOutputs(value=arguments.value + 1)
+
+
+def _chain_program(length: int) -> Program:
+    names = ["a"] + [f"v{i}" for i in range(length)]
+    return Program(
+        statements=[
+            AssignmentStatement(
+                assignments={target: "value"},
+                rhs_expression=CallableInvocation(
+                    name="step", arguments=dict(value=VariableExpr(name=source))
+                ),
+            )
+            for source, target in zip(names, names[1:])
+        ],
+        return_statement=ReturnStatement(return_values=dict(result=VariableExpr(name=names[-1]))),
+    )
+
+
+def _agent(tmp_path, length: int = 4, **kwargs) -> SelfProgrammer:
+    kwargs = dict(callables=[StepTool()], program=_chain_program(length)) | kwargs
+    return SelfProgrammer(
+        name="chain",
+        instructions="Add one a few times",
+        inputs=dict(a=PlaceholderDefinition(dtype=int, description="Start")),
+        expected_outputs=dict(result=PlaceholderDefinition(dtype=int, description="End")),
+        checkpoint_dir=str(tmp_path),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("every", [1, 3])
+def test_resume_skips_completed_statements(tmp_path, every):
+    StepTool.calls.clear()
+    StepTool.failing.add(3)
+    agent = _agent(tmp_path, checkpoint_every=every)
+    try:
+        with pytest.raises(RuntimeError) as excinfo:
+            agent.execute(dict(a=0), run_id="run-1")
+    finally:
+        StepTool.failing.clear()
+    assert "chain.resume('run-1')" in excinfo.value.__notes__[0]
+    assert agent.checkpoints.runs() == ["run-1"]
+    # The statements before the failure are kept even when they weren't due a checkpoint yet
+    assert StepTool.calls == [0, 1, 2]
+
+    assert agent.resume("run-1").result == 4
+    assert StepTool.calls == [0, 1, 2, 3]
+    assert agent.checkpoints.runs() == []
+    with pytest.raises(KeyError):
+        agent.resume("run-1")
+
+
+def test_checkpoint_log_is_append_only(tmp_path):
+    store = CheckpointStore(tmp_path, every=2)
+    program = _chain_program(5)
+    checkpoint = store.start("run", program, dict(a=0))
+    sizes = []
+    for index, statement in enumerate(program.statements):
+        checkpoint.record(index, statement, _FakeRunState(index))
+        sizes.append(checkpoint.path.stat().st_size)
+    assert sizes[0] < sizes[1] == sizes[2] < sizes[3] == sizes[4]
+
+    # A record torn by a crash is dropped along with anything after it
+    with open(checkpoint.path, "ab") as f:
+        f.write(b"\x01\xff\xff")
+    checkpoint, arguments, variables = store.restore("run", program)
+    assert (checkpoint.completed, arguments) == (4, dict(a=0))
+    assert variables == dict(v0=1, v1=2, v2=3, v3=4)
+
+    with pytest.raises(CheckpointMismatch):
+        store.restore("run", _chain_program(2))
+
+    assert store.collect_garbage() == 0
+    assert store.collect_garbage(retention=-1) == 1
+    assert store.runs() == []
+
+
+class _FakeRunState:
+    def __init__(self, index: int):
+        self.variables = {f"v{i}": i + 1 for i in range(index + 1)}
+
+
+class ViewInputs(BaseCallableInputs):
+    value: int
+
+
+class ViewOutputs(BaseCallableOutputs):
+    view: Buffer
+
+
+class ViewTool(SimpleCallable[ViewInputs, ViewOutputs]):
+    """Returns a view of a buffer, which can't be pickled."""
+
+    name: ClassVar[str] = "view"
+    description: ClassVar[str] = "Views a buffer"
+    inputs: ClassVar[type[BaseCallableInputs]] = ViewInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = ViewOutputs
+
+    def execute(self, arguments: ViewInputs) -> ViewOutputs:
+        return ViewOutputs(view=memoryview(b"x" * arguments.value))
+
+
+def test_unwritable_checkpoints_dont_fail_the_run(tmp_path, capsys):
+    StepTool.calls.clear()
+    program = _chain_program(3)
+    program.statements.insert(
+        1,
+        AssignmentStatement(
+            assignments=dict(view="view"),
+            rhs_expression=CallableInvocation(
+                name="view", arguments=dict(value=VariableExpr(name="v0"))
+            ),
+        ),
+    )
+    agent = _agent(tmp_path, callables=[StepTool(), ViewTool()], program=program)
+
+    # The record holding the view can't be written, so the run carries on without checkpoints
+    assert agent.execute(dict(a=0), run_id="run-1").result == 3
+    assert StepTool.calls == [0, 1, 2]
+    assert "Stopped checkpointing run-1.ckpt" in capsys.readouterr().out
+    assert agent.checkpoints.runs() == []
+
+    # A run that then fails can still be resumed, from the last record that was written
+    StepTool.calls.clear()
+    StepTool.failing.add(2)
+    try:
+        with pytest.raises(RuntimeError) as excinfo:
+            agent.execute(dict(a=0), run_id="run-2")
+    finally:
+        StepTool.failing.clear()
+    assert "chain.resume('run-2')" in excinfo.value.__notes__[0]
+    assert agent.resume("run-2").result == 3
+    assert StepTool.calls == [0, 1, 1, 2]
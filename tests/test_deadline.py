@@ -0,0 +1,153 @@
+import time
+from typing import ClassVar
+
+import pytest
+
+from planning_agent_demo.ast.deadline import (
+    ExecutionCancelled,
+    ExecutionContext,
+    ExecutionTimeout,
+    execution_context,
+)
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    LiteralExpr,
+    MapExpr,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.result import ResultError, ResultOk
+from planning_agent_demo.ast.run_state import RunState
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class SleepInputs(BaseCallableInputs):
+    seconds: float
+
+
+class SleepOutputs(BaseCallableOutputs):
+    slept: float
+
+
+class SleepTool(SimpleCallable[SleepInputs, SleepOutputs]):
+    name: ClassVar[str] = "sleep"
+    description: ClassVar[str] = "Sleeps; fails for a negative number of seconds"
+    inputs: ClassVar[type[BaseCallableInputs]] = SleepInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = SleepOutputs
+
+    finished: ClassVar[list[float]] = []
+
+    def execute(self, arguments: SleepInputs) -> SleepOutputs:
+        if arguments.seconds < 0:
+            raise ValueError("Can't sleep for negative time")
+        time.sleep(arguments.seconds)
+        self.finished.append(arguments.seconds)
+        return SleepOutputs(slept=arguments.seconds)
+
+
+def _sleep_program(seconds) -> Program:
+    return Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(slept="slept"),
+                rhs_expression=CallableInvocation(
+                    name="sleep", arguments=dict(seconds=LiteralExpr(value=seconds))
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(return_values=dict(slept=VariableExpr(name="slept"))),
+    )
+
+
+def _run(program: Program) -> RunState:
+    run_state = RunState(available_callables=[SleepTool()])
+    program.evaluate(run_state)
+    return run_state
+
+
+def test_context_deadlines_nest():
+    with execution_context(timeout=10) as outer:
+        with execution_context(timeout=60, callable_timeouts=dict(sleep=1)) as inner:
+            assert inner.deadline == outer.deadline
+            assert inner.callable_timeouts == dict(sleep=1)
+        outer.cancel()
+        assert inner.cancelled
+        with pytest.raises(ExecutionCancelled):
+            inner.check()
+    with pytest.raises(ExecutionTimeout):
+        ExecutionContext(timeout=0).check()
+
+
+def test_callable_timeout_gives_a_timeout_result():
+    assert _run(_sleep_program(0.01)).result == ResultOk(values=dict(slept=0.01))
+
+    start = time.perf_counter()
+    with execution_context(callable_timeouts=dict(sleep=0.05)):
+        run_state = _run(_sleep_program(5))
+    assert time.perf_counter() - start < 1
+    assert isinstance(run_state.result, ResultError)
+    assert run_state.result.kind == "timeout"
+
+    run_state = _run(_sleep_program(-1))
+    assert run_state.result.kind == "error"
+
+
+def test_nested_agent_timeout_propagates():
+    child = SelfProgrammer(
+        name="sleeper",
+        instructions="Sleep",
+        callables=[SleepTool()],
+        inputs={},
+        expected_outputs=dict(slept=PlaceholderDefinition(dtype=float, description="Slept")),
+        program=_sleep_program(5),
+    )
+    parent = child.model_copy(
+        update=dict(
+            name="parent",
+            callables=[child],
+            program=Program(
+                statements=[
+                    AssignmentStatement(
+                        assignments=dict(slept="slept"),
+                        rhs_expression=CallableInvocation(name="sleeper", arguments={}),
+                    )
+                ],
+                return_statement=ReturnStatement(
+                    return_values=dict(slept=VariableExpr(name="slept"))
+                ),
+            ),
+        )
+    )
+    with execution_context(timeout=0.1), pytest.raises(ExecutionTimeout):
+        parent.execute({})
+
+
+def test_failed_map_item_cancels_its_siblings():
+    SleepTool.finished.clear()
+    program = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(slept="slept"),
+                rhs_expression=MapExpr(
+                    name="sleep",
+                    item_parameter="seconds",
+                    collection=LiteralExpr(value=[-1] + [0.2] * 8),
+                    parallelism="threads",
+                    max_workers=2,
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(return_values=dict(slept=VariableExpr(name="slept"))),
+    )
+    run_state = _run(program)
+    assert run_state.result.kind == "error"
+    # Only the item already running alongside the failed one got to finish
+    assert len(SleepTool.finished) <= 1
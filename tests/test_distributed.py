@@ -0,0 +1,137 @@
+import time
+from typing import ClassVar
+
+import pytest
+
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast import binary
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.backends import FakeBackend, PlanningBackends
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+from planning_agent_demo.serving.distributed import Coordinator, RemoteExecutionError
+
+
+class DelayInputs(BaseCallableInputs):
+    seconds: float
+
+
+class DelayOutputs(BaseCallableOutputs):
+    slept: float
+
+
+class DelayTool(SimpleCallable[DelayInputs, DelayOutputs]):
+    name: ClassVar[str] = "delay"
+    description: ClassVar[str] = "Sleeps; fails for a negative number of seconds"
+    inputs: ClassVar[type[BaseCallableInputs]] = DelayInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = DelayOutputs
+
+    def execute(self, arguments: DelayInputs) -> DelayOutputs:
+        if arguments.seconds < 0:
+            raise ValueError("Can't sleep for negative time")
+        time.sleep(arguments.seconds)
+        return DelayOutputs(slept=arguments.seconds)
+
+
+@pytest.fixture
+def agent() -> SelfProgrammer:
+    return SelfProgrammer(
+        name="delayer",
+        instructions="Sleep for a while",
+        callables=[DelayTool()],
+        inputs=dict(seconds=PlaceholderDefinition(dtype=float, description="How long")),
+        expected_outputs=dict(slept=PlaceholderDefinition(dtype=float, description="Slept")),
+        program=Program(
+            statements=[
+                AssignmentStatement(
+                    assignments=dict(slept="slept"),
+                    rhs_expression=CallableInvocation(
+                        name="delay", arguments=dict(seconds=VariableExpr(name="seconds"))
+                    ),
+                )
+            ],
+            return_statement=ReturnStatement(return_values=dict(slept=VariableExpr(name="slept"))),
+        ),
+    )
+
+
+def test_distributed_map_keeps_input_order(agent, tmp_path):
+    seconds = [0.05 * (i % 4) for i in range(24)]
+    with Coordinator(agent, str(tmp_path / "coordinator.sock")) as coordinator:
+        coordinator.spawn_workers(3, callables=[DelayTool()])
+        start = time.perf_counter()
+        results = list(coordinator.map(dict(seconds=s) for s in seconds))
+        elapsed = time.perf_counter() - start
+        metrics = coordinator.metrics()
+
+    assert results == [dict(slept=s) for s in seconds]
+    assert sum(metrics["completed"].values()) == len(seconds)
+    assert all(metrics["completed"].values())
+    # Well under the serial time
+    assert elapsed < sum(seconds) / 2
+
+
+def test_idle_workers_steal_queued_records(agent):
+    # Both of the first two records go to the first worker, stuck behind the slow one
+    seconds = [1.0, 0.01, 0.01, 0.01]
+    with Coordinator(agent, prefetch=2) as coordinator:
+        coordinator.spawn_workers(2, callables=[DelayTool()])
+        start = time.perf_counter()
+        results = list(coordinator.map(dict(seconds=s) for s in seconds))
+        elapsed = time.perf_counter() - start
+        assert coordinator.metrics()["stolen"] >= 1
+
+    assert results == [dict(slept=s) for s in seconds]
+    assert elapsed < 1.5
+
+
+def test_distributed_failures_and_lost_workers(agent):
+    with Coordinator(agent) as coordinator:
+        coordinator.spawn_workers(2, callables=[DelayTool()])
+        results = coordinator.map(dict(seconds=s) for s in [0.0, -1.0, 0.0])
+        assert next(results) == dict(slept=0.0)
+        with pytest.raises(RemoteExecutionError, match="negative time"):
+            next(results)
+
+        # Records held by a worker that dies are handed to the others
+        results = coordinator.map(dict(seconds=0.05) for _ in range(10))
+        assert next(results) == dict(slept=0.05)
+        coordinator._processes[0].kill()
+        assert list(results) == [dict(slept=0.05)] * 9
+        assert coordinator.metrics()["workers"] == 1
+
+
+def test_coordinator_plans_the_agent_before_shipping_it(agent):
+    step = dict(
+        function="delay",
+        arguments=dict(seconds=dict(variable_name="seconds")),
+        result_assignments=dict(slept="slept"),
+    )
+    backend = FakeBackend(
+        responses=dict(program=[dict(steps=[step], return_values=dict(slept="slept"))])
+    )
+    agent = agent.model_copy(
+        update=dict(
+            program=None,
+            planning_mode="single_shot",
+            backends=PlanningBackends(default=backend),
+        )
+    )
+    with Coordinator(agent) as coordinator:
+        assert agent.program is not None
+        assert binary.loads(coordinator._agent_blob, [DelayTool()]).program == agent.program
+        coordinator.spawn_workers(2, callables=[DelayTool()])
+        assert list(coordinator.map(dict(seconds=0.0) for _ in range(4))) == [dict(slept=0.0)] * 4
+
+    # Planned once, here, rather than once per worker
+    assert backend._calls == dict(program=1)
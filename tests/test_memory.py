@@ -0,0 +1,224 @@
+import mmap
+import tracemalloc
+from typing import ClassVar
+
+import pytest
+
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.memory import Buffer, SpillingScope, materialize
+from planning_agent_demo.ast.run_state import RunState
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+)
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+
+class RepeatInputs(BaseCallableInputs):
+    data: bytes
+
+
+class RepeatOutputs(BaseCallableOutputs):
+    data: bytes
+
+
+class RepeatTool(SimpleCallable[RepeatInputs, RepeatOutputs]):
+    """Doubles a buffer, recording the type of each buffer it was given."""
+
+    name: ClassVar[str] = "repeat"
+    description: ClassVar[str] = "Repeats a buffer twice"
+    inputs: ClassVar[type[BaseCallableInputs]] = RepeatInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = RepeatOutputs
+
+    received: ClassVar[list[type]] = []
+
+    def execute(self, arguments: RepeatInputs) -> RepeatOutputs:
+        self.received.append(type(arguments.data))
+        return RepeatOutputs(data=bytes(arguments.data) * 2)
+
+
+def _step(source: str, target: str) -> AssignmentStatement:
+    return AssignmentStatement(
+        assignments={target: "data"},
+        rhs_expression=CallableInvocation(
+            name="repeat", arguments=dict(data=VariableExpr(name=source))
+        ),
+    )
+
+
+def _program() -> Program:
+    # `b` is read twice and `unused` never; `c` is reassigned after its last read
+    return Program(
+        statements=[
+            _step("a", "b"),
+            _step("b", "unused"),
+            _step("b", "c"),
+            _step("c", "d"),
+            _step("d", "c"),
+        ],
+        return_statement=ReturnStatement(return_values=dict(data=VariableExpr(name="c"))),
+    )
+
+
+def test_dead_variables_are_freed():
+    program = _program()
+    assert program.dead_variables() == [["a"], ["unused"], ["b"], ["c"], ["d"]]
+    assert program.reads() == {"a"}
+
+    run_state = RunState(available_callables=[RepeatTool()], variables=dict(a=b"x"))
+    program.evaluate(run_state, free_dead=True)
+    assert run_state.result.values == dict(data=b"x" * 16)
+    assert run_state.variables == dict(c=b"x" * 16)
+
+
+def test_spilling_scope_keeps_to_its_budget(tmp_path):
+    scope = SpillingScope(
+        dict(arg=b"a" * 100), budget=1000, min_spill_bytes=100, directory=tmp_path
+    )
+    scope["small"] = b"s" * 99
+    scope["kept"] = bytearray(b"k" * 600)
+    scope["spilled"] = b"p" * 600
+    assert (scope.resident_bytes, scope.spills, scope.spilled_bytes) == (699, 1, 600)
+
+    view = scope["spilled"]
+    assert isinstance(view, memoryview) and isinstance(view.obj, mmap.mmap)
+    assert view.readonly and view == b"p" * 600
+    assert materialize(dict(values=[view])) == dict(values=[b"p" * 600])
+    with pytest.raises(TypeError):
+        view[0] = 0
+
+    # Freeing a resident buffer makes room for the next one
+    del scope["kept"]
+    scope["kept"] = b"n" * 600
+    assert (scope.resident_bytes, scope.spills, scope.peak_resident_bytes) == (699, 1, 699)
+
+    scope.zero_copy = False
+    assert scope["spilled"] == b"p" * 600 and isinstance(scope["spilled"], bytes)
+    assert dict(scope).keys() == {"arg", "small", "kept", "spilled"}
+
+
+@pytest.mark.parametrize("trusted", [True, False])
+def test_agent_runs_within_memory_budget(tmp_path, trusted):
+    RepeatTool.received.clear()
+    agent = SelfProgrammer(
+        name="repeater",
+        instructions="Repeat a buffer sixteen times",
+        callables=[RepeatTool()],
+        inputs=dict(a=PlaceholderDefinition(dtype=bytes, description="The buffer")),
+        expected_outputs=dict(data=PlaceholderDefinition(dtype=bytes, description="Repeated")),
+        program=_program(),
+        trusted=trusted,
+        memory_budget=1 << 16,
+        spill_dir=str(tmp_path),
+    )
+    assert agent.execute(dict(a=b"x" * (1 << 14))).data == b"x" * (1 << 18)
+    # Every buffer from the first one over budget on was spilled, and read back without a copy
+    # unless the callable validates its inputs as plain `bytes`
+    spilled = memoryview if trusted else bytes
+    assert RepeatTool.received == [bytes] * 3 + [spilled] * 2
+    assert list(tmp_path.iterdir()) == []
+
+
+class SourceInputs(BaseCallableInputs):
+    pass
+
+
+class SourceOutputs(BaseCallableOutputs):
+    data: Buffer
+
+
+class SourceTool(SimpleCallable[SourceInputs, SourceOutputs]):
+    """Hands out a large buffer that lives outside the Python heap."""
+
+    name: ClassVar[str] = "source"
+    description: ClassVar[str] = "Produces a large buffer"
+    inputs: ClassVar[type[BaseCallableInputs]] = SourceInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = SourceOutputs
+
+    buffer: ClassVar[mmap.mmap | None] = None
+
+    def execute(self, arguments: SourceInputs) -> SourceOutputs:
+        return SourceOutputs(data=memoryview(self.buffer))
+
+
+class ViewLengthInputs(BaseCallableInputs):
+    data: Buffer
+
+
+class BytesLengthInputs(BaseCallableInputs):
+    data: bytes
+
+
+class LengthOutputs(BaseCallableOutputs):
+    size: int
+
+
+class ViewLengthTool(SimpleCallable[ViewLengthInputs, LengthOutputs]):
+    """Measures a buffer, recording the heap memory traced at the time it was called."""
+
+    name: ClassVar[str] = "length"
+    description: ClassVar[str] = "Measures a buffer"
+    inputs: ClassVar[type[BaseCallableInputs]] = ViewLengthInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = LengthOutputs
+
+    traced: ClassVar[list[int]] = []
+
+    def execute(self, arguments) -> LengthOutputs:
+        self.traced.append(tracemalloc.get_traced_memory()[0])
+        return LengthOutputs(size=len(arguments.data))
+
+
+class BytesLengthTool(ViewLengthTool):
+    inputs: ClassVar[type[BaseCallableInputs]] = BytesLengthInputs
+
+
+@pytest.mark.parametrize("tool", [ViewLengthTool, BytesLengthTool])
+def test_untrusted_agent_reads_spilled_buffers_in_place(tmp_path, tool):
+    size = 4 << 20
+    SourceTool.buffer = mmap.mmap(-1, size)
+    ViewLengthTool.traced.clear()
+    agent = SelfProgrammer(
+        name="measurer",
+        instructions="Measure a large buffer",
+        callables=[SourceTool(), tool()],
+        inputs={},
+        expected_outputs=dict(size=PlaceholderDefinition(dtype=int, description="Its size")),
+        program=Program(
+            statements=[
+                AssignmentStatement(
+                    assignments=dict(data="data"),
+                    rhs_expression=CallableInvocation(name="source", arguments={}),
+                ),
+                AssignmentStatement(
+                    assignments=dict(size="size"),
+                    rhs_expression=CallableInvocation(
+                        name="length", arguments=dict(data=VariableExpr(name="data"))
+                    ),
+                ),
+            ],
+            return_statement=ReturnStatement(return_values=dict(size=VariableExpr(name="size"))),
+        ),
+        memory_budget=1 << 16,
+        spill_dir=str(tmp_path),
+    )
+    agent.execute({})  # Builds and caches the agent's models
+
+    tracemalloc.start()
+    try:
+        assert agent.execute({}).size == size
+    finally:
+        tracemalloc.stop()
+    # A `Buffer` parameter reads the spilled buffer through a view, even though the call is
+    # validated; a plain `bytes` one gets it copied onto the heap
+    if tool is ViewLengthTool:
+        assert ViewLengthTool.traced[-1] < size / 16
+    else:
+        assert ViewLengthTool.traced[-1] >= size
@@ -1,9 +1,24 @@
 import decimal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import ClassVar, Literal
 
+import pytest
 from langchain_ollama import ChatOllama
+from pydantic import Field, TypeAdapter, ValidationError
 
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    LiteralExpr,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
 from planning_agent_demo.ast.variable import PlaceholderDefinition
-from planning_agent_demo.callables.self_programmer import SelfProgrammer
+from planning_agent_demo.callables.backends import BaseBackend, FakeBackend, PlanningBackends
+from planning_agent_demo.callables.planning import PlanningContext, estimate_tokens
+from planning_agent_demo.callables.self_programmer import PlanExample, SelfProgrammer
 from planning_agent_demo.callables.summation import SummationTool
 
 
@@ -108,3 +123,712 @@ def test_recursive_self_programmer():
         ),
     )
     assert parent_tool.execute(dict(a=1, b=2, c=4, d=8)).model_dump() == dict(e=decimal.Decimal(15))
+
+
+def _summation_program(first: str, second: str, output: str) -> Program:
+    return Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(total="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(a=VariableExpr(name=first), b=VariableExpr(name=second)),
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(return_values={output: VariableExpr(name="total")}),
+    )
+
+
+def test_trusted_self_programmer_with_preset_program():
+    child_tool = SelfProgrammer(
+        name="summation agent",
+        instructions="Provided two input integers x and y, compute z=x+y",
+        callables=[SummationTool()],
+        inputs=dict(
+            x=PlaceholderDefinition(dtype="int", description="First number to add"),
+            y=PlaceholderDefinition(dtype="int", description="Second number to add"),
+        ),
+        expected_outputs=dict(z=PlaceholderDefinition(dtype="int", description="The sum of x + y")),
+        program=_summation_program("x", "y", "z"),
+        trusted=True,
+    )
+    parent_tool = SelfProgrammer(
+        name="super summation agent",
+        instructions="Provided two input integers a and b, compute c=a+b",
+        callables=[child_tool],
+        inputs=dict(
+            a=PlaceholderDefinition(dtype="int", description="First number to add"),
+            b=PlaceholderDefinition(dtype="int", description="Second number to add"),
+        ),
+        expected_outputs=dict(c=PlaceholderDefinition(dtype="int", description="The sum of a + b")),
+        program=Program(
+            statements=[
+                AssignmentStatement(
+                    assignments=dict(total="z"),
+                    rhs_expression=CallableInvocation(
+                        name=child_tool.name,
+                        arguments=dict(x=VariableExpr(name="a"), y=VariableExpr(name="b")),
+                    ),
+                )
+            ],
+            return_statement=ReturnStatement(return_values=dict(c=VariableExpr(name="total"))),
+        ),
+        trusted=True,
+    )
+    assert parent_tool.execute(dict(a=1, b=2)).model_dump() == dict(c=decimal.Decimal(3))
+
+
+def test_warm_up_recursive_self_programmer():
+    self_programming_tool = SelfProgrammer(
+        name="summation agent",
+        instructions="Provided two input integers x and y, compute z=x+y",
+        callables=[SummationTool()],
+        inputs=dict(
+            x=PlaceholderDefinition(dtype="int", description="First number to add"),
+            y=PlaceholderDefinition(dtype="int", description="Second number to add"),
+        ),
+        expected_outputs=dict(z=PlaceholderDefinition(dtype="int", description="The sum of x + y")),
+    )
+    parent_tool = SelfProgrammer(
+        name="super summation agent",
+        instructions="Provided four input integers--a, b, c, and d--compute e=a+b+c+d; "
+        "do this as a tree, where you first add temp1=a+b, then temp2=c+d, "
+        "then add temp1+temp2 to get e.",
+        callables=[self_programming_tool],
+        inputs=dict(
+            a=PlaceholderDefinition(dtype="int", description="First number to add"),
+            b=PlaceholderDefinition(dtype="int", description="Second number to add"),
+            c=PlaceholderDefinition(dtype="int", description="Third number to add"),
+            d=PlaceholderDefinition(dtype="int", description="Fourth number to add"),
+        ),
+        expected_outputs=dict(
+            e=PlaceholderDefinition(dtype="int", description="The sum of a + b + c + d")
+        ),
+    )
+    timings = parent_tool.warm_up()
+    assert [timing.name for timing in timings] == ["summation agent", "super summation agent"]
+    assert all(timing.planned for timing in timings)
+    assert self_programming_tool.program is not None
+    assert parent_tool.program is not None
+
+    # Warming up again is a no-op
+    assert not any(timing.planned for timing in parent_tool.warm_up())
+    assert parent_tool.execute(dict(a=1, b=2, c=4, d=8)).model_dump() == dict(e=decimal.Decimal(15))
+
+
+class TimedFakeBackend(FakeBackend):
+    """A fake backend that notes when each of its calls starts and ends."""
+
+    backend_type: Literal["timed_fake"] = Field("timed_fake", frozen=True)
+    label: str
+
+    calls: ClassVar[list[tuple[str, float, float]]] = []
+
+    def structured_call(self, generate_model, messages, *, stage, temperature):
+        start = time.perf_counter()
+        try:
+            return super().structured_call(
+                generate_model, messages, stage=stage, temperature=temperature
+            )
+        finally:
+            self.calls.append((self.label, start, time.perf_counter()))
+
+
+def _agent_tree_with_timed_planning(delay: float) -> SelfProgrammer:
+    def backends(label, steps, returned):
+        program = dict(steps=steps, return_values=dict(c=returned))
+        return PlanningBackends(
+            default=TimedFakeBackend(
+                label=label, responses=dict(program=[program]), delays=dict(program=[delay])
+            )
+        )
+
+    children = [
+        _summation_agent(
+            name=name, planning_mode="single_shot", backends=backends(name, [SUMMATION_STEP], "c")
+        )
+        for name in ("left", "right")
+    ]
+    steps = [
+        dict(
+            function="left",
+            arguments=dict(a=dict(variable_name="a"), b=dict(variable_name="b")),
+            result_assignments=dict(partial="c"),
+        ),
+        dict(
+            function="right",
+            arguments=dict(a=dict(variable_name="partial"), b=dict(variable_name="b")),
+            result_assignments=dict(total="c"),
+        ),
+    ]
+    return _summation_agent(
+        name="parent",
+        callables=children,
+        planning_mode="single_shot",
+        backends=backends("parent", steps, "total"),
+    )
+
+
+def test_warm_up_plans_nested_agents_first_and_concurrently():
+    # With a single worker, children are planned before their parents
+    TimedFakeBackend.calls.clear()
+    parent = _agent_tree_with_timed_planning(delay=0.0)
+    assert [timing.name for timing in parent.warm_up(max_workers=1)] == ["left", "right", "parent"]
+    assert [label for label, _, _ in TimedFakeBackend.calls] == ["left", "right", "parent"]
+    assert parent.execute(dict(a=1, b=2)).c == 5
+
+    # By default, every agent in the tree is planned at once
+    TimedFakeBackend.calls.clear()
+    parent = _agent_tree_with_timed_planning(delay=0.3)
+    start = time.perf_counter()
+    assert all(timing.planned for timing in parent.warm_up())
+    assert time.perf_counter() - start < 0.6
+    calls = {label: (started, ended) for label, started, ended in TimedFakeBackend.calls}
+    assert calls["left"][0] < calls["right"][1] and calls["right"][0] < calls["left"][1]
+    assert parent.execute(dict(a=1, b=2)).c == 5
+
+
+def test_inlined_recursive_self_programmer_with_preset_programs():
+    child_tool = SelfProgrammer(
+        name="summation agent",
+        instructions="Provided two input integers x and y, compute z=x+y",
+        callables=[SummationTool()],
+        inputs=dict(
+            x=PlaceholderDefinition(dtype="int", description="First number to add"),
+            y=PlaceholderDefinition(dtype="int", description="Second number to add"),
+        ),
+        expected_outputs=dict(z=PlaceholderDefinition(dtype="int", description="The sum of x + y")),
+        program=_summation_program("x", "y", "z"),
+    )
+
+    def child_call(first, second, output):
+        return AssignmentStatement(
+            assignments={output: "z"},
+            rhs_expression=CallableInvocation(
+                name=child_tool.name,
+                arguments=dict(x=VariableExpr(name=first), y=VariableExpr(name=second)),
+            ),
+        )
+
+    parent_tool = SelfProgrammer(
+        name="super summation agent",
+        instructions="Provided four input integers--a, b, c, and d--compute e=a+b+c+d",
+        callables=[child_tool],
+        inputs=dict(
+            a=PlaceholderDefinition(dtype="int", description="First number to add"),
+            b=PlaceholderDefinition(dtype="int", description="Second number to add"),
+            c=PlaceholderDefinition(dtype="int", description="Third number to add"),
+            d=PlaceholderDefinition(dtype="int", description="Fourth number to add"),
+        ),
+        expected_outputs=dict(
+            e=PlaceholderDefinition(dtype="int", description="The sum of a + b + c + d")
+        ),
+        program=Program(
+            statements=[
+                child_call("a", "b", "temp1"),
+                child_call("c", "d", "temp2"),
+                child_call("temp1", "temp2", "total"),
+            ],
+            return_statement=ReturnStatement(return_values=dict(e=VariableExpr(name="total"))),
+        ),
+        inline_agents=True,
+    )
+
+    program, callables = parent_tool._executable_program()
+    assert [fn.definition.name for fn in callables] == ["summation agent", "summation"]
+    invoked = [
+        statement.rhs_expression.name
+        for statement in program.statements
+        if isinstance(statement.rhs_expression, CallableInvocation)
+    ]
+    assert invoked == ["summation"] * 3
+    assert program.verify(parent_tool.inputs, {fn.definition.name: fn for fn in callables}) == []
+
+    assert parent_tool.execute(dict(a=1, b=2, c=4, d=8)).model_dump() == dict(e=decimal.Decimal(15))
+    parent_tool.trusted = True
+    assert parent_tool.execute(dict(a=1, b=2, c=4, d=8)).model_dump() == dict(e=decimal.Decimal(15))
+
+
+def _summation_agent(**kwargs) -> SelfProgrammer:
+    kwargs = dict(name="summation agent", callables=[SummationTool()]) | kwargs
+    return SelfProgrammer(
+        instructions="Provided two input integers a and b, compute c=a+b",
+        inputs=dict(
+            a=PlaceholderDefinition(dtype="int", description="First number to add"),
+            b=PlaceholderDefinition(dtype="int", description="Second number to add"),
+        ),
+        expected_outputs=dict(c=PlaceholderDefinition(dtype="int", description="The sum of a + b")),
+        **kwargs,
+    )
+
+
+def test_plan_candidate_selection():
+    self_programming_tool = _summation_agent(
+        plan_examples=[PlanExample(inputs=dict(a=1, b=2), expected_outputs=dict(c=3))]
+    )
+    wrong = _summation_program("a", "a", "c")
+    cheap = _summation_program("a", "b", "c")
+    expensive = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(first="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(a=VariableExpr(name="a"), b=LiteralExpr(value=0)),
+                ),
+            ),
+            *_summation_program("first", "b", "c").statements,
+        ],
+        return_statement=ReturnStatement(return_values=dict(c=VariableExpr(name="total"))),
+    )
+    unverifiable = _summation_program("a", "missing", "c")
+    # Runs fine, but returns something that isn't a number
+    invalid = Program(
+        statements=[],
+        return_statement=ReturnStatement(return_values=dict(c=LiteralExpr(value="not a number"))),
+    )
+
+    selected = self_programming_tool._select_program(
+        [wrong, invalid, unverifiable, expensive, cheap]
+    )
+    assert selected is cheap
+
+    with pytest.raises(RuntimeError):
+        self_programming_tool._select_program([wrong, unverifiable])
+
+
+def test_self_programmer_plan_search():
+    self_programming_tool = _summation_agent(
+        plan_candidates=3,
+        plan_examples=[PlanExample(inputs=dict(a=1, b=2), expected_outputs=dict(c=3))],
+    )
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+
+
+def test_plan_search_with_fake_backend():
+    def candidate(*steps):
+        return dict(steps=list(steps), return_values=dict(c="c"))
+
+    def add(first, second, result):
+        return dict(
+            function="summation",
+            arguments=dict(a=first, b=second),
+            result_assignments={result: "sum"},
+        )
+
+    a, b, partial = (dict(variable_name=name) for name in ("a", "b", "partial"))
+    wrong = candidate(add(a, a, "c"))
+    expensive = candidate(add(a, dict(literal_value=0), "partial"), add(partial, b, "c"))
+    cheap = candidate(add(a, b, "c"))
+    backend = FakeBackend(
+        responses=dict(program=[wrong, expensive, cheap]), delays=dict(program=[0.3] * 3)
+    )
+    self_programming_tool = _summation_agent(
+        planning_mode="single_shot",
+        plan_candidates=3,
+        plan_examples=[PlanExample(inputs=dict(a=1, b=2), expected_outputs=dict(c=3))],
+        backends=PlanningBackends(default=backend),
+    )
+
+    start = time.perf_counter()
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+    # The candidates were generated concurrently...
+    assert time.perf_counter() - start < 0.6
+    assert backend._calls == dict(program=3)
+    # ...and of the two that pass the example, the one making fewer calls was kept
+    program = self_programming_tool.program
+    assert len(program.statements) == 1
+    assert str(program.statements[0]) == "(c <- sum) = summation(a=a, b=b)"
+
+
+def test_planning_context_keeps_a_stable_prefix():
+    context = PlanningContext([("system", "You write programs."), ("human", "Add a and b.")])
+    overview = context.prompt("overview")
+    context.extend(("assistant", "1. Add a and b"))
+    step_1 = context.prompt("step_1", ("assistant", "Step 1; available: ['a', 'b']"))
+    step_2 = context.prompt("step_2", ("assistant", "Step 2; available: ['a', 'b', 'c']"))
+
+    # Each prompt starts with the previous prompt's shared prefix, unchanged
+    assert step_1[: len(overview)] == overview
+    assert step_2[:-1] == step_1[:-1]
+    # ... and later steps don't grow with the steps before them
+    assert len(step_2) == len(step_1)
+
+    stages = {stage.stage: stage for stage in context.stages}
+    assert stages["overview"].shared_prefix_tokens == 0
+    assert stages["step_2"].shared_prefix_tokens == sum(
+        estimate_tokens(content) for _, content in step_2[:-1]
+    )
+    assert context.total_prompt_tokens == sum(stage.prompt_tokens for stage in context.stages)
+
+
+def test_self_programmer_single_shot():
+    self_programming_tool = _summation_agent(planning_mode="single_shot")
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+
+
+SUMMATION_STEP = dict(
+    function="summation",
+    arguments=dict(a=dict(variable_name="a"), b=dict(variable_name="b")),
+    result_assignments=dict(c="sum"),
+)
+
+
+def _fake_backends(**responses) -> PlanningBackends:
+    return PlanningBackends(default=FakeBackend(responses=responses))
+
+
+def test_single_shot_planning_and_its_fallback():
+    staged = dict(
+        overview=[
+            dict(initial_thoughts="Add", detailed_thoughts="a+b", concluding_thoughts="Done")
+        ],
+        rough_plan=[
+            dict(
+                implementation_steps=[
+                    dict(step_description="Add a and b", expected_output_variable_names=["c"])
+                ]
+            )
+        ],
+        formal_step=[SUMMATION_STEP],
+        **{"return": [dict(return_values=dict(c="c"))]},
+    )
+
+    # The whole program in a single call, with no staged planning
+    backends = _fake_backends(
+        program=[dict(steps=[SUMMATION_STEP], return_values=dict(c="c"))], **staged
+    )
+    self_programming_tool = _summation_agent(planning_mode="single_shot", backends=backends)
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+    assert backends.default._calls == dict(program=1)
+
+    # A single-shot call that fails falls back to planning step by step
+    backends = _fake_backends(**staged)
+    self_programming_tool = _summation_agent(planning_mode="single_shot", backends=backends)
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+    assert backends.default._calls == dict(overview=1, rough_plan=1, formal_step=1, **{"return": 1})
+    assert [stage.stage for stage in self_programming_tool._planning_stages] == [
+        "overview",
+        "rough_plan",
+        "step_1",
+        "return",
+    ]
+
+
+def test_self_programmer_with_fake_backend():
+    self_programming_tool = _summation_agent(
+        planning_mode="single_shot",
+        backends=_fake_backends(
+            # Returns a variable that is never assigned, so planning falls back to the staged planner
+            program=[dict(steps=[SUMMATION_STEP], return_values=dict(c="total"))],
+            overview=[
+                dict(initial_thoughts="Add", detailed_thoughts="a+b", concluding_thoughts="Done")
+            ],
+            rough_plan=[
+                dict(
+                    implementation_steps=[
+                        dict(step_description="Add a and b", expected_output_variable_names=["c"])
+                    ]
+                )
+            ],
+            formal_step=[SUMMATION_STEP],
+            **{"return": [dict(return_values=dict(c="c"))]},
+        ),
+    )
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+    assert [stage.stage for stage in self_programming_tool._planning_stages] == [
+        "overview",
+        "rough_plan",
+        "step_1",
+        "return",
+    ]
+
+    # A program that verifies only takes the one call
+    self_programming_tool.program = None
+    self_programming_tool.backends.default.responses["program"] = [
+        dict(steps=[SUMMATION_STEP], return_values=dict(c="c"))
+    ]
+    assert self_programming_tool.execute(dict(a=1, b=2)).model_dump() == dict(c=decimal.Decimal(3))
+    assert [stage.stage for stage in self_programming_tool._planning_stages] == ["program"]
+
+
+def test_planning_backends_per_stage():
+    overview = FakeBackend(responses=dict(overview=[]))
+    backends = PlanningBackends.model_validate(
+        dict(default=dict(backend_type="ollama", model="llama3.2"), stages=dict(overview=overview))
+    )
+    assert backends.for_stage("overview") is backends.stages["overview"]
+    assert backends.for_stage("formal_step").model == "llama3.2"
+
+
+class ProgramOnlyBackend(BaseBackend):
+    """A user-defined backend, which always answers with the same single-shot program."""
+
+    backend_type: Literal["program_only"] = Field("program_only", frozen=True)
+    steps: list[dict]
+
+    def structured_call(self, generate_model, messages, *, stage, temperature):
+        response = dict(steps=self.steps, return_values=dict(c="c"))
+        return TypeAdapter(generate_model).validate_python(response), None
+
+
+def test_custom_backend():
+    backends = PlanningBackends(default=ProgramOnlyBackend(steps=[SUMMATION_STEP]))
+    assert PlanningBackends.model_validate_json(backends.model_dump_json()) == backends
+
+    self_programming_tool = _summation_agent(planning_mode="single_shot", backends=backends)
+    assert self_programming_tool.execute(dict(a=5, b=6)).model_dump() == dict(c=decimal.Decimal(11))
+
+    with pytest.raises(ValidationError, match="Unknown backend type"):
+        PlanningBackends.model_validate(dict(default=dict(backend_type="missing")))
+
+
+def test_self_programmer_plans_map_steps():
+    self_programming_tool = SelfProgrammer(
+        name="increment agent",
+        instructions="Add one to each of the numbers in xs",
+        callables=[SummationTool()],
+        inputs=dict(xs=PlaceholderDefinition(dtype=list, description="The numbers")),
+        expected_outputs=dict(ys=PlaceholderDefinition(dtype=list, description="xs plus one")),
+        planning_mode="single_shot",
+        plan_map_steps=True,
+        backends=_fake_backends(
+            program=[
+                dict(
+                    steps=[
+                        dict(
+                            step_type="map",
+                            function="summation",
+                            item_parameter="a",
+                            collection=dict(variable_name="xs"),
+                            arguments=dict(b=dict(literal_value=1)),
+                            result_assignments=dict(ys="sum"),
+                        )
+                    ],
+                    return_values=dict(ys="ys"),
+                )
+            ]
+        ),
+    )
+    assert self_programming_tool.execute(dict(xs=[1, 2, 3])).model_dump() == dict(ys=[2, 3, 4])
+    assert str(self_programming_tool.program.statements[0]) == (
+        "(ys <- sum) = [summation(a=_, b=Decimal('1')) for _ in xs]"
+    )
+
+
+def test_planning_calls_are_retried_and_hedged():
+    from planning_agent_demo.callables.backends import HedgePolicy, RetryPolicy, llm_call_stats
+    from planning_agent_demo.callables.self_programmer import ProgramOverview, structured_llm_call
+
+    llm_call_stats.reset()
+    thoughts = dict(initial_thoughts="Add", detailed_thoughts="a+b", concluding_thoughts="Done")
+    backends = PlanningBackends(
+        default=FakeBackend(
+            # The first response is malformed, the second is slow, and the third is quick
+            responses=dict(overview=[dict(initial_thoughts="Add"), thoughts, thoughts]),
+            delays=dict(overview=[0, 5, 0]),
+        ),
+        retry=RetryPolicy(initial_backoff=0),
+        hedge=HedgePolicy(delay=0.05),
+    )
+    overview = structured_llm_call(
+        ProgramOverview, messages=[], stage="overview", backends=backends
+    )
+    assert overview == ProgramOverview(**thoughts)
+
+    stats = llm_call_stats.snapshot()["overview"]
+    assert stats["calls"] == 1
+    assert stats["retries"] == 1
+    assert stats["hedges"] == 1
+    assert stats["hedge_win_rate"] == 1.0
+
+
+def test_structured_runnables_are_cached(monkeypatch):
+    from planning_agent_demo.callables import backends
+    from planning_agent_demo.callables.self_programmer import (
+        ProgramOverview,
+        ProgramReturnStep,
+        structured_llm_call,
+    )
+
+    prepared = []
+
+    class StubLLM:
+        def with_structured_output(self, generate_model, include_raw=False):
+            prepared.append(generate_model)
+            return StubRunnable(generate_model)
+
+    class StubRunnable:
+        def __init__(self, generate_model):
+            self.generate_model = generate_model
+
+        def invoke(self, messages):
+            parsed = self.generate_model.model_validate(messages[0][1])
+            return dict(raw=None, parsed=parsed, parsing_error=None)
+
+    monkeypatch.setattr(backends, "llm", lambda *args: StubLLM())
+    backends.structured_runnables.clear()
+    planning_backends = PlanningBackends(default=backends.OllamaBackend(model="stub"))
+
+    planning_backends.prepare(dict(overview=ProgramOverview), [0.0])
+    thoughts = dict(initial_thoughts="Add", detailed_thoughts="a+b", concluding_thoughts="Done")
+    for _ in range(2):
+        overview = structured_llm_call(
+            ProgramOverview,
+            messages=[("user", thoughts)],
+            stage="overview",
+            backends=planning_backends,
+        )
+        assert overview == ProgramOverview(**thoughts)
+
+    # Models built separately for identical schemas share a runnable
+    for _ in range(2):
+        return_model = ProgramReturnStep.create_specified_return_step(["total"], ["c"])
+        return_step = structured_llm_call(
+            ProgramReturnStep,
+            return_model,
+            messages=[("user", dict(return_values=dict(c="total")))],
+            stage="return",
+            backends=planning_backends,
+        )
+        assert return_step.return_values == dict(c="total")
+    assert len(prepared) == 2
+    assert (backends.structured_runnables.hits, backends.structured_runnables.misses) == (3, 2)
+
+    # Generated models are only converted when they may differ from the output model
+    assert backends.is_instance_of(ProgramOverview, ProgramOverview)
+    assert not backends.is_instance_of(return_model, ProgramReturnStep)
+
+
+def test_concurrent_first_requests_plan_once(tmp_path):
+    from planning_agent_demo.ast.deadline import ExecutionTimeout
+
+    def run_concurrently(agent, requests=8):
+        def execute(_):
+            try:
+                return agent.execute(dict(a=1, b=2)).c
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=requests) as executor:
+            return list(executor.map(execute, range(requests)))
+
+    program = dict(steps=[SUMMATION_STEP], return_values=dict(c="c"))
+    backends = PlanningBackends(
+        default=FakeBackend(responses=dict(program=[program]), delays=dict(program=[0.3]))
+    )
+    agent = _summation_agent(planning_mode="single_shot", backends=backends)
+    assert run_concurrently(agent) == [3] * 8
+    assert backends.default._calls == dict(program=1)
+
+    # Failures reach every waiting request, and the next request tries again
+    failing = _summation_agent(planning_mode="single_shot", backends=_fake_backends())
+    results = run_concurrently(failing)
+    assert all(isinstance(result, LookupError) for result in results)
+
+    # Waiters give up after `plan_wait_timeout`, while the request planning carries on
+    slow = _summation_agent(
+        planning_mode="single_shot",
+        plan_wait_timeout=0.05,
+        backends=PlanningBackends(
+            default=FakeBackend(responses=dict(program=[program]), delays=dict(program=[0.5]))
+        ),
+    )
+    results = run_concurrently(slow, requests=4)
+    assert results.count(3) == 1
+    assert sum(isinstance(result, ExecutionTimeout) for result in results) == 3
+
+    # Identical agents, in this process or another, reuse a plan saved to the plan cache
+    cached = [
+        _summation_agent(
+            planning_mode="single_shot", backends=backends, plan_cache_dir=str(tmp_path)
+        )
+        for _ in range(2)
+    ]
+    assert cached[0].plan_key == cached[1].plan_key == agent.plan_key
+    assert [fn.execute(dict(a=1, b=2)).c for fn in cached] == [3, 3]
+    assert backends.default._calls == dict(program=2)
+
+    # ...but not a plan made under different planning settings
+    from planning_agent_demo.callables.planning import PlanningBudget
+
+    for setting in [
+        dict(planning_mode="staged"),
+        dict(plan_map_steps=True),
+        dict(plan_candidates=3),
+        dict(plan_examples=[PlanExample(inputs=dict(a=1, b=2), expected_outputs=dict(c=3))]),
+        dict(planning_budget=PlanningBudget(max_calls=5)),
+    ]:
+        assert agent.model_copy(update=setting).plan_key != agent.plan_key, setting
+
+
+def test_planning_profile_and_budget():
+    from planning_agent_demo.callables.planning import (
+        PlanningBudget,
+        PlanningBudgetExceeded,
+        planning_profiler,
+    )
+
+    def staged_backends():
+        thoughts = dict(initial_thoughts="Add", detailed_thoughts="a+b", concluding_thoughts="Done")
+        step = dict(step_description="Add a and b", expected_output_variable_names=["c"])
+        return _fake_backends(
+            overview=[thoughts],
+            rough_plan=[dict(implementation_steps=[step])],
+            formal_step=[SUMMATION_STEP],
+            **{"return": [dict(return_values=dict(c="c"))]},
+        )
+
+    planning_profiler.reset()
+    self_programming_tool = _summation_agent(backends=staged_backends())
+    self_programming_tool.execute(dict(a=1, b=2))
+
+    stages = {stage.stage: stage for stage in self_programming_tool._planning_stages}
+    assert stages["step_1"].kind == "formal_step"
+    assert stages["step_1"].history_chars > stages["overview"].history_chars
+    assert stages["step_1"].schema_bytes > stages["overview"].schema_bytes
+    summary = planning_profiler.summary()
+    assert summary["runs"] == 1
+    assert set(summary["stages"]) == {"overview", "rough_plan", "formal_step", "return"}
+    assert all(
+        totals["calls"] == 1 and totals["seconds"] > 0 and totals["completion_tokens"] > 0
+        for totals in summary["stages"].values()
+    )
+    assert summary["agents"]["summation agent"]["calls"] == 4
+    assert "formal_step: 1 calls" in planning_profiler.report()
+
+    over_budget = _summation_agent(
+        backends=staged_backends(), planning_budget=PlanningBudget(max_calls=2)
+    )
+    with pytest.raises(PlanningBudgetExceeded, match="2 calls"):
+        over_budget.execute(dict(a=1, b=2))
+    # The aborted run is profiled too
+    assert planning_profiler.summary()["runs"] == 2
+    assert planning_profiler.summary()["stages"]["overview"]["calls"] == 2
+
+    # One budget covers the whole planning run: the fallback from single-shot planning...
+    fallback_backends = staged_backends()
+    fallback_backends.default.responses["program"] = [dict(steps=[], return_values=dict(c="c"))]
+    fallback = _summation_agent(
+        planning_mode="single_shot",
+        backends=fallback_backends,
+        planning_budget=PlanningBudget(max_calls=4),
+    )
+    with pytest.raises(PlanningBudgetExceeded, match="4 calls"):
+        fallback.execute(dict(a=1, b=2))
+    assert fallback_backends.default._calls == dict(
+        program=1, overview=1, rough_plan=1, formal_step=1
+    )
+
+    # ...and every candidate of a plan search
+    program = dict(steps=[SUMMATION_STEP], return_values=dict(c="c"))
+    search_backends = _fake_backends(program=[program])
+    search = _summation_agent(
+        planning_mode="single_shot",
+        plan_candidates=4,
+        backends=search_backends,
+        planning_budget=PlanningBudget(max_calls=2),
+    )
+    assert search.execute(dict(a=1, b=2)).c == 3
+    assert search_backends.default._calls == dict(program=2)
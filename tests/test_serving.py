@@ -0,0 +1,288 @@
+import decimal
+import threading
+import time
+from typing import ClassVar
+
+import httpx
+import pytest
+
+from planning_agent_demo.ast.deadline import ExecutionTimeout
+from planning_agent_demo.ast.expression import (
+    AssignmentStatement,
+    CallableInvocation,
+    Program,
+    ReturnStatement,
+    VariableExpr,
+)
+from planning_agent_demo.ast.variable import PlaceholderDefinition
+from planning_agent_demo.callables.base import (
+    BaseCallableInputs,
+    BaseCallableOutputs,
+    SimpleCallable,
+    unwrap_callable,
+)
+from planning_agent_demo.callables.coalescing import (
+    CoalescingCallable,
+    argument_key,
+    coalescing_stats,
+)
+from planning_agent_demo.callables.limited import ConcurrencyLimitedCallable
+from planning_agent_demo.callables.self_programmer import SelfProgrammer
+from planning_agent_demo.callables.summation import SummationTool
+from planning_agent_demo.serving.load_generator import run_load
+from planning_agent_demo.serving.server import AgentServer, ServerOverloaded
+
+
+class GateInputs(BaseCallableInputs):
+    value: int
+
+
+class GateOutputs(BaseCallableOutputs):
+    value: int
+
+
+class GateTool(SimpleCallable[GateInputs, GateOutputs]):
+    """Blocks every execution until the test opens the gate."""
+
+    name: ClassVar[str] = "gate"
+    description: ClassVar[str] = "Passes its input through once the gate opens"
+    inputs: ClassVar[type[BaseCallableInputs]] = GateInputs
+    outputs: ClassVar[type[BaseCallableOutputs]] = GateOutputs
+
+    gate: ClassVar[threading.Event] = threading.Event()
+
+    def execute(self, arguments: GateInputs) -> GateOutputs:
+        self.gate.wait(timeout=10)
+        return GateOutputs(value=arguments.value)
+
+
+def _agent(name: str, invocation: CallableInvocation, returned: str, callables) -> SelfProgrammer:
+    return SelfProgrammer(
+        name=name,
+        instructions="Compute c from a and b",
+        callables=callables,
+        inputs=dict(
+            a=PlaceholderDefinition(dtype="int", description="First number"),
+            b=PlaceholderDefinition(dtype="int", description="Second number"),
+        ),
+        expected_outputs=dict(c=PlaceholderDefinition(dtype="int", description="The result")),
+        program=Program(
+            statements=[
+                AssignmentStatement(assignments=dict(result=returned), rhs_expression=invocation)
+            ],
+            return_statement=ReturnStatement(return_values=dict(c=VariableExpr(name="result"))),
+        ),
+    )
+
+
+def _adder() -> SelfProgrammer:
+    invocation = CallableInvocation(
+        name="summation", arguments=dict(a=VariableExpr(name="a"), b=VariableExpr(name="b"))
+    )
+    return _agent("adder", invocation, "sum", [SummationTool()])
+
+
+def _gated() -> SelfProgrammer:
+    invocation = CallableInvocation(name="gate", arguments=dict(value=VariableExpr(name="a")))
+    return _agent("gated", invocation, "value", [GateTool()])
+
+
+def test_server_executes_requests():
+    with AgentServer([_adder()]) as server:
+        server.warm()
+        assert server.execute("adder", dict(a=1, b=2)) == dict(c=3)
+        metrics = server.metrics()
+        assert metrics["completed"] == 1
+        assert metrics["queue_depth"] == 0
+
+
+def test_server_sheds_load_and_limits_callables():
+    GateTool.gate.clear()
+    agent = _gated()
+    with AgentServer([agent], max_workers=4, max_queue=2, callable_limits=dict(gate=1)) as server:
+        assert isinstance(agent.callables[0], ConcurrencyLimitedCallable)
+
+        # Occupy all four workers; the gate callable lets only one of them in at a time
+        futures = []
+        for i in range(4):
+            futures.append(server.submit("gated", dict(a=i, b=0)))
+            while server.metrics()["queue_depth"] > 0:
+                time.sleep(0.01)
+
+        # The next two requests fill the queue, and anything beyond that is shed
+        futures += [server.submit("gated", dict(a=i, b=0)) for i in range(4, 6)]
+        with pytest.raises(ServerOverloaded):
+            server.submit("gated", dict(a=6, b=0))
+
+        GateTool.gate.set()
+        assert [future.result(timeout=10) for future in futures] == [dict(c=i) for i in range(6)]
+        assert server.metrics()["rejected"] == 1
+
+
+def test_server_over_http():
+    with AgentServer([_adder()]) as server:
+        http_server = server.make_http_server(port=0)
+        thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            host, port = http_server.server_address
+            with httpx.Client(base_url=f"http://{host}:{port}") as client:
+                response = client.post("/agents/adder/execute", json=dict(a=1, b=2))
+                assert response.json() == dict(result=dict(c=3))
+                # Numbers come back as JSON numbers, not strings
+                assert isinstance(response.json()["result"]["c"], int)
+                assert client.post("/agents/missing/execute", json={}).status_code == 404
+                assert client.post("/agents/adder/execute", json=dict(a=1)).status_code == 400
+
+                report = run_load(client, "adder", dict(a=1, b=2), concurrency=4, requests=20)
+                assert report["statuses"] == {200: 20}
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+def test_server_times_out_requests():
+    GateTool.gate.clear()
+    with AgentServer([_gated()], request_timeout=0.1) as server:
+        with pytest.raises(ExecutionTimeout):
+            server.execute("gated", dict(a=1, b=0), timeout=5)
+        assert server.metrics()["timed_out"] == 1
+        GateTool.gate.set()
+
+
+def test_server_coalesces_identical_calls():
+    GateTool.gate.clear()
+    coalescing_stats.reset()
+    agent = _gated()
+    with AgentServer([agent], max_workers=6, coalesce=["gate"]) as server:
+        assert isinstance(agent.callables[0], CoalescingCallable)
+
+        futures = [server.submit("gated", dict(a=1, b=i)) for i in range(4)]
+        futures += [server.submit("gated", dict(a=2, b=0)) for _ in range(2)]
+        while coalescing_stats.snapshot().get("gate", {}).get("in_flight") != 6:
+            time.sleep(0.01)
+
+        GateTool.gate.set()
+        assert [future.result(timeout=10) for future in futures] == [dict(c=1)] * 4 + [
+            dict(c=2)
+        ] * 2
+        stats = server.metrics()["coalescing"]["gate"]
+        assert (stats["calls"], stats["executions"], stats["coalesced"]) == (6, 2, 4)
+        assert stats["coalescing_ratio"] == pytest.approx(4 / 6)
+
+
+def test_argument_key_is_canonical():
+    assert argument_key(dict(a=1, b=[1.5, "x"])) == argument_key(dict(b=[1.5, "x"], a=1))
+    assert argument_key(GateInputs(value=1)) == argument_key(GateInputs.model_construct(value=1))
+    assert argument_key(decimal.Decimal("1.50")) == argument_key(decimal.Decimal("1.5"))
+    values = [1, 1.0, True, "1", b"1", [1], {1}, decimal.Decimal(1)]
+    assert len({argument_key(value) for value in values}) == 8
+    assert argument_key(dict(a=object())) is None
+
+
+def _parent(name: str, child: SelfProgrammer) -> SelfProgrammer:
+    invocation = CallableInvocation(
+        name=child.name, arguments=dict(a=VariableExpr(name="a"), b=VariableExpr(name="b"))
+    )
+    return _agent(name, invocation, "c", [child])
+
+
+def test_server_quoted_names_same_named_agents_and_cancellation():
+    # Two different nested agents that share a name must each keep their own limit wrapper
+    doubler = _agent(
+        "inner",
+        CallableInvocation(
+            name="summation", arguments=dict(a=VariableExpr(name="a"), b=VariableExpr(name="a"))
+        ),
+        "sum",
+        [SummationTool()],
+    )
+    adder = _adder().model_copy(update=dict(name="inner"))
+    agents = [_parent("add numbers", adder), _parent("double", doubler), _gated()]
+    GateTool.gate.clear()
+    with AgentServer(agents, max_workers=1, callable_limits=dict(inner=1)) as server:
+        http_server = server.make_http_server(port=0)
+        thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            host, port = http_server.server_address
+            with httpx.Client(base_url=f"http://{host}:{port}") as client:
+                response = client.post("/agents/add%20numbers/execute", json=dict(a=1, b=2))
+                assert response.json() == dict(result=dict(c=3))
+            assert server.execute("double", dict(a=5, b=0)) == dict(c=10)
+
+            # A request cancelled while queued is counted as such, rather than as completed
+            running = server.submit("gated", dict(a=1, b=0))
+            queued = server.submit("gated", dict(a=2, b=0))
+            assert queued.cancel()
+            GateTool.gate.set()
+            assert running.result(timeout=10) == dict(c=1)
+            while server.metrics()["in_flight"] or server.metrics()["queue_depth"]:
+                time.sleep(0.01)
+            metrics = server.metrics()
+            assert (metrics["completed"], metrics["cancelled"]) == (3, 1)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+def test_server_coalesces_nested_agents():
+    # Nested agents are called with the parent's values, which are decimals
+    GateTool.gate.clear()
+    coalescing_stats.reset()
+    with AgentServer([_parent("outer", _gated())], max_workers=4, coalesce=["gated"]) as server:
+        futures = [server.submit("outer", dict(a=1, b=2)) for _ in range(4)]
+        while coalescing_stats.snapshot().get("gated", {}).get("in_flight") != 4:
+            time.sleep(0.01)
+
+        GateTool.gate.set()
+        assert [future.result(timeout=10) for future in futures] == [dict(c=1)] * 4
+        stats = server.metrics()["coalescing"]["gated"]
+        assert (stats["calls"], stats["executions"], stats["unkeyed"]) == (4, 1, 0)
+
+
+def _wrappers(fn) -> list[type]:
+    chain = []
+    while hasattr(fn, "inner"):
+        chain.append(type(fn))
+        fn = fn.inner
+    return chain
+
+
+def test_server_limits_shared_nested_agents_once():
+    child = _adder().model_copy(update=dict(name="child"))
+    agents = [_parent("first", child), _parent("second", child)]
+    limits = dict(summation=1, child=1)
+    with AgentServer(agents, callable_limits=limits, coalesce=["summation", "child"]) as server:
+        assert server.execute("second", dict(a=1, b=2)) == dict(c=3)
+
+    # However many agents it's nested in, each callable is limited exactly once
+    for fn in [*child.callables, *(agent.callables[0] for agent in agents)]:
+        assert _wrappers(fn).count(ConcurrencyLimitedCallable) == 1
+    assert agents[0].callables[0] is agents[1].callables[0]
+
+
+def test_server_wraps_shared_nested_agents_in_order():
+    child = _adder().model_copy(update=dict(name="child"))
+    agents = [_parent("first", child), _parent("second", child)]
+    limits = dict(summation=1, child=1)
+    AgentServer(agents, callable_limits=limits, coalesce=["summation", "child"]).close()
+    # Hosting them again (say, on a second server) changes nothing
+    AgentServer(agents[::-1], callable_limits=limits, coalesce=["summation", "child"]).close()
+
+    # Coalescing outside a single limit, so callers waiting on a shared call don't hold a slot
+    (summation,) = child.callables
+    assert _wrappers(summation) == [CoalescingCallable, ConcurrencyLimitedCallable]
+    assert isinstance(unwrap_callable(summation), SummationTool)
+    for agent in agents:
+        assert _wrappers(agent.callables[0]) == [CoalescingCallable, ConcurrencyLimitedCallable]
+        assert unwrap_callable(agent.callables[0]) is child
+
+    # Nor is a callable wrapped again when it's already coalesced further in
+    pre_wrapped = ConcurrencyLimitedCallable(
+        inner=CoalescingCallable(inner=SummationTool()), max_concurrency=2
+    )
+    agent = _adder()
+    agent.callables = [pre_wrapped]
+    AgentServer([agent], coalesce=["summation"]).close()
+    assert agent.callables[0] is pre_wrapped
@@ -158,3 +158,208 @@ def test_invocation_template():
                 )
             )
         )
+
+
+def test_summation_trusted_execution():
+    summation_tool = SummationTool()
+    arguments = SummationInputs.model_construct(a=1, b=2, c=4)
+    assert summation_tool.execute_trusted(arguments) == dict(sum=7)
+
+
+def test_summation_in_trusted_program():
+    run_state = RunState(
+        variables=dict(
+            x=1,
+            y=2,
+            z=4,
+        ),
+        trusted=True,
+    )
+    program = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(result="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(
+                        a=VariableExpr(name="x"),
+                        b=VariableExpr(name="y"),
+                        c=VariableExpr(name="z"),
+                    ),
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(
+            return_values=dict(final_result=VariableExpr(name="result"))
+        ),
+    )
+    assert program.verify(run_state.variables, run_state.callables) == []
+    program.evaluate(run_state)
+    assert run_state.result == ResultOk(values=dict(final_result=7))
+
+
+def test_program_verification():
+    program = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(result="total"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(
+                        a=VariableExpr(name="x"),
+                        c=VariableExpr(name="undefined"),
+                    ),
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(
+            return_values=dict(final_result=VariableExpr(name="result"))
+        ),
+    )
+    errors = program.verify(["x"], RunState().callables, expected_outputs=["final_result"])
+    assert errors == [
+        "statement 1: variable `undefined` is used before it is assigned",
+        "statement 1: `summation` is missing parameters ['b']",
+        "statement 1: `summation` does not return ['total']",
+    ]
+
+
+def test_tool_index_shortlists_relevant_callables():
+    from planning_agent_demo.ast.variable import PlaceholderDefinition
+    from planning_agent_demo.callables.retrieval import ToolIndex
+    from planning_agent_demo.callables.self_programmer import SelfProgrammer
+
+    def tool(name, instructions):
+        number = PlaceholderDefinition(dtype="int", description="A number")
+        return SelfProgrammer(
+            name=name,
+            instructions=instructions,
+            callables=[],
+            inputs=dict(value=number),
+            expected_outputs=dict(result=number),
+        )
+
+    summation = SummationTool()
+    tools = [
+        tool("weather lookup", "Look up the weather forecast for a city"),
+        summation,
+        tool("email sender", "Send an email message to a recipient"),
+        tool("string reverser", "Reverse the characters in a string"),
+    ]
+    index = ToolIndex(tools)
+    assert index.search("forecast the weather in Paris", 1) == [tools[0]]
+    assert index.search("add up the numbers and return their sum", 1) == [summation]
+    assert index.search("send an email", 2, among=tools[2:])[0] is tools[2]
+    assert len(index.search("anything", 10)) == len(tools)
+
+    agent = SelfProgrammer(
+        name="emailer",
+        instructions="Send an email to the recipient",
+        callables=tools,
+        inputs={},
+        expected_outputs={},
+        max_tools=2,
+    )
+    assert agent._planning_tools()[0] is tools[2]
+    assert len(agent._planning_tools()) == 2
+
+
+def test_scope_is_copy_on_write():
+    from planning_agent_demo.ast.scope import Scope
+
+    parent = dict(a=1, b=[1, 2, 3])
+    scope = Scope(parent)
+    child = scope.child(c=3)
+    child["a"] = 10
+    del child["b"]
+
+    assert dict(child) == dict(a=10, c=3)
+    assert dict(scope) == parent == dict(a=1, b=[1, 2, 3])
+    assert scope["b"] is parent["b"]
+    assert RunState(variables=child).variables is child
+
+
+def test_by_reference_values_are_not_copied():
+    from planning_agent_demo.ast.utils import PlaceholderDict
+    from planning_agent_demo.ast.variable import PlaceholderDefinition
+
+    def inputs_type(by_reference):
+        items = PlaceholderDefinition(dtype=list, description="", by_reference=by_reference)
+        return PlaceholderDict(placeholders=dict(items=items)).to_pydantic("Inputs")
+
+    items = [1, 2, 3]
+    assert inputs_type(by_reference=True)(items=items).items is items
+    assert inputs_type(by_reference=False)(items=items).items is not items
+    with pytest.raises(ValidationError):
+        inputs_type(by_reference=True)(items=(1, 2, 3))
+
+
+@pytest.mark.parametrize("parallelism", ["serial", "threads", "processes"])
+def test_map_over_collection(parallelism):
+    from planning_agent_demo.ast.expression import MapExpr
+
+    program = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(totals="sum"),
+                rhs_expression=MapExpr(
+                    name="summation",
+                    item_parameter="a",
+                    collection=VariableExpr(name="xs"),
+                    arguments=dict(b=LiteralExpr(value=10)),
+                    parallelism=parallelism,
+                    max_workers=4,
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(return_values=dict(totals=VariableExpr(name="totals"))),
+    )
+    assert str(program.statements[0]) == "(totals <- sum) = [summation(a=_, b=10) for _ in xs]"
+    assert program.verify(["xs"], RunState().callables, expected_outputs=["totals"]) == []
+
+    run_state = RunState(variables=dict(xs=list(range(20))))
+    program.evaluate(run_state)
+    assert run_state.result == ResultOk(values=dict(totals=[x + 10 for x in range(20)]))
+
+
+def test_map_verification():
+    from planning_agent_demo.ast.expression import MapExpr
+
+    expression = MapExpr(
+        name="summation",
+        item_parameter="a",
+        collection=VariableExpr(name="missing"),
+        arguments=dict(a=LiteralExpr(value=1)),
+    )
+    assert expression.verify(set(), RunState().callables) == [
+        "variable `missing` is used before it is assigned",
+        "`a` is both the item parameter and an argument",
+        "`summation` is missing parameters ['b']",
+    ]
+
+
+@pytest.mark.parametrize("trusted", [False, True])
+def test_trusted_program_coerces_like_untrusted(trusted):
+    run_state = RunState(variables=dict(x=1, y=True), trusted=trusted)
+    program = Program(
+        statements=[
+            AssignmentStatement(
+                assignments=dict(result="sum"),
+                rhs_expression=CallableInvocation(
+                    name="summation",
+                    arguments=dict(
+                        a=VariableExpr(name="x"),
+                        b=LiteralExpr(value="2"),
+                        c=VariableExpr(name="y"),
+                    ),
+                ),
+            )
+        ],
+        return_statement=ReturnStatement(
+            return_values=dict(final_result=VariableExpr(name="result"))
+        ),
+    )
+    assert program.verify(run_state.variables, run_state.callables) == []
+    program.evaluate(run_state)
+    assert run_state.result == ResultOk(values=dict(final_result=4))
+    assert type(run_state.result.values["final_result"]) is int